@@ -0,0 +1,89 @@
+"""
+Measures how long it takes to import modelmw_client and create an API client, and
+checks that neither imports pandas or opens a session.
+
+Run from the root of the repository:
+    python benchmarks/import_time.py [--runs 5] [--max-ms 400]
+
+Exits with a non-zero status if pandas is imported, a session is created, or the
+median import time is over the limit.
+"""
+#%%
+import argparse
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+
+# run in a fresh interpreter, so nothing is already imported
+CHECK_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import modelmw_client
+import_ms = (time.perf_counter() - start) * 1000
+start = time.perf_counter()
+mmw_run = modelmw_client.ModelMyWatershedAPI("not-a-real-key")
+init_ms = (time.perf_counter() - start) * 1000
+print(
+    import_ms,
+    init_ms,
+    "pandas" in sys.modules,
+    mmw_run._mmw_session is not None,
+)
+"""
+
+
+#%%
+def run_once() -> tuple:
+    completed = subprocess.run(
+        [sys.executable, "-c", CHECK_SCRIPT],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    import_ms, init_ms, pandas_imported, session_created = completed.stdout.split()
+    return (
+        float(import_ms),
+        float(init_ms),
+        pandas_imported == "True",
+        session_created == "True",
+    )
+
+
+def main() -> int:
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--runs", type=int, default=5)
+    arg_parser.add_argument("--max-ms", type=float, default=400.0)
+    args = arg_parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+    import_ms = statistics.median(run[0] for run in runs)
+    init_ms = statistics.median(run[1] for run in runs)
+    pandas_imported = any(run[2] for run in runs)
+    session_created = any(run[3] for run in runs)
+
+    print(
+        "import modelmw_client: {:.1f} ms (median of {})".format(import_ms, args.runs)
+    )
+    print("ModelMyWatershedAPI(): {:.1f} ms".format(init_ms))
+    print("pandas imported: {}".format(pandas_imported))
+    print("session created: {}".format(session_created))
+
+    failed = False
+    if pandas_imported:
+        print("FAIL: pandas should only be imported when a data frame is made")
+        failed = True
+    if session_created:
+        print("FAIL: the session should only be created on the first request")
+        failed = True
+    if import_ms > args.max_ms:
+        print("FAIL: import took longer than {:.0f} ms".format(args.max_ms))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,348 @@
+"""
+Stress tests one API client shared by a pool of threads, against a local mock of the
+ModelMyWatershed server.
+
+Every thread starts jobs on the analysis and the older (form data) modeling endpoints,
+polls for their results and creates projects, all through the same client, while
+another thread logs in again part way through.  Then background and interactive jobs
+are run through a job queue on the same client while the threads keep starting jobs
+directly.  The mock server records the headers of every request, and the run checks
+that:
+
+- each request had the content type, referer and origin of its own endpoint
+- every request after the first login had the CSRF token
+- each job got back the result of its own payload
+- the job starts stayed within the client's rate limit, and each took exactly one
+  token from it
+- the interactive jobs in the queue started ahead of the queued background jobs
+
+Run from the root of the repository:
+    python benchmarks/thread_safety.py [--threads 16] [--jobs 200]
+
+Exits with a non-zero status if any check fails.
+"""
+#%%
+import argparse
+import itertools
+import json
+import logging
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from modelmw_client import (
+    ModelMyWatershedAPI,
+    ModelMyWatershedJobQueue,
+    ModelMyWatershedRateLimiter,
+)
+
+CSRF_TOKEN = "not-a-real-csrf-token"
+
+
+#%%
+class MockServer(ThreadingHTTPServer):
+    """A mock ModelMyWatershed server, recording every request it gets"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), MockHandler)
+        self.lock = threading.Lock()
+        # (time, method, path, headers) of each request
+        self.requests = []
+        # the payload of each job, by job id
+        self.jobs = {}
+        # when each job was started, by its label
+        self.job_start_times = {}
+        self.project_ids = itertools.count(1)
+
+    @property
+    def host(self) -> str:
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _record(self) -> bytes:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0) or 0))
+        with self.server.lock:
+            self.server.requests.append(
+                (time.monotonic(), self.command, self.path, dict(self.headers))
+            )
+        return body
+
+    def _send(self, status: int, response: dict, headers: dict = None) -> None:
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        body = self._record()
+        if self.path.startswith("/user/login"):
+            self._send(
+                200, {}, {"Set-Cookie": "csrftoken={}; Path=/".format(CSRF_TOKEN)}
+            )
+        elif "/projects/" in self.path:
+            self._send(201, {"id": next(self.server.project_ids)})
+        else:
+            job_id = str(uuid.uuid4())
+            if "tr55" in self.path:
+                payload = {
+                    key: values[0]
+                    for key, values in parse_qs(body.decode("utf-8")).items()
+                }
+            else:
+                payload = json.loads(body)
+            with self.server.lock:
+                self.server.jobs[job_id] = payload
+                self.server.job_start_times[
+                    payload.get("huc", payload.get("model_input"))
+                ] = time.monotonic()
+            self._send(200, {"job": job_id, "job_uuid": job_id, "status": "started"})
+
+    def do_GET(self) -> None:
+        self._record()
+        job_id = self.path.rstrip("/").split("/")[-1]
+        with self.server.lock:
+            payload = self.server.jobs.get(job_id)
+        if payload is None:
+            self._send(404, {"detail": "Not found."})
+        else:
+            self._send(
+                200, {"job_uuid": job_id, "status": "complete", "result": payload}
+            )
+
+
+class CountingRateLimiter(ModelMyWatershedRateLimiter):
+    """A rate limiter that counts the tokens taken from it"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n_taken = 0
+        self._count_lock = threading.Lock()
+
+    def acquire(self, *args, **kwargs) -> bool:
+        taken = super().acquire(*args, **kwargs)
+        if taken:
+            with self._count_lock:
+                self.n_taken += 1
+        return taken
+
+
+#%%
+def expected_headers(mmw_api: ModelMyWatershedAPI, path: str) -> dict:
+    """The headers a request to a path should have had"""
+    if path.startswith("/" + mmw_api.project_endpoint) or path.startswith(
+        "/" + mmw_api.old_modeling_endpoint
+    ):
+        referer = "{}/project/".format(mmw_api.mmw_host)
+    else:
+        referer = "{}/analyze".format(mmw_api.mmw_host)
+    if path.startswith("/" + mmw_api.old_modeling_endpoint) and not path.startswith(
+        "/" + mmw_api.project_endpoint
+    ):
+        content_type = "application/x-www-form-urlencoded; charset=UTF-8"
+    else:
+        content_type = "application/json"
+    return {
+        "Content-Type": content_type,
+        "Referer": referer,
+        "Origin": mmw_api.mmw_host,
+        "X-CSRFToken": CSRF_TOKEN,
+    }
+
+
+def run_task(mmw_api: ModelMyWatershedAPI, task_number: int) -> list:
+    """Runs one job, or creates one project, and returns any problems"""
+    label = "task_{}".format(task_number)
+    if task_number % 3 == 0:
+        project = mmw_api.create_project("gwlfe", name=label, huc="020402050301")
+        return [] if "id" in project else ["{}: no project made".format(label)]
+    if task_number % 3 == 1:
+        endpoint = mmw_api.land_endpoint.format("2019_2019")
+        payload = {"huc": label}
+    else:
+        endpoint = mmw_api.tr55_endpoint
+        payload = "model_input={}".format(label).encode("utf-8")
+    started = mmw_api.start_job(endpoint, label, payload)
+    finished = mmw_api.get_job_result(started)
+    if finished.get("job_result_status") != "succeeded":
+        return ["{}: job failed".format(label)]
+    result = finished["result_response"]["result"]
+    if result.get("huc", result.get("model_input")) != label:
+        return ["{}: got the result of another job, {}".format(label, result)]
+    return []
+
+
+def check_queued_job(queued_job, label: str) -> list:
+    """Checks that a job run through the job queue got its own result"""
+    job_dict = queued_job.result()
+    if job_dict is None or job_dict.get("job_result_status") != "succeeded":
+        return ["{}: queued job failed".format(label)]
+    if job_dict["result_response"]["result"].get("huc") != label:
+        return ["{}: queued job got the result of another job".format(label)]
+    return []
+
+
+def run_queue(mmw_api: ModelMyWatershedAPI, server: MockServer, args) -> list:
+    """Runs background and interactive jobs through a job queue while the threads
+    keep starting jobs directly, and returns any problems"""
+    problems = []
+    endpoint = mmw_api.land_endpoint.format("2019_2019")
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        direct_futures = [
+            executor.submit(run_task, mmw_api, task_number)
+            for task_number in range(args.jobs, args.jobs + args.jobs // 2)
+        ]
+        with ModelMyWatershedJobQueue(mmw_api, max_workers=4) as job_queue:
+            background_labels = ["background_{}".format(n) for n in range(40)]
+            background_jobs = [
+                job_queue.submit(endpoint, label, {"huc": label}, priority="background")
+                for label in background_labels
+            ]
+            interactive_labels = ["interactive_{}".format(n) for n in range(5)]
+            interactive_jobs = [
+                job_queue.submit(
+                    endpoint, label, {"huc": label}, priority="interactive"
+                )
+                for label in interactive_labels
+            ]
+            for queued_job, label in zip(
+                background_jobs + interactive_jobs,
+                background_labels + interactive_labels,
+            ):
+                problems.extend(check_queued_job(queued_job, label))
+        for future in direct_futures:
+            problems.extend(future.result())
+
+    last_background_start = max(
+        server.job_start_times.get(label, 0.0) for label in background_labels
+    )
+    for label in interactive_labels:
+        if server.job_start_times.get(label, float("inf")) > last_background_start:
+            problems.append(
+                "{} started after the background jobs queued before it".format(label)
+            )
+    return problems
+
+
+def main() -> int:
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--threads", type=int, default=16)
+    arg_parser.add_argument("--jobs", type=int, default=200)
+    arg_parser.add_argument("--requests-per-minute", type=float, default=3000.0)
+    arg_parser.add_argument("--burst", type=int, default=8)
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    server = MockServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    mmw_api = ModelMyWatershedAPI(
+        "not-a-real-key",
+        hosts=[{"mmw_host": server.host}],
+        rate_limiter=CountingRateLimiter(
+            args.requests_per_minute, burst=args.burst, reserved=1
+        ),
+    )
+    # the mock server finishes jobs at once
+    mmw_api.first_poll_seconds = 0.0
+    if not mmw_api.login("user", "password"):
+        print("FAIL: couldn't log in to the mock server")
+        return 1
+    logged_in_time = time.monotonic()
+
+    problems = []
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        futures = []
+        for task_number in range(args.jobs):
+            if task_number == args.jobs // 2:
+                # log in again while the jobs are running
+                login_future = executor.submit(mmw_api.login, "user", "password")
+            futures.append(executor.submit(run_task, mmw_api, task_number))
+        for future in futures:
+            problems.extend(future.result())
+        if not login_future.result():
+            problems.append("logging in again failed")
+    problems.extend(run_queue(mmw_api, server, args))
+    elapsed_seconds = time.perf_counter() - start_time
+
+    n_checked = 0
+    for request_time, method, path, headers in server.requests:
+        if path.startswith("/user/login") or request_time < logged_in_time:
+            continue
+        n_checked += 1
+        for header, value in expected_headers(mmw_api, path).items():
+            # requests without a body have no content type
+            if header == "Content-Type" and method == "GET":
+                continue
+            if headers.get(header) != value:
+                problems.append(
+                    "{} {}: {} was {!r} instead of {!r}".format(
+                        method, path, header, headers.get(header), value
+                    )
+                )
+
+    # the job starts in any stretch of time are limited to the burst plus what
+    # refilled during it
+    start_times = sorted(
+        request_time
+        for request_time, method, path, _ in server.requests
+        if method == "POST" and "/jobs/" not in path and "/projects/" not in path
+        if not path.startswith("/user/login")
+    )
+    rate_per_second = args.requests_per_minute / 60
+    for first, last in itertools.combinations(range(len(start_times)), 2):
+        allowed = (
+            args.burst + (start_times[last] - start_times[first]) * rate_per_second
+        )
+        if last - first + 1 > allowed + 1:
+            problems.append(
+                "{} jobs started in {:.3f}s, over the rate limit".format(
+                    last - first + 1, start_times[last] - start_times[first]
+                )
+            )
+            break
+    if mmw_api.rate_limiter.n_taken != len(start_times):
+        problems.append(
+            "{} rate limiter tokens were taken for {} job starts".format(
+                mmw_api.rate_limiter.n_taken, len(start_times)
+            )
+        )
+
+    print(
+        "{} tasks and 45 queued jobs on {} threads: {:.2f} s, {} requests checked, "
+        "{} job starts".format(
+            args.jobs + args.jobs // 2,
+            args.threads,
+            elapsed_seconds,
+            n_checked,
+            len(start_times),
+        )
+    )
+    for problem in problems[:20]:
+        print("FAIL: {}".format(problem))
+    if len(problems) > 20:
+        print("... and {} more".format(len(problems) - 20))
+    server.shutdown()
+    return 1 if len(problems) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,47 @@ from .model_client import (
     ModemMyWatershedLayerOverride,
     ModelMyWatershedAPI,
 )
+from .aoi import ModelMyWatershedAOI
+from .cache import ModelMyWatershedResultCache
+from .cache_policy import ModelMyWatershedCachePolicies, ModelMyWatershedCachePolicy
+from .circuit_breaker import (
+    ModelMyWatershedCircuitBreaker,
+    ModelMyWatershedCircuitState,
+    ModelMyWatershedHostHealth,
+)
+from .comparison import ModelMyWatershedGWLFEComparison
+from .cost_model import ModelMyWatershedCostModel
+from .dump_index import ModelMyWatershedDumpIndex
+from .hosts import ModelMyWatershedHost, ModelMyWatershedHostRouter
+from .ingest import ModelMyWatershedDumpIngester
+from .job_record import ModelMyWatershedJobRecord, ModelMyWatershedJobState
+from .job_queue import ModelMyWatershedJobQueue, ModelMyWatershedQueuedJob
+from .modifications import ModelMyWatershedModificationSet
+from .payload import ModelMyWatershedPayloadTemplate
+from .planner import (
+    ModelMyWatershedPlannedJob,
+    ModelMyWatershedRunPlan,
+    ModelMyWatershedRunPlanner,
+)
+from .project_pool import ModelMyWatershedProjectPool
+from .rate_limiter import ModelMyWatershedRateLimiter
+from .reclassification import ModelMyWatershedLandCoverReclassifier
+from .scenarios import (
+    ModelMyWatershedScenarioJob,
+    ModelMyWatershedScenarioMatrix,
+)
+from .sharding import (
+    ModelMyWatershedShardedExecutor,
+    ModelMyWatershedWorker,
+)
+from .subbasins import (
+    ModelMyWatershedSubbasinCache,
+    ModelMyWatershedSubbasinGeometry,
+)
+from .weather import (
+    ModelMyWatershedWeatherData,
+    ModelMyWatershedWeatherService,
+)
 
 
 #%%
@@ -0,0 +1,403 @@
+"""
+Parsing, validation and canonical serialization of areas of interest (AOIs).
+"""
+#%%
+import hashlib
+import json
+import math
+import logging
+from typing import Dict, List, Tuple, Union
+
+module_logger = logging.getLogger(__name__)
+
+# A single [lon, lat] position, a closed ring of positions, and a polygon of rings
+Position = List[float]
+Ring = List[Position]
+Polygon = List[Ring]
+
+# km per degree of latitude, for the approximate geometry areas
+_KM_PER_DEGREE = 111.32
+
+
+#%%
+class ModelMyWatershedAOI:
+    """An area of interest for ModelMyWatershed analysis and modeling requests.
+
+    An AOI can be given as a HUC code (HUC8, HUC10 or HUC12), a well-known area of
+    interest (WKAoI) identifier from ModelMW's hidden table, or a GeoJSON shape.  The
+    AOI is parsed once when it is created: the kind of AOI is determined, GeoJSON
+    features and polygons are unwrapped to the MultiPolygon ModelMW expects, and the
+    canonical JSON, hash and geometry summary are computed and kept for re-use.
+    """
+
+    __slots__ = (
+        "kind",
+        "value",
+        "job_label",
+        "properties",
+        "_json_bytes",
+        "_hash",
+        "_summary",
+    )
+
+    def __init__(
+        self,
+        aoi: Union[str, Dict],
+        job_label: Union[str, None] = None,
+        run_number: int = 1,
+    ):
+        """Parses an area of interest
+
+        Args:
+            aoi (Union[str, Dict]): The area of interest.  A string with double
+                underscores is taken as a WKAoI, a string of 8, 10 or 12 digits is
+                taken as a HUC code, and a dictionary is taken as GeoJSON.
+            job_label (Union[str, None], optional): The label to use for jobs on this
+                area. Defaults to the AOI string, the "name" property of a GeoJSON
+                feature, or "shape_{run_number}".
+            run_number (int, optional): The position of the AOI in a batch, used for
+                the default label of unnamed shapes. Defaults to 1.
+
+        Raises:
+            ValueError: If the AOI is a string that is neither a HUC nor a WKAoI, or a
+                dictionary that isn't GeoJSON
+        """
+        self.properties: Dict = {}
+        self._json_bytes: Union[bytes, None] = None
+        self._hash: Union[str, None] = None
+        self._summary: Union[Dict, None] = None
+
+        # if it's a string with underscores, we're assuming it's a WKAoI from the hidden well-known area of interest table
+        # this is not expected, but we'll support it
+        if isinstance(aoi, str) and "__" in aoi:
+            self.kind = "wkaoi"
+            self.value = aoi
+        # if it doesn't have underscores, it must be a HUC
+        elif isinstance(aoi, str):
+            if not (aoi.isdigit() and len(aoi) in [8, 10, 12]):
+                raise ValueError(
+                    "'{}' is neither a WKAoI nor an 8, 10 or 12 digit HUC code".format(
+                        aoi
+                    )
+                )
+            self.kind = "huc"
+            self.value = aoi
+        elif isinstance(aoi, Dict) and "type" in aoi.keys():
+            self.kind = "geojson"
+            try:
+                self.value = self._to_multipolygon(aoi)
+            except (KeyError, TypeError, IndexError) as ex:
+                raise ValueError("The GeoJSON has no geometry: {}".format(ex))
+            feature = aoi["features"][0] if aoi["type"] == "FeatureCollection" else aoi
+            self.properties = feature.get("properties") or {}
+        else:
+            raise ValueError("The area of interest is not a string or a GeoJSON")
+
+        if job_label is not None:
+            self.job_label = job_label
+        elif self.kind != "geojson":
+            self.job_label = self.value
+        elif "name" in self.properties.keys():
+            self.job_label = str(self.properties["name"])
+        else:
+            self.job_label = "shape_{}".format(run_number)
+
+    @classmethod
+    def from_any(
+        cls, aoi: Union[str, Dict, "ModelMyWatershedAOI"], run_number: int = 1
+    ) -> "ModelMyWatershedAOI":
+        """Returns the input if it is already parsed, or parses it if not"""
+        if isinstance(aoi, cls):
+            return aoi
+        return cls(aoi, run_number=run_number)
+
+    @classmethod
+    def from_kwargs(
+        cls,
+        area_of_interest: Union[Dict, None] = None,
+        wkaoi: Union[str, None] = None,
+        huc: Union[str, None] = None,
+    ) -> Union["ModelMyWatershedAOI", None]:
+        """Parses an AOI given the way `create_project` takes it, with the geojson
+        taking precedence over the HUC and the HUC over the WKAoI.
+
+        Returns:
+            Union[ModelMyWatershedAOI, None]: The AOI, or None if none was given
+        """
+        if area_of_interest is not None:
+            return cls(area_of_interest)
+        elif huc is not None and huc != "":
+            return cls(huc)
+        elif wkaoi is not None and wkaoi != "":
+            return cls(wkaoi)
+        return None
+
+    @staticmethod
+    def _to_multipolygon(geojson: Dict) -> Dict:
+        """Unwraps features and converts polygons into a MultiPolygon geometry"""
+        if geojson["type"] == "FeatureCollection":
+            if len(geojson.get("features", [])) != 1:
+                raise ValueError("A feature collection AOI must have exactly 1 feature")
+            geojson = geojson["features"][0]
+        if geojson["type"] == "Feature":
+            geojson = geojson["geometry"]
+        if geojson["type"] == "Polygon":
+            return {"type": "MultiPolygon", "coordinates": [geojson["coordinates"]]}
+        return {"type": geojson["type"], "coordinates": geojson.get("coordinates")}
+
+    def __repr__(self) -> str:
+        return "ModelMyWatershedAOI({}: {})".format(self.kind, self.job_label)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, ModelMyWatershedAOI) and self.hash == other.hash
+
+    def __hash__(self) -> int:
+        return hash(self.hash)
+
+    @property
+    def payload_key(self) -> str:
+        """The key the AOI goes under in a modeling or project payload"""
+        return "area_of_interest" if self.kind == "geojson" else self.kind
+
+    @property
+    def key(self) -> str:
+        """A short string key for the AOI, ie "huc:020402050301" """
+        if self.kind == "geojson":
+            return "geojson:{}".format(self.hash)
+        return "{}:{}".format(self.kind, self.value)
+
+    @property
+    def json_bytes(self) -> bytes:
+        """The canonical (sorted, compact) JSON of the AOI's value, serialized once"""
+        if self._json_bytes is None:
+            self._json_bytes = json.dumps(
+                self.value, sort_keys=True, separators=(",", ":")
+            ).encode("utf-8")
+        return self._json_bytes
+
+    @property
+    def hash(self) -> str:
+        """A stable SHA-256 hash of the kind and canonical JSON of the AOI"""
+        if self._hash is None:
+            self._hash = hashlib.sha256(
+                self.kind.encode("utf-8") + b":" + self.json_bytes
+            ).hexdigest()
+        return self._hash
+
+    def analysis_payload(self) -> Dict:
+        """The payload for an analysis request on this AOI"""
+        if self.kind == "geojson":
+            return self.value
+        return {self.kind: self.value}
+
+    def analysis_payload_json(self) -> bytes:
+        """The serialized payload for an analysis request on this AOI"""
+        if self.kind == "geojson":
+            return self.json_bytes
+        return b'{"' + self.kind.encode("utf-8") + b'":' + self.json_bytes + b"}"
+
+    def project_kwargs(self) -> Dict:
+        """The keyword arguments for `create_project` for this AOI"""
+        return {self.payload_key: self.value}
+
+    def size_class(self) -> str:
+        """A coarse size class for the AOI: the HUC level, "wkaoi" or "geojson" """
+        if self.kind == "huc":
+            return "huc{}".format(len(self.value))
+        return self.kind
+
+    def summary(self) -> Dict:
+        """Summarizes the geometry of a GeoJSON AOI; the summary is computed once.
+
+        Returns:
+            Dict: The number of polygons, rings and vertices, the bounding box
+                (min lon, min lat, max lon, max lat) and an approximate area in km²
+        """
+        if self._summary is not None:
+            return self._summary
+        summary = {
+            "kind": self.kind,
+            "size_class": self.size_class(),
+            "n_polygons": 0,
+            "n_rings": 0,
+            "n_vertices": 0,
+            "bbox": None,
+            "area_km2": None,
+        }
+        if self.kind == "geojson" and isinstance(self.value["coordinates"], list):
+            min_x = min_y = math.inf
+            max_x = max_y = -math.inf
+            area_km2 = 0.0
+            for polygon in self.value["coordinates"]:
+                summary["n_polygons"] += 1
+                for ring_number, ring in enumerate(polygon):
+                    summary["n_rings"] += 1
+                    summary["n_vertices"] += len(ring)
+                    for lon, lat, *_ in ring:
+                        min_x, max_x = min(min_x, lon), max(max_x, lon)
+                        min_y, max_y = min(min_y, lat), max(max_y, lat)
+                    # holes are subtracted from the outer ring
+                    ring_area = _ring_area_km2(ring)
+                    area_km2 += ring_area if ring_number == 0 else -ring_area
+            if summary["n_vertices"] > 0:
+                summary["bbox"] = (min_x, min_y, max_x, max_y)
+                summary["area_km2"] = area_km2
+        self._summary = summary
+        return summary
+
+    def validate(self, single_ring: bool = True) -> None:
+        """Checks that a GeoJSON AOI is a valid MultiPolygon, as ModelMW requires,
+        without needing a geospatial library.  HUC and WKAoI AOIs are always valid.
+
+        Args:
+            single_ring (bool, optional): Require each polygon to have a single ring,
+                ie, no holes. Defaults to True.
+
+        Raises:
+            ValueError: With a description of the first problem found
+        """
+        if self.kind != "geojson":
+            return
+        if self.value["type"] != "MultiPolygon":
+            raise ValueError(
+                "{}: expected a MultiPolygon, got a {}".format(
+                    self.job_label, self.value["type"]
+                )
+            )
+        polygons = self.value["coordinates"]
+        if not isinstance(polygons, list) or len(polygons) == 0:
+            raise ValueError(
+                "{}: the MultiPolygon has no polygons".format(self.job_label)
+            )
+        for polygon_number, polygon in enumerate(polygons):
+            where = "{} polygon {}".format(self.job_label, polygon_number)
+            if not isinstance(polygon, list) or len(polygon) == 0:
+                raise ValueError("{}: the polygon has no rings".format(where))
+            if single_ring and len(polygon) != 1:
+                raise ValueError(
+                    "{}: expected a single ring, found {}".format(where, len(polygon))
+                )
+            for ring_number, ring in enumerate(polygon):
+                _validate_ring(ring, "{} ring {}".format(where, ring_number))
+
+    def _with_polygons(self, polygons: List[Polygon]) -> "ModelMyWatershedAOI":
+        new_aoi = ModelMyWatershedAOI(
+            {"type": "MultiPolygon", "coordinates": polygons}, job_label=self.job_label
+        )
+        new_aoi.properties = self.properties
+        return new_aoi
+
+    def quantize(self, decimals: int = 6) -> "ModelMyWatershedAOI":
+        """Rounds the coordinates of a GeoJSON AOI to shrink the payload, dropping any
+        repeated points the rounding creates.  Six decimals is about 10 cm.
+
+        Args:
+            decimals (int, optional): The number of decimal places to keep. Defaults to 6.
+
+        Returns:
+            ModelMyWatershedAOI: A new AOI with the rounded coordinates, or this AOI if
+                it isn't GeoJSON
+        """
+        if self.kind != "geojson":
+            return self
+        polygons = []
+        for polygon in self.value["coordinates"]:
+            rings = []
+            for ring in polygon:
+                rounded_ring = []
+                for position in ring:
+                    rounded = [round(coord, decimals) for coord in position]
+                    if len(rounded_ring) == 0 or rounded != rounded_ring[-1]:
+                        rounded_ring.append(rounded)
+                # keep the original if the ring collapses
+                rings.append(rounded_ring if len(rounded_ring) >= 4 else ring)
+            polygons.append(rings)
+        return self._with_polygons(polygons)
+
+    def simplify(self, tolerance: float) -> "ModelMyWatershedAOI":
+        """Simplifies the rings of a GeoJSON AOI with the Douglas-Peucker algorithm to
+        shrink the payload.
+
+        Args:
+            tolerance (float): The largest distance, in degrees, a removed point may be
+                from the simplified ring
+
+        Returns:
+            ModelMyWatershedAOI: A new AOI with the simplified coordinates, or this AOI
+                if it isn't GeoJSON
+        """
+        if self.kind != "geojson":
+            return self
+        polygons = []
+        for polygon in self.value["coordinates"]:
+            rings = []
+            for ring in polygon:
+                simple_ring = _douglas_peucker(ring, tolerance)
+                rings.append(simple_ring if len(simple_ring) >= 4 else ring)
+            polygons.append(rings)
+        return self._with_polygons(polygons)
+
+
+def _validate_ring(ring: Ring, where: str) -> None:
+    if not isinstance(ring, list) or len(ring) < 4:
+        raise ValueError("{}: a ring needs at least 4 positions".format(where))
+    for position in ring:
+        if (
+            not isinstance(position, list)
+            or len(position) not in [2, 3]
+            or not all(
+                isinstance(coord, (int, float))
+                and not isinstance(coord, bool)
+                and math.isfinite(coord)
+                for coord in position
+            )
+        ):
+            raise ValueError("{}: {} is not a valid position".format(where, position))
+        if not (-180 <= position[0] <= 180 and -90 <= position[1] <= 90):
+            raise ValueError(
+                "{}: {} is not a longitude/latitude".format(where, position)
+            )
+    if ring[0] != ring[-1]:
+        raise ValueError("{}: the ring is not closed".format(where))
+
+
+def _ring_area_km2(ring: Ring) -> float:
+    """The approximate area of a ring with the shoelace formula on an equirectangular
+    projection - good enough for sizing requests, not for analysis."""
+    if len(ring) < 3:
+        return 0.0
+    mean_lat = sum(position[1] for position in ring) / len(ring)
+    x_scale = _KM_PER_DEGREE * math.cos(math.radians(mean_lat))
+    twice_area = 0.0
+    for (x1, y1, *_), (x2, y2, *_) in zip(ring, ring[1:] + ring[:1]):
+        twice_area += x1 * y2 - x2 * y1
+    return abs(twice_area) / 2 * x_scale * _KM_PER_DEGREE
+
+
+def _douglas_peucker(points: Ring, tolerance: float) -> Ring:
+    """Simplifies a line with the Douglas-Peucker algorithm, always keeping the end
+    points, so closed rings stay closed."""
+    if len(points) < 3:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack: List[Tuple[int, int]] = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = points[first][:2], points[last][:2]
+        dx, dy = x2 - x1, y2 - y1
+        seg_len = math.hypot(dx, dy)
+        max_dist, max_index = -1.0, first
+        for index in range(first + 1, last):
+            px, py = points[index][:2]
+            if seg_len == 0:
+                dist = math.hypot(px - x1, py - y1)
+            else:
+                dist = abs(dy * px - dx * py + x2 * y1 - y2 * x1) / seg_len
+            if dist > max_dist:
+                max_dist, max_index = dist, index
+        if max_dist > tolerance:
+            keep[max_index] = True
+            stack.append((first, max_index))
+            stack.append((max_index, last))
+    return [point for point, kept in zip(points, keep) if kept]
@@ -0,0 +1,245 @@
+"""
+A cache of ModelMyWatershed job results keyed by a hash of the job inputs.
+"""
+#%%
+import hashlib
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Union
+
+from .cache_policy import ModelMyWatershedCachePolicies
+from .dump_index import ModelMyWatershedDumpIndex
+
+module_logger = logging.getLogger(__name__)
+
+
+#%%
+class ModelMyWatershedResultCache:
+    """Keeps job results keyed by a hash of the request endpoint and the serialized
+    payload, so the same inputs are never run twice.
+
+    Results are kept in memory and, if a cache path is given, also written to one
+    json file per key so they survive between sessions.  The files on disk are looked
+    up in an index of the cache directory, so a miss doesn't check the file system.
+
+    Each result is kept with its endpoint, the time it was cached and the version of
+    its data layer, and is treated as missing once it has expired under the cache's
+    policies.  Results cached before this was kept never expire, until they are
+    invalidated.
+    """
+
+    cache_logger = module_logger.getChild(__qualname__)
+
+    def __init__(
+        self,
+        cache_path: Union[str, None] = None,
+        keep_in_memory: bool = True,
+        policies: Union[ModelMyWatershedCachePolicies, None] = None,
+    ):
+        """Create a new result cache
+
+        Args:
+            cache_path (Union[str, None], optional): The directory to save results in.
+                Defaults to None, for a cache that is only in memory.
+            keep_in_memory (bool, optional): Keep results in memory as well as on disk.
+                Defaults to True.
+            policies (Union[ModelMyWatershedCachePolicies, None], optional): The
+                expiration policies for the results. Defaults to None, for results
+                that never expire.
+        """
+        self.cache_path = cache_path
+        self.keep_in_memory = keep_in_memory or cache_path is None
+        self.policies = (
+            policies if policies is not None else ModelMyWatershedCachePolicies()
+        )
+        self._results: Dict[str, Dict] = {}
+        # the endpoint, time cached and layer version of the results in memory
+        self._metadata: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._index = (
+            ModelMyWatershedDumpIndex(cache_path, "cache_index.jsonl")
+            if cache_path is not None
+            else None
+        )
+
+    @staticmethod
+    def make_key(request_endpoint: str, payload: Union[bytes, str, Dict, None]) -> str:
+        """Creates the cache key for a job
+
+        Args:
+            request_endpoint (str): The endpoint for the request
+            payload (Union[bytes, str, Dict, None]): The payload of the request, either
+                serialized or as a JSON serializable dictionary
+
+        Returns:
+            str: The SHA-256 hash of the endpoint and payload
+        """
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif not isinstance(payload, bytes):
+            payload = json.dumps(payload, sort_keys=True, separators=(",", ":")).encode(
+                "utf-8"
+            )
+        return hashlib.sha256(
+            request_endpoint.encode("utf-8") + b"\n" + payload
+        ).hexdigest()
+
+    def _get_filename(self, key: str) -> Path:
+        return Path(self.cache_path) / "{}.json".format(key)
+
+    def get(self, key: str) -> Union[Dict, None]:
+        """Gets a cached result
+
+        Args:
+            key (str): The cache key from `make_key`
+
+        Returns:
+            Union[Dict, None]: The result, or None if it isn't cached
+        """
+        with self._lock:
+            if key in self._results:
+                if not self.policies.is_expired(self._metadata.get(key)):
+                    return self._results[key]
+                # another process may have cached a newer result
+                self._results.pop(key)
+                self._metadata.pop(key, None)
+        if self.cache_path is None or self._get_filename(key) not in self._index:
+            return None
+        if self.policies.is_expired(self._index.get_metadata(self._get_filename(key))):
+            self.cache_logger.debug("\tThe cached result for {} expired".format(key))
+            return None
+        try:
+            with open(self._get_filename(key)) as fp:
+                cached = json.load(fp)
+            result = cached["result"]
+        except FileNotFoundError:
+            return None
+        except (json.JSONDecodeError, KeyError):
+            self.cache_logger.warn(
+                "\tIgnoring unreadable cache file for {}".format(key)
+            )
+            return None
+        # the index may have been rebuilt without the metadata
+        metadata = cached.get("metadata")
+        if self.policies.is_expired(metadata):
+            return None
+        if self.keep_in_memory:
+            with self._lock:
+                self._results[key] = result
+                if metadata is not None:
+                    self._metadata[key] = metadata
+        return result
+
+    def put(
+        self,
+        key: str,
+        result: Dict,
+        request_endpoint: str = "",
+        made_at: Union[float, None] = None,
+    ) -> None:
+        """Adds a result to the cache
+
+        Args:
+            key (str): The cache key from `make_key`
+            result (Dict): The job result
+            request_endpoint (str, optional): The endpoint of the request, saved with
+                the result, and for its expiration policy. Defaults to "".
+            made_at (Union[float, None], optional): The time the result was made, ie,
+                when its job was started, to expire it from. Defaults to None, for now.
+        """
+        metadata = self.policies.make_metadata(request_endpoint, made_at)
+        if self.keep_in_memory:
+            with self._lock:
+                self._results[key] = result
+                self._metadata[key] = metadata
+        if self.cache_path is None:
+            return
+        # written to a temporary file and renamed, so a crash can't leave a partial file
+        self._index.write(
+            self._get_filename(key),
+            json.dumps(
+                {
+                    "request_endpoint": request_endpoint,
+                    "metadata": metadata,
+                    "result": result,
+                }
+            ).encode("utf-8"),
+            metadata,
+        )
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            if key in self._results and not self.policies.is_expired(
+                self._metadata.get(key)
+            ):
+                return True
+        return (
+            self.cache_path is not None
+            and self._get_filename(key) in self._index
+            and not self.policies.is_expired(
+                self._index.get_metadata(self._get_filename(key))
+            )
+        )
+
+    def invalidate(
+        self,
+        request_endpoint: Union[str, None] = None,
+        expired_only: bool = False,
+        cached_before: Union[float, None] = None,
+    ) -> int:
+        """Removes cached results in bulk, from memory and from disk
+
+        Args:
+            request_endpoint (Union[str, None], optional): Only remove the results for
+                this endpoint, or endpoints starting with it, ie, "api/analyze/land/".
+                Defaults to None, for any endpoint.
+            expired_only (bool, optional): Only remove results that have expired, ie,
+                after a layer version changed. Defaults to False.
+            cached_before (Union[float, None], optional): Only remove results cached
+                before this time, in seconds since the epoch. Defaults to None.
+
+        Returns:
+            int: The number of results removed
+        """
+        now = time.time()
+
+        def is_invalid(metadata: Union[Dict[str, Any], None]) -> bool:
+            # the endpoint of results cached without metadata isn't known
+            if request_endpoint is not None and (
+                metadata is None
+                or not metadata["e"]
+                .lstrip("/")
+                .startswith(request_endpoint.lstrip("/"))
+            ):
+                return False
+            if expired_only and not self.policies.is_expired(metadata, now):
+                return False
+            if cached_before is not None and (
+                metadata is not None and metadata["t"] >= cached_before
+            ):
+                return False
+            return True
+
+        invalid_keys: List[str] = []
+        with self._lock:
+            for key in list(self._results.keys()):
+                if is_invalid(self._metadata.get(key)):
+                    self._results.pop(key)
+                    self._metadata.pop(key, None)
+                    invalid_keys.append(key)
+        if self.cache_path is not None:
+            for filename in self._index.list_files():
+                if is_invalid(self._index.get_metadata(filename)):
+                    self._index.remove(filename)
+                    invalid_keys.append(Path(filename).stem)
+        n_invalid = len(set(invalid_keys))
+        self.cache_logger.info("\tInvalidated {} cached results".format(n_invalid))
+        return n_invalid
+
+    def clear(self) -> None:
+        """Forgets the results held in memory; results on disk are kept"""
+        with self._lock:
+            self._results.clear()
@@ -0,0 +1,187 @@
+"""
+Expiration policies for cached ModelMyWatershed results, by request endpoint.
+"""
+#%%
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Union
+
+module_logger = logging.getLogger(__name__)
+
+
+#%%
+class ModelMyWatershedCachePolicy:
+    """How long the cached results of the requests to an endpoint stay valid.
+
+    A result can expire a fixed time after it was cached (ie, MapShed job ids, which
+    the server forgets after about an hour), when the version of the data layer it was
+    made from changes (ie, land analyses for a land use layer), or never (ie, geometry
+    and model runs, which only depend on their inputs).
+    """
+
+    __slots__ = ("request_endpoint", "max_age_seconds", "layer_versioned")
+
+    def __init__(
+        self,
+        request_endpoint: str,
+        max_age_seconds: Union[float, None] = None,
+        layer_versioned: bool = False,
+    ):
+        """Create a policy
+
+        Args:
+            request_endpoint (str): The endpoint, or the start of the endpoints, the
+                policy is for, ie, "api/analyze/land/" for the land analysis of every
+                layer
+            max_age_seconds (Union[float, None], optional): How long after it was
+                cached a result expires. Defaults to None, for no time limit.
+            layer_versioned (bool, optional): Expire results when the version of their
+                data layer changes.  The layer is the part of the endpoint after
+                `request_endpoint`, ie, "2019_2019". Defaults to False.
+        """
+        self.request_endpoint = request_endpoint.lstrip("/")
+        self.max_age_seconds = max_age_seconds
+        self.layer_versioned = layer_versioned
+
+    def __repr__(self) -> str:
+        return "ModelMyWatershedCachePolicy({}, max_age_seconds={}, layer_versioned={})".format(
+            self.request_endpoint, self.max_age_seconds, self.layer_versioned
+        )
+
+    def get_layer_key(self, request_endpoint: str) -> Union[str, None]:
+        """Gets the data layer of a request from its endpoint, ie, "2019_2019" from
+        "api/analyze/land/2019_2019/", or None for policies without layers"""
+        if not self.layer_versioned:
+            return None
+        layer_path = request_endpoint.lstrip("/")[len(self.request_endpoint) :]
+        return layer_path.strip("/").split("/")[0] or None
+
+
+class ModelMyWatershedCachePolicies:
+    """The expiration policies of a result cache and job ledger, and the current version
+    of each data layer.
+
+    The policy for a request is the one for the longest matching start of its endpoint;
+    results for endpoints without a policy never expire.  Each cached result keeps the
+    time it was cached and the version of its data layer, and is treated as missing once
+    it has expired.  Changing a layer version with `set_layer_version` expires every
+    result made from the old version at once.
+    """
+
+    policies_logger = module_logger.getChild(__qualname__)
+
+    def __init__(
+        self,
+        policies: Union[List[ModelMyWatershedCachePolicy], None] = None,
+        layer_versions: Union[Dict[str, str], None] = None,
+    ):
+        """Create a set of policies
+
+        Args:
+            policies (Union[List[ModelMyWatershedCachePolicy], None], optional): The
+                policies. Defaults to None, for results that never expire.
+            layer_versions (Union[Dict[str, str], None], optional): The current
+                version of each data layer, by the layer key in the endpoint, ie,
+                {"2019_2019": "nlcd-2019-30m-epsg5070-512-byte"}. Defaults to None.
+        """
+        # longest endpoints first, so the most specific policy is found first
+        self.policies: List[ModelMyWatershedCachePolicy] = sorted(
+            policies if policies is not None else [],
+            key=lambda policy: -len(policy.request_endpoint),
+        )
+        self.layer_versions: Dict[str, str] = (
+            dict(layer_versions) if layer_versions is not None else {}
+        )
+        self._lock = threading.Lock()
+
+    def get_policy(
+        self, request_endpoint: str
+    ) -> Union[ModelMyWatershedCachePolicy, None]:
+        """Gets the policy for an endpoint, or None if its results never expire"""
+        request_endpoint = request_endpoint.lstrip("/")
+        for policy in self.policies:
+            if request_endpoint.startswith(policy.request_endpoint):
+                return policy
+        return None
+
+    def set_layer_version(self, layer_key: str, layer_version: str) -> None:
+        """Sets the current version of a data layer, expiring the cached results made
+        from any other version of it
+
+        Args:
+            layer_key (str): The layer key in the endpoint, ie, "2019_2019"
+            layer_version (str): The version, ie, the layer's name on the server or the
+                date it was last updated
+        """
+        with self._lock:
+            if self.layer_versions.get(layer_key) != layer_version:
+                self.policies_logger.info(
+                    "\tResults for layer {} from before version {} have expired".format(
+                        layer_key, layer_version
+                    )
+                )
+            self.layer_versions[layer_key] = layer_version
+
+    def get_layer_version(self, request_endpoint: str) -> Union[str, None]:
+        """Gets the current version of the data layer of a request, or None if its
+        results aren't versioned by layer"""
+        policy = self.get_policy(request_endpoint)
+        if policy is None:
+            return None
+        layer_key = policy.get_layer_key(request_endpoint)
+        if layer_key is None:
+            return None
+        with self._lock:
+            return self.layer_versions.get(layer_key, layer_key)
+
+    def make_metadata(
+        self, request_endpoint: str, made_at: Union[float, None] = None
+    ) -> Dict[str, Any]:
+        """Creates the metadata to keep with a result as it is cached
+
+        Args:
+            request_endpoint (str): The endpoint of the request
+            made_at (Union[float, None], optional): The time the result was made, ie,
+                when its job was started, for results that expire a time after that.
+                Defaults to None, for now.
+
+        Returns:
+            Dict[str, Any]: The endpoint ("e"), the time it was made or cached ("t")
+                and, for results versioned by layer, the layer version ("v")
+        """
+        metadata = {
+            "e": request_endpoint,
+            "t": round(time.time() if made_at is None else made_at, 3),
+        }
+        layer_version = self.get_layer_version(request_endpoint)
+        if layer_version is not None:
+            metadata["v"] = layer_version
+        return metadata
+
+    def is_expired(
+        self, metadata: Union[Dict[str, Any], None], now: Union[float, None] = None
+    ) -> bool:
+        """Checks whether a cached result has expired
+
+        Args:
+            metadata (Union[Dict[str, Any], None]): The metadata kept with the result,
+                from `make_metadata`.  Results cached without metadata never expire.
+            now (Union[float, None], optional): The time to check at. Defaults to None,
+                for now.
+
+        Returns:
+            bool: True if the result has expired
+        """
+        if metadata is None:
+            return False
+        policy = self.get_policy(metadata.get("e", ""))
+        if policy is None:
+            return False
+        if policy.max_age_seconds is not None:
+            now = time.time() if now is None else now
+            if now - metadata.get("t", 0.0) > policy.max_age_seconds:
+                return True
+        if policy.layer_versioned and "v" in metadata:
+            return metadata["v"] != self.get_layer_version(metadata["e"])
+        return False
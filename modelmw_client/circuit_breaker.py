@@ -0,0 +1,309 @@
+"""
+Circuit breakers for ModelMyWatershed hosts, so requests fail fast while a host is down.
+"""
+#%%
+import enum
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Tuple, Union
+
+from urllib3.exceptions import MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
+
+module_logger = logging.getLogger(__name__)
+
+
+#%%
+class ModelMyWatershedCircuitState(enum.IntEnum):
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+
+class ModelMyWatershedCircuitBreaker:
+    """Tracks the failures of requests to one host and endpoint family.
+
+    - While CLOSED, every request is allowed.  After `failure_threshold` failures in a
+      row the circuit opens.
+    - While OPEN, requests are refused right away, without being sent.  After
+      `recovery_seconds` the circuit is half-open.
+    - While HALF_OPEN, up to `half_open_requests` requests at a time are let through to
+      probe the host.  A success closes the circuit; a failure opens it again for
+      another `recovery_seconds`.
+
+    A failure is a request that got no response (a timeout or connection error, or the
+    retries of the session ran out) or a server error (a status code of 500 or over).
+    Any other response, including a client error or throttling, is a success: the host
+    is up.
+    """
+
+    breaker_logger = module_logger.getChild(__qualname__)
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        recovery_seconds: float = 60.0,
+        half_open_requests: int = 1,
+    ):
+        """Create a new, closed circuit breaker
+
+        Args:
+            name (str): A name for the circuit, for logging and metrics
+            failure_threshold (int, optional): The number of failures in a row that
+                open the circuit. Defaults to 5.
+            recovery_seconds (float, optional): How long the circuit stays open before
+                it lets a probe through. Defaults to 60.
+            half_open_requests (int, optional): The number of probes allowed at once
+                while half-open. Defaults to 1.
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self.half_open_requests = half_open_requests
+        self._state = ModelMyWatershedCircuitState.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at: Union[float, None] = None
+        self._probes_in_flight = 0
+        self._lock = threading.Lock()
+        # counts for metrics
+        self._n_successes = 0
+        self._n_failures = 0
+        self._n_refused = 0
+        self._n_opened = 0
+
+    def _set_state(self, new_state: ModelMyWatershedCircuitState) -> None:
+        """Changes the state of the circuit.  Call with the lock held."""
+        if new_state == self._state:
+            return
+        if new_state == ModelMyWatershedCircuitState.OPEN:
+            self._opened_at = time.monotonic()
+            self._n_opened += 1
+            self.breaker_logger.warn(
+                "\tCircuit for {} is open after {} failures; refusing requests for {}s".format(
+                    self.name, self._consecutive_failures, self.recovery_seconds
+                )
+            )
+        elif new_state == ModelMyWatershedCircuitState.CLOSED:
+            self.breaker_logger.info("\tCircuit for {} is closed".format(self.name))
+        self._state = new_state
+
+    @property
+    def state(self) -> ModelMyWatershedCircuitState:
+        with self._lock:
+            if (
+                self._state == ModelMyWatershedCircuitState.OPEN
+                and time.monotonic() - self._opened_at >= self.recovery_seconds
+            ):
+                self._set_state(ModelMyWatershedCircuitState.HALF_OPEN)
+            return self._state
+
+    def seconds_until_retry(self) -> float:
+        """The number of seconds until an open circuit lets a probe through, or 0 if a
+        request can be tried now"""
+        with self._lock:
+            if self._state != ModelMyWatershedCircuitState.OPEN:
+                return 0.0
+            return max(
+                0.0, self.recovery_seconds - (time.monotonic() - self._opened_at)
+            )
+
+    def allow_request(self) -> bool:
+        """Checks if a request may be sent.  Every allowed request must be followed by
+        a call to `record_success` or `record_failure`.
+
+        Returns:
+            bool: True if the request can be sent, False if it should fail fast
+        """
+        state = self.state
+        with self._lock:
+            if state == ModelMyWatershedCircuitState.CLOSED:
+                return True
+            if (
+                state == ModelMyWatershedCircuitState.HALF_OPEN
+                and self._probes_in_flight < self.half_open_requests
+            ):
+                self._probes_in_flight += 1
+                return True
+            self._n_refused += 1
+            return False
+
+    def record_success(self) -> None:
+        """Records a request that got a response from the host"""
+        with self._lock:
+            self._n_successes += 1
+            self._consecutive_failures = 0
+            if self._state == ModelMyWatershedCircuitState.HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+            self._set_state(ModelMyWatershedCircuitState.CLOSED)
+
+    def record_failure(self) -> None:
+        """Records a request that got no response, or a server error"""
+        with self._lock:
+            self._n_failures += 1
+            self._consecutive_failures += 1
+            if self._state == ModelMyWatershedCircuitState.HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                # the probe failed; wait another full recovery period
+                self._set_state(ModelMyWatershedCircuitState.OPEN)
+            elif self._consecutive_failures >= self.failure_threshold:
+                self._set_state(ModelMyWatershedCircuitState.OPEN)
+
+    def metrics(self) -> Dict[str, Any]:
+        """The state of the circuit and its request counts
+
+        Returns:
+            Dict[str, Any]: The "state", the "consecutive_failures", the total
+                "successes", "failures" and "refused" requests, the number of times the
+                circuit has "opened" and the "seconds_until_retry"
+        """
+        state = self.state
+        seconds_until_retry = self.seconds_until_retry()
+        with self._lock:
+            return {
+                "state": state.name,
+                "consecutive_failures": self._consecutive_failures,
+                "successes": self._n_successes,
+                "failures": self._n_failures,
+                "refused": self._n_refused,
+                "opened": self._n_opened,
+                "seconds_until_retry": round(seconds_until_retry, 3),
+            }
+
+    def __repr__(self) -> str:
+        return "ModelMyWatershedCircuitBreaker({}, {})".format(
+            self.name, self.state.name
+        )
+
+
+class ModelMyWatershedHostHealth:
+    """The circuit breakers for every host and endpoint family a client has used"""
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        recovery_seconds: float = 60.0,
+        half_open_requests: int = 1,
+    ):
+        """Create a new set of circuit breakers.  The arguments are used for every
+        breaker; see `ModelMyWatershedCircuitBreaker`.
+
+        Args:
+            failure_threshold (int, optional): The number of failures in a row that
+                open a circuit. Defaults to 5.
+            recovery_seconds (float, optional): How long a circuit stays open before it
+                lets a probe through. Defaults to 60.
+            half_open_requests (int, optional): The number of probes allowed at once
+                while half-open. Defaults to 1.
+        """
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self.half_open_requests = half_open_requests
+        self._breakers: Dict[Tuple[str, str], ModelMyWatershedCircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get_breaker(
+        self, host: str, endpoint_family: str
+    ) -> ModelMyWatershedCircuitBreaker:
+        """Gets the circuit breaker for a host and endpoint family, creating it if
+        needed
+
+        Args:
+            host (str): The host, ie, "modelmywatershed.org"
+            endpoint_family (str): The family of endpoints, ie, "analyze" or "jobs"
+
+        Returns:
+            ModelMyWatershedCircuitBreaker: The circuit breaker
+        """
+        with self._lock:
+            if (host, endpoint_family) not in self._breakers:
+                self._breakers[(host, endpoint_family)] = (
+                    ModelMyWatershedCircuitBreaker(
+                        "{} {}".format(host, endpoint_family),
+                        self.failure_threshold,
+                        self.recovery_seconds,
+                        self.half_open_requests,
+                    )
+                )
+            return self._breakers[(host, endpoint_family)]
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        """The metrics of every circuit breaker
+
+        Returns:
+            Dict[str, Dict[str, Any]]: The metrics from
+                `ModelMyWatershedCircuitBreaker.metrics`, by "<host> <endpoint family>"
+        """
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.name: breaker.metrics() for breaker in breakers}
+
+
+class ModelMyWatershedCircuitRetry(Retry):
+    """The retries of a session, recording every failed try with the circuit breaker
+    for its host and endpoint family, and giving up as soon as that circuit opens
+    instead of backing off through the rest of the retries."""
+
+    def __init__(
+        self,
+        *args,
+        get_breaker: Union[
+            Callable[[str], ModelMyWatershedCircuitBreaker], None
+        ] = None,
+        **kwargs
+    ):
+        """Create new retries
+
+        Args:
+            get_breaker (Union[Callable[[str], ModelMyWatershedCircuitBreaker], None], optional):
+                A function giving the circuit breaker for a url. Defaults to None, for
+                plain retries.
+            *args, **kwargs: The arguments for `urllib3.util.retry.Retry`
+        """
+        super().__init__(*args, **kwargs)
+        self.get_breaker = get_breaker
+
+    def new(self, **kw) -> "ModelMyWatershedCircuitRetry":
+        new_retry = super().new(**kw)
+        new_retry.get_breaker = self.get_breaker
+        return new_retry
+
+    def increment(
+        self,
+        method=None,
+        url=None,
+        response=None,
+        error=None,
+        _pool=None,
+        _stacktrace=None,
+    ) -> "ModelMyWatershedCircuitRetry":
+        if self.get_breaker is None or _pool is None:
+            return super().increment(method, url, response, error, _pool, _stacktrace)
+
+        default_port = 443 if _pool.scheme == "https" else 80
+        netloc = (
+            _pool.host
+            if _pool.port in [None, default_port]
+            else "{}:{}".format(_pool.host, _pool.port)
+        )
+        circuit_breaker = self.get_breaker(
+            "{}://{}{}".format(_pool.scheme, netloc, url)
+        )
+        # every try that goes through the retries is recorded here, including the
+        # last one, before it raises once the retries are used up; only the responses
+        # the session hands back are recorded by the client
+        if error is not None or (response is not None and response.status >= 500):
+            circuit_breaker.record_failure()
+        else:
+            # ie, throttling; the host is up
+            circuit_breaker.record_success()
+        new_retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        if circuit_breaker.state == ModelMyWatershedCircuitState.OPEN:
+            raise MaxRetryError(
+                _pool,
+                url,
+                error
+                or ResponseError("circuit for {} is open".format(circuit_breaker.name)),
+            )
+        return new_retry
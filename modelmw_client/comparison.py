@@ -0,0 +1,233 @@
+"""
+Vectorized comparison of GWLF-E results across scenarios, as dense arrays.
+"""
+#%%
+import logging
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple, Union
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+module_logger = logging.getLogger(__name__)
+
+# the columns of the normalized tables that label a row rather than measure something
+_LABEL_COLUMNS = [
+    "job_label",
+    "request_endpoint",
+    "dump_file",
+    "Land_Use_Source",
+    "land_use_layer",
+    "modification",
+    "precipitation",
+]
+
+
+#%%
+class ModelMyWatershedGWLFEComparison:
+    """Aligns the GWLF-E results of many AOIs and scenarios into dense arrays, and
+    computes the change from a baseline scenario for all of them at once.
+
+    Each of the "monthly", "SummaryLoads" and "Loads" results becomes one array of
+    shape (AOI x scenario x row x metric), where the rows are the months or the load
+    sources.  Results are put in place by their integer positions along each axis, so
+    there are no merges or pivots, and a missing job or row is left as NaN.
+    """
+
+    comparison_logger = module_logger.getChild(__qualname__)
+
+    # for each result: the normalized table it is in and the column of its rows
+    result_tables: Dict[str, Tuple[str, str]] = {
+        "monthly": ("gwlfe_monthly", "month"),
+        "SummaryLoads": ("gwlfe_load_summaries", "Source"),
+        "Loads": ("gwlfe_lu_loads", "Source"),
+    }
+
+    def __init__(
+        self,
+        tables: Dict[str, Union["pd.DataFrame", None]],
+        aoi_column: str = "job_label",
+        scenario_columns: Union[str, List[str]] = "Land_Use_Source",
+    ):
+        """Create a comparison from normalized GWLF-E tables
+
+        Args:
+            tables (Dict[str, Union[pd.DataFrame, None]]): The tables from
+                `normalize_gwlfe_results`, ie, from `run_batch_gwlfe`, a scenario
+                matrix or a dump ingest
+            aoi_column (str, optional): The column identifying the AOI.
+                Defaults to "job_label".
+            scenario_columns (Union[str, List[str]], optional): The column or columns
+                identifying the scenario, ie, ["land_use_layer", "modification"] for a
+                scenario matrix. Defaults to "Land_Use_Source".
+        """
+        import numpy as np
+        import pandas as pd
+
+        self.aoi_column = aoi_column
+        self.scenario_columns = (
+            [scenario_columns]
+            if isinstance(scenario_columns, str)
+            else list(scenario_columns)
+        )
+        present_tables = {
+            result_key: tables[table_name]
+            for result_key, (table_name, _) in self.result_tables.items()
+            if tables.get(table_name) is not None and len(tables[table_name]) > 0
+        }
+
+        # the AOIs and scenarios are shared by every array, in order of appearance
+        self.aois: pd.Index = pd.Index(
+            pd.unique(
+                np.concatenate(
+                    [
+                        table[aoi_column].to_numpy(dtype=object)
+                        for table in present_tables.values()
+                    ]
+                )
+                if len(present_tables) > 0
+                else np.array([], dtype=object)
+            )
+        )
+        scenario_indexes = [
+            self._get_scenario_index(table) for table in present_tables.values()
+        ]
+        self.scenarios: pd.Index = (
+            scenario_indexes[0].append(scenario_indexes[1:]).unique()
+            if len(scenario_indexes) > 0
+            else pd.Index([])
+        )
+
+        # the rows, metrics and values of each result
+        self.rows: Dict[str, pd.Index] = {}
+        self.metrics: Dict[str, List[str]] = {}
+        self.values: Dict[str, np.ndarray] = {}
+        for result_key, table in present_tables.items():
+            row_column = self.result_tables[result_key][1]
+            metric_columns = [
+                column
+                for column in table.columns
+                if column not in _LABEL_COLUMNS + self.scenario_columns
+                and column not in [aoi_column, row_column]
+                and pd.api.types.is_numeric_dtype(table[column])
+                and not pd.api.types.is_bool_dtype(table[column])
+            ]
+            row_codes, row_labels = pd.factorize(table[row_column], sort=True)
+            aoi_codes = self.aois.get_indexer(table[aoi_column])
+            scenario_codes = self.scenarios.get_indexer(self._get_scenario_index(table))
+
+            result_values = np.full(
+                (
+                    len(self.aois),
+                    len(self.scenarios),
+                    len(row_labels),
+                    len(metric_columns),
+                ),
+                np.nan,
+            )
+            # if a row appears more than once for a job, the last one is kept
+            result_values[aoi_codes, scenario_codes, row_codes, :] = table[
+                metric_columns
+            ].to_numpy(dtype=float, na_value=np.nan)
+            self.rows[result_key] = pd.Index(row_labels, name=row_column)
+            self.metrics[result_key] = metric_columns
+            self.values[result_key] = result_values
+
+    def _get_scenario_index(self, table: "pd.DataFrame") -> "pd.Index":
+        import pandas as pd
+
+        if len(self.scenario_columns) == 1:
+            return pd.Index(table[self.scenario_columns[0]])
+        return pd.MultiIndex.from_frame(table[self.scenario_columns])
+
+    def _get_baseline_position(self, baseline: Any) -> int:
+        try:
+            return self.scenarios.get_loc(baseline)
+        except KeyError:
+            raise ValueError(
+                "The baseline {} is not one of the scenarios: {}".format(
+                    baseline, list(self.scenarios)
+                )
+            )
+
+    def get_values(
+        self, result_key: str, metric: Union[str, None] = None
+    ) -> "np.ndarray":
+        """Gets the aligned values of one result
+
+        Args:
+            result_key (str): "monthly", "SummaryLoads" or "Loads"
+            metric (Union[str, None], optional): One metric, ie, "TotalN". Defaults to
+                None, for every metric.
+
+        Returns:
+            np.ndarray: The values, of shape (AOI x scenario x row x metric), or
+                (AOI x scenario x row) for one metric; the labels of each axis are in
+                `aois`, `scenarios`, `rows[result_key]` and `metrics[result_key]`
+        """
+        if metric is None:
+            return self.values[result_key]
+        return self.values[result_key][..., self.metrics[result_key].index(metric)]
+
+    def compare(
+        self, result_key: str, baseline: Any, metric: Union[str, None] = None
+    ) -> Dict[str, "np.ndarray"]:
+        """Compares every scenario of every AOI to a baseline scenario
+
+        Args:
+            result_key (str): "monthly", "SummaryLoads" or "Loads"
+            baseline (Any): The baseline scenario, ie, a land use source,
+                or a tuple of values for several scenario columns
+            metric (Union[str, None], optional): One metric, ie, "TotalN". Defaults to
+                None, for every metric.
+
+        Returns:
+            Dict[str, np.ndarray]: The "values", their "delta" from the baseline and
+                their "percent_change" from the baseline, each shaped like the values.
+                The percent change is NaN where the baseline is 0.
+        """
+        import numpy as np
+
+        values = self.get_values(result_key, metric)
+        baseline_values = values[:, [self._get_baseline_position(baseline)]]
+        delta = values - baseline_values
+        with np.errstate(divide="ignore", invalid="ignore"):
+            percent_change = np.where(
+                baseline_values != 0, 100.0 * delta / baseline_values, np.nan
+            )
+        return {"values": values, "delta": delta, "percent_change": percent_change}
+
+    def to_frame(self, result_key: str, baseline: Any) -> "pd.DataFrame":
+        """Flattens a comparison into a long table, with one row for each AOI,
+        scenario, row and metric that has a value
+
+        Args:
+            result_key (str): "monthly", "SummaryLoads" or "Loads"
+            baseline (Any): The baseline scenario
+
+        Returns:
+            pd.DataFrame: The AOI, scenario and row columns, "metric", "value", "delta"
+                and "percent_change"
+        """
+        import numpy as np
+        import pandas as pd
+
+        comparison = self.compare(result_key, baseline)
+        has_value = ~np.isnan(comparison["values"])
+        aoi_pos, scenario_pos, row_pos, metric_pos = np.nonzero(has_value)
+
+        columns: Dict[str, Any] = {self.aoi_column: self.aois.to_numpy()[aoi_pos]}
+        scenario_values = self.scenarios.take(scenario_pos)
+        if len(self.scenario_columns) == 1:
+            columns[self.scenario_columns[0]] = scenario_values.to_numpy()
+        else:
+            for level, scenario_column in enumerate(self.scenario_columns):
+                columns[scenario_column] = scenario_values.get_level_values(
+                    level
+                ).to_numpy()
+        columns[self.rows[result_key].name] = self.rows[result_key].to_numpy()[row_pos]
+        columns["metric"] = np.array(self.metrics[result_key], dtype=object)[metric_pos]
+        columns["value"] = comparison["values"][has_value]
+        columns["delta"] = comparison["delta"][has_value]
+        columns["percent_change"] = comparison["percent_change"][has_value]
+        return pd.DataFrame(columns)
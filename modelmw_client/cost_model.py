@@ -0,0 +1,162 @@
+"""
+A model of how long ModelMyWatershed jobs take, for scheduling and ETAs.
+"""
+#%%
+import heapq
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+module_logger = logging.getLogger(__name__)
+
+
+#%%
+class ModelMyWatershedCostModel:
+    """Records how long jobs take for each request endpoint and AOI size class, and
+    estimates the duration of new jobs from them.
+
+    A job's estimate is the mean duration of the past jobs for the same endpoint and
+    size class.  Until there are `min_samples` of those, the estimate is scaled from
+    all of the jobs on the endpoint by the relative size of the AOI's class (ie, a
+    HUC-8 is taken to be about 25 times the work of a HUC-12), and with no jobs on the
+    endpoint at all, from `default_seconds`.
+
+    If a history path is given, every duration is appended to it, so the estimates
+    improve from one session to the next.
+    """
+
+    cost_logger = module_logger.getChild(__qualname__)
+
+    # the relative work of an AOI in each size class, to a HUC-12
+    size_factors: Dict[str, float] = {
+        "huc8": 25.0,
+        "huc10": 5.0,
+        "huc12": 1.0,
+        "wkaoi": 1.0,
+        "geojson": 1.0,
+    }
+    # the estimate for a HUC-12 sized job on an endpoint that hasn't been timed
+    default_seconds: float = 30.0
+    min_samples: int = 3
+
+    def __init__(self, history_path: Union[str, None] = None):
+        """Create a new cost model
+
+        Args:
+            history_path (Union[str, None], optional): A file to read past job
+                durations from and append new ones to. Defaults to None, for a model
+                only kept in memory.
+        """
+        self.history_path = history_path
+        # the number of jobs and their total duration, by endpoint and size class
+        self._durations: Dict[Tuple[str, str], List[float]] = {}
+        self._lock = threading.Lock()
+        if history_path is not None and Path(history_path).is_file():
+            with open(history_path) as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                        self._add_duration(
+                            entry["request_endpoint"],
+                            entry["size_class"],
+                            entry["duration"],
+                        )
+                    except (json.JSONDecodeError, KeyError):
+                        continue
+
+    def _add_duration(
+        self, request_endpoint: str, size_class: str, duration: float
+    ) -> None:
+        count_and_total = self._durations.setdefault(
+            (request_endpoint, size_class), [0, 0.0]
+        )
+        count_and_total[0] += 1
+        count_and_total[1] += duration
+
+    def record(self, request_endpoint: str, size_class: str, duration: float) -> None:
+        """Records the duration of a finished job
+
+        Args:
+            request_endpoint (str): The endpoint of the job
+            size_class (str): The size class of the job's AOI, from
+                `ModelMyWatershedAOI.size_class`
+            duration (float): The time from starting the job to getting its results, in
+                seconds
+        """
+        with self._lock:
+            self._add_duration(request_endpoint, size_class, duration)
+            if self.history_path is None:
+                return
+            # a missing history only costs the estimates, so it is never an error
+            try:
+                Path(self.history_path).parent.mkdir(parents=True, exist_ok=True)
+                with open(self.history_path, "a") as fp:
+                    fp.write(
+                        json.dumps(
+                            {
+                                "request_endpoint": request_endpoint,
+                                "size_class": size_class,
+                                "duration": duration,
+                                "time": time.time(),
+                            }
+                        )
+                        + "\n"
+                    )
+            except OSError as ex:
+                self.cost_logger.warn(
+                    "\tCould not record the job duration in {}:\n\t{}".format(
+                        self.history_path, ex
+                    )
+                )
+
+    def estimate(self, request_endpoint: str, size_class: str) -> float:
+        """Estimates how long a job will take
+
+        Args:
+            request_endpoint (str): The endpoint of the job
+            size_class (str): The size class of the job's AOI, from
+                `ModelMyWatershedAOI.size_class`
+
+        Returns:
+            float: The estimated duration, in seconds
+        """
+        size_factor = self.size_factors.get(size_class, 1.0)
+        with self._lock:
+            count, total = self._durations.get((request_endpoint, size_class), [0, 0.0])
+            if count >= self.min_samples:
+                return total / count
+            # fit the time per unit of work from every size class on the endpoint
+            endpoint_work = 0.0
+            endpoint_total = 0.0
+            for (timed_endpoint, timed_class), (
+                timed_count,
+                timed_total,
+            ) in self._durations.items():
+                if timed_endpoint == request_endpoint:
+                    endpoint_work += timed_count * self.size_factors.get(
+                        timed_class, 1.0
+                    )
+                    endpoint_total += timed_total
+        if endpoint_work > 0:
+            return size_factor * endpoint_total / endpoint_work
+        return size_factor * self.default_seconds
+
+    @staticmethod
+    def estimate_batch_seconds(estimates: List[float], max_workers: int = 1) -> float:
+        """Estimates how long a batch of jobs will take, if they are run longest first
+        with `max_workers` at a time
+
+        Args:
+            estimates (List[float]): The estimated duration of each job, in seconds
+            max_workers (int, optional): The number of jobs run at once. Defaults to 1.
+
+        Returns:
+            float: The estimated time until the last job finishes, in seconds
+        """
+        worker_loads = [0.0] * max(1, min(max_workers, len(estimates)))
+        for estimate in sorted(estimates, reverse=True):
+            heapq.heapreplace(worker_loads, worker_loads[0] + estimate)
+        return max(worker_loads)
@@ -0,0 +1,317 @@
+"""
+Atomic writes of saved job dumps, with an append-only index of what has been written.
+"""
+#%%
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Tuple, Union
+
+module_logger = logging.getLogger(__name__)
+
+
+#%%
+class ModelMyWatershedDumpIndex:
+    """Writes files into a directory atomically and keeps an append-only index of them,
+    with the size and SHA-256 hash of each.
+
+    - Each file is written to a temporary file in the same directory and renamed over
+      the old one, so a crash or another writer can never leave a partial file; readers
+      see either the old file or the new one.
+    - Writes to the same file from threads of one process are serialized with a lock
+      for each file name.  Writers in other processes each rename a complete file, so
+      the last write wins.
+    - Every write appends one line to the index file.  Looking up a file reads the index
+      instead of checking the file system: a file that has been seen costs nothing and a
+      file that hasn't costs one read of whatever was appended to the index since the
+      last lookup, no matter how many files are in the directory.
+
+    The index is made on first use, from the files already in the directory.  Files
+    copied into the directory by other means after that aren't seen until `rebuild` is
+    called, or until they are added with `add_file` (as the API client does for dumps
+    with `check_unindexed_dumps` turned on).  A write can also keep a little metadata about the file in the index (ie,
+    when a cached result expires), so it can be checked without opening the file.
+    """
+
+    index_logger = module_logger.getChild(__qualname__)
+
+    def __init__(
+        self,
+        directory: str,
+        index_filename: str = "dump_index.jsonl",
+        file_pattern: str = "*.json",
+    ):
+        """Create a new index of a directory.  Nothing is read until the first lookup
+        or write.
+
+        Args:
+            directory (str): The directory of files
+            index_filename (str, optional): The name of the index file, in the
+                directory. Defaults to "dump_index.jsonl".
+            file_pattern (str, optional): A glob pattern for the files to index when the
+                index is first made. Defaults to "*.json".
+        """
+        self.directory = directory
+        self.index_filename = str(Path(directory) / index_filename)
+        self.file_pattern = file_pattern
+        # the size and hash of each file, by file name; the hash is None for files
+        # indexed from the directory rather than written through the index
+        self._entries: Union[Dict[str, Tuple[int, Union[str, None]]], None] = None
+        # the metadata given with the last write of each file, if any
+        self._metadata: Dict[str, Dict[str, Any]] = {}
+        # how much of the index file has been read
+        self._index_offset = 0
+        self._index_lock = threading.Lock()
+        self._file_locks: Dict[str, threading.Lock] = {}
+
+    def _read_new_entries(self) -> None:
+        """Reads the lines appended to the index since it was last read.  Call with the
+        index lock held."""
+        try:
+            with open(self.index_filename, "rb") as fp:
+                fp.seek(self._index_offset)
+                appended = fp.read()
+        except FileNotFoundError:
+            return
+        # leave a line that is still being written for the next read
+        complete_end = appended.rfind(b"\n") + 1
+        for line in appended[:complete_end].splitlines():
+            try:
+                entry = json.loads(line)
+                # removed files are written with no size
+                if entry["s"] is None:
+                    self._entries.pop(entry["f"], None)
+                else:
+                    self._entries[entry["f"]] = (entry["s"], entry["h"])
+                if "m" in entry:
+                    self._metadata[entry["f"]] = entry["m"]
+                else:
+                    self._metadata.pop(entry["f"], None)
+            except (ValueError, KeyError, TypeError):
+                self.index_logger.warn(
+                    "\tSkipping unreadable index line {}".format(line)
+                )
+        self._index_offset += complete_end
+
+    def _load(self) -> None:
+        """Reads the index, making it from the directory if it doesn't exist yet.  Call
+        with the index lock held."""
+        if self._entries is not None:
+            return
+        self._entries = {}
+        if not Path(self.index_filename).is_file():
+            self._index_directory()
+        self._read_new_entries()
+
+    def _index_directory(self) -> None:
+        """Appends every file in the directory to the index"""
+        if not Path(self.directory).is_dir():
+            return
+        index_lines = [
+            self._make_index_line(filename.name, filename.stat().st_size, None)
+            for filename in sorted(Path(self.directory).glob(self.file_pattern))
+            if filename.is_file()
+        ]
+        if len(index_lines) > 0:
+            with open(self.index_filename, "a") as fp:
+                fp.write("".join(index_lines))
+
+    @staticmethod
+    def _make_index_line(
+        filename: str,
+        size: Union[int, None],
+        sha256: Union[str, None],
+        metadata: Union[Dict[str, Any], None] = None,
+    ) -> str:
+        entry = {"f": filename, "s": size, "h": sha256, "t": round(time.time(), 3)}
+        if metadata is not None:
+            entry["m"] = metadata
+        return json.dumps(entry, separators=(",", ":")) + "\n"
+
+    def rebuild(self) -> None:
+        """Replaces the index with one made from the files now in the directory"""
+        with self._index_lock:
+            if Path(self.index_filename).is_file():
+                os.remove(self.index_filename)
+            self._entries = None
+            self._metadata = {}
+            self._index_offset = 0
+            self._load()
+
+    def get(self, filename: str) -> Union[Tuple[int, Union[str, None]], None]:
+        """Looks up a file in the index
+
+        Args:
+            filename (str): The file, with or without its directory
+
+        Returns:
+            Union[Tuple[int, Union[str, None]], None]: The size and SHA-256 hash of the
+                last write of the file, or None if it isn't in the index
+        """
+        name = Path(filename).name
+        with self._index_lock:
+            self._load()
+            if name not in self._entries:
+                # it may have been written by another process
+                self._read_new_entries()
+            return self._entries.get(name)
+
+    def __contains__(self, filename: str) -> bool:
+        return self.get(filename) is not None
+
+    def get_metadata(self, filename: str) -> Union[Dict[str, Any], None]:
+        """Looks up the metadata written with a file
+
+        Args:
+            filename (str): The file, with or without its directory
+
+        Returns:
+            Union[Dict[str, Any], None]: The metadata, or None if the file isn't in the
+                index or was written without any
+        """
+        if self.get(filename) is None:
+            return None
+        with self._index_lock:
+            return self._metadata.get(Path(filename).name)
+
+    def list_files(self) -> List[str]:
+        """Lists the files in the index
+
+        Returns:
+            List[str]: The file names, without their directory
+        """
+        with self._index_lock:
+            self._load()
+            self._read_new_entries()
+            return list(self._entries.keys())
+
+    def lock(self, filename: str) -> threading.Lock:
+        """Gets the lock for writing a file
+
+        Args:
+            filename (str): The file, with or without its directory
+
+        Returns:
+            threading.Lock: The lock, shared by every caller for the same file name
+        """
+        name = Path(filename).name
+        with self._index_lock:
+            if name not in self._file_locks:
+                self._file_locks[name] = threading.Lock()
+            return self._file_locks[name]
+
+    def write(
+        self,
+        filename: str,
+        content: bytes,
+        metadata: Union[Dict[str, Any], None] = None,
+    ) -> None:
+        """Writes a file atomically and adds it to the index
+
+        Args:
+            filename (str): The file, with or without its directory
+            content (bytes): The whole content of the file
+            metadata (Union[Dict[str, Any], None], optional): A little JSON
+                serializable metadata to keep in the index with the file.
+                Defaults to None.
+        """
+        name = Path(filename).name
+        Path(self.directory).mkdir(parents=True, exist_ok=True)
+        with self.lock(name):
+            fd, temp_name = tempfile.mkstemp(
+                dir=self.directory, prefix=".{}.".format(name), suffix=".tmp"
+            )
+            try:
+                with os.fdopen(fd, "wb") as fp:
+                    fp.write(content)
+                os.replace(temp_name, Path(self.directory) / name)
+            except Exception:
+                if Path(temp_name).is_file():
+                    os.remove(temp_name)
+                raise
+
+            index_line = self._make_index_line(
+                name, len(content), hashlib.sha256(content).hexdigest(), metadata
+            )
+            with self._index_lock:
+                self._load()
+                # a single append of the whole line, so processes sharing the index
+                # don't interleave their lines
+                with open(self.index_filename, "a") as fp:
+                    fp.write(index_line)
+                self._read_new_entries()
+
+    def add_file(
+        self,
+        source_filename: str,
+        filename: str,
+        size: int,
+        sha256: Union[str, None],
+    ) -> None:
+        """Moves a complete file, ie, a response streamed to a temporary file in the
+        directory, into place and adds it to the index.  A file already in place (ie,
+        copied into the directory) is added by giving it as its own source.
+
+        Args:
+            source_filename (str): The complete file, on the same file system
+            filename (str): The file to replace, with or without its directory
+            size (int): The size of the file
+            sha256 (Union[str, None]): The SHA-256 hash of the file, or None if it
+                wasn't written through the index
+        """
+        name = Path(filename).name
+        with self.lock(name):
+            os.replace(source_filename, Path(self.directory) / name)
+            index_line = self._make_index_line(name, size, sha256)
+            with self._index_lock:
+                self._load()
+                with open(self.index_filename, "a") as fp:
+                    fp.write(index_line)
+                self._read_new_entries()
+
+    def remove(self, filename: str) -> None:
+        """Deletes a file and removes it from the index
+
+        Args:
+            filename (str): The file, with or without its directory
+        """
+        name = Path(filename).name
+        with self.lock(name):
+            try:
+                os.remove(Path(self.directory) / name)
+            except FileNotFoundError:
+                pass
+            index_line = self._make_index_line(name, None, None)
+            with self._index_lock:
+                self._load()
+                with open(self.index_filename, "a") as fp:
+                    fp.write(index_line)
+                self._read_new_entries()
+
+    def verify(self, filename: str) -> bool:
+        """Checks that a file is the same size, and has the same hash, as when it was
+        last written through the index
+
+        Args:
+            filename (str): The file, with or without its directory
+
+        Returns:
+            bool: True if the file matches its index entry
+        """
+        entry = self.get(filename)
+        if entry is None:
+            return False
+        size, sha256 = entry
+        try:
+            with open(Path(self.directory) / Path(filename).name, "rb") as fp:
+                content = fp.read()
+        except FileNotFoundError:
+            return False
+        return len(content) == size and (
+            sha256 is None or hashlib.sha256(content).hexdigest() == sha256
+        )
@@ -0,0 +1,131 @@
+"""
+Lazy reading of single result keys from saved job dumps.
+"""
+#%%
+import json
+import logging
+import mmap
+from pathlib import Path
+from typing import Any, Iterator, Tuple, Union
+
+from .streaming import read_streamed_result
+
+module_logger = logging.getLogger(__name__)
+
+_decoder = json.JSONDecoder()
+
+# where the result keys are in a dump written by `dump_job_json`, with indent=2
+_RESULT_RESPONSE_START = b'\n  "result_response": {'
+_RESULT_START = b'\n    "result": {'
+_RESULT_END = b"\n    }"
+_RESULT_KEY_INDENT = b"\n      "
+
+# the first piece of a value to try decoding; doubled until the value fits
+_FIRST_WINDOW_BYTES = 64 * 1024
+
+
+#%%
+def _decode_value_at(mapped: mmap.mmap, value_start: int) -> Any:
+    """Decodes the JSON value starting at a byte offset, reading no more of the file
+    than it takes to hold the value"""
+    window_bytes = _FIRST_WINDOW_BYTES
+    while True:
+        window_end = min(len(mapped), value_start + window_bytes)
+        window = mapped[value_start:window_end].decode("utf-8", errors="replace")
+        try:
+            value, value_end = _decoder.raw_decode(window)
+            # a number cut off by the end of the window still decodes, so the value
+            # only counts if something comes after it
+            if value_end < len(window) or window_end == len(mapped):
+                return value
+        except json.JSONDecodeError:
+            if window_end == len(mapped):
+                raise
+        window_bytes *= 2
+
+
+def read_result_key(dump_filename: Union[str, Path], result_key: str) -> Any:
+    """Reads one key of the job result from a saved dump, without parsing the rest of
+    the file.
+
+    The file is memory-mapped and only the bytes of the requested value are decoded.
+    Dumps written by `dump_job_json` are found by their layout; other JSON files
+    (ie, with a different indentation or only a "result" key) are parsed in full.
+
+    Args:
+        dump_filename (Union[str, Path]): The dump file
+        result_key (str): The key within the job "result", ie, "SummaryLoads", "Area"
+            or "survey"
+
+    Returns:
+        Any: The value of the key, or None if the file or key doesn't exist
+    """
+    try:
+        with open(dump_filename, "rb") as fp:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                response_start = mapped.find(_RESULT_RESPONSE_START)
+                result_start = (
+                    -1
+                    if response_start < 0
+                    else mapped.find(_RESULT_START, response_start)
+                )
+                if result_start >= 0:
+                    # the first line at the result's indentation closes it, because
+                    # everything nested inside is indented further
+                    result_end = mapped.find(_RESULT_END, result_start)
+                    if result_end < 0:
+                        result_end = len(mapped)
+                    key_token = (
+                        _RESULT_KEY_INDENT + json.dumps(result_key).encode() + b": "
+                    )
+                    key_start = mapped.find(key_token, result_start, result_end)
+                    if key_start < 0:
+                        return None
+                    return _decode_value_at(mapped, key_start + len(key_token))
+    except (FileNotFoundError, ValueError):
+        # ValueError: the file is empty and can't be mapped
+        return None
+
+    # not laid out like our dumps, so parse the whole file
+    with open(dump_filename) as fp:
+        try:
+            dump = json.load(fp)
+        except json.JSONDecodeError:
+            module_logger.warn("\tCould not parse {}".format(dump_filename))
+            return None
+    if not isinstance(dump, dict):
+        return None
+    if "result_file" in dump:
+        # the result was streamed to its own file, beside the dump
+        result = read_streamed_result(
+            str(Path(dump_filename).parent / Path(dump["result_file"]).name)
+        )
+    else:
+        result = dump.get("result_response", {}).get("result", dump.get("result", dump))
+    return result.get(result_key) if isinstance(result, dict) else None
+
+
+def iter_dump_results(
+    archive_path: Union[str, Path],
+    result_key: str,
+    file_pattern: str = "*.json",
+) -> Iterator[Tuple[Path, Any]]:
+    """Reads one result key from every dump in a directory, one file at a time, so
+    only a single file is mapped and a single value held at once.
+
+    Args:
+        archive_path (Union[str, Path]): The directory of dumps
+        result_key (str): The key within each job "result" to read
+        file_pattern (str, optional): A glob pattern for the dump files, ie,
+            "*_gwlf-e_run.json". Defaults to "*.json".
+
+    Yields:
+        Iterator[Tuple[Path, Any]]: The file name and the value of the key, for each
+            file that has the key
+    """
+    for dump_filename in sorted(Path(archive_path).glob(file_pattern)):
+        if not dump_filename.is_file():
+            continue
+        value = read_result_key(dump_filename, result_key)
+        if value is not None:
+            yield dump_filename, value
@@ -0,0 +1,146 @@
+"""
+Routing of ModelMyWatershed jobs across several hosts, by weight, health and budget.
+"""
+#%%
+import logging
+import random
+import threading
+from typing import Any, Dict, List, TypedDict, Union
+from urllib.parse import urlsplit
+
+from typing_extensions import NotRequired
+
+from .circuit_breaker import ModelMyWatershedCircuitState, ModelMyWatershedHostHealth
+from .rate_limiter import ModelMyWatershedRateLimiter
+
+module_logger = logging.getLogger(__name__)
+
+
+#%%
+class ModelMyWatershedHost(TypedDict):
+    mmw_host: str
+    weight: NotRequired[float]
+    requests_per_minute: NotRequired[float]
+    burst: NotRequired[int]
+
+
+class ModelMyWatershedHostRouter:
+    """Picks the host to start each job on, from several ModelMyWatershed hosts (ie,
+    production and staging).
+
+    - Hosts whose circuit for the endpoint family is open are skipped.
+    - The healthy hosts are tried in a random order weighted by their `weight`, and
+      the first with room in its own request budget is used.
+    - If none of them has room, the job waits for the budget of the first.
+    """
+
+    router_logger = module_logger.getChild(__qualname__)
+
+    def __init__(
+        self, hosts: List[ModelMyWatershedHost], host_health: ModelMyWatershedHostHealth
+    ):
+        """Create a new host router
+
+        Args:
+            hosts (List[ModelMyWatershedHost]): The hosts, with their weights (default
+                1) and, optionally, their own limit of job starts per minute and burst
+                (default 4)
+            host_health (ModelMyWatershedHostHealth): The circuit breakers for the hosts
+        """
+        if len(hosts) == 0:
+            raise ValueError("At least one host is needed")
+        self.hosts = hosts
+        self.host_health = host_health
+        self.rate_limiters: Dict[str, Union[ModelMyWatershedRateLimiter, None]] = {
+            host["mmw_host"]: (
+                ModelMyWatershedRateLimiter(
+                    host["requests_per_minute"], host.get("burst", 4), reserved=0
+                )
+                if host.get("requests_per_minute") is not None
+                else None
+            )
+            for host in hosts
+        }
+        self._n_routed = {host["mmw_host"]: 0 for host in hosts}
+        self._lock = threading.Lock()
+
+    def is_healthy(self, mmw_host: str, endpoint_family: str) -> bool:
+        """Checks that the circuit for a host and endpoint family isn't open"""
+        return (
+            self.host_health.get_breaker(
+                urlsplit(mmw_host).netloc, endpoint_family
+            ).state
+            != ModelMyWatershedCircuitState.OPEN
+        )
+
+    def choose_host(
+        self, endpoint_family: str, exclude: Union[List[str], None] = None
+    ) -> Union[str, None]:
+        """Chooses a host for a job and takes a request from its budget, waiting for
+        the budget if every healthy host has used up its own
+
+        Args:
+            endpoint_family (str): The endpoint family of the job, ie, "analyze"
+            exclude (Union[List[str], None], optional): Hosts not to use, ie, hosts
+                already tried for this job. Defaults to None.
+
+        Returns:
+            Union[str, None]: The host, or None if no host is healthy
+        """
+        exclude = exclude if exclude is not None else []
+        candidates = [
+            host
+            for host in self.hosts
+            if host["mmw_host"] not in exclude
+            and self.is_healthy(host["mmw_host"], endpoint_family)
+        ]
+        if len(candidates) == 0:
+            return None
+
+        # a weighted random order: sort by u^(1/weight) for a uniform random u
+        order_keys = {}
+        for host in candidates:
+            weight = max(host.get("weight", 1), 1e-9)
+            order_keys[host["mmw_host"]] = random.random() ** (1.0 / weight)
+        candidates.sort(key=lambda host: order_keys[host["mmw_host"]], reverse=True)
+        chosen_host = None
+        for host in candidates:
+            rate_limiter = self.rate_limiters[host["mmw_host"]]
+            if rate_limiter is None or rate_limiter.acquire(
+                use_reserve=True, timeout=0
+            ):
+                chosen_host = host["mmw_host"]
+                break
+        if chosen_host is None:
+            chosen_host = candidates[0]["mmw_host"]
+            self.router_logger.debug(
+                "\tWaiting for the request budget of {}".format(chosen_host)
+            )
+            self.rate_limiters[chosen_host].acquire(use_reserve=True)
+
+        with self._lock:
+            self._n_routed[chosen_host] += 1
+        return chosen_host
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        """The number of jobs routed to each host and whether its circuits are open
+
+        Returns:
+            Dict[str, Dict[str, Any]]: The "weight", the number of jobs "routed" and
+                the names of any "open_circuits", by host
+        """
+        breaker_metrics = self.host_health.metrics()
+        with self._lock:
+            return {
+                host["mmw_host"]: {
+                    "weight": host.get("weight", 1),
+                    "routed": self._n_routed[host["mmw_host"]],
+                    "open_circuits": [
+                        name
+                        for name, metrics in breaker_metrics.items()
+                        if name.split(" ")[0] == urlsplit(host["mmw_host"]).netloc
+                        and metrics["state"] == "OPEN"
+                    ],
+                }
+                for host in self.hosts
+            }
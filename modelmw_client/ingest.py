@@ -0,0 +1,342 @@
+"""
+Bulk ingest of a directory of saved job dumps into consolidated tables.
+"""
+#%%
+import json
+import logging
+import os
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple, Union
+
+from .results import (
+    normalize_analysis_results,
+    normalize_gwlfe_results,
+    normalize_tr55_results,
+)
+from .streaming import read_streamed_result
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+module_logger = logging.getLogger(__name__)
+
+# The kinds of dumps that are ingested, by the end of the request endpoint.  The
+# endpoint in each dump decides its kind; the file name is only used if the dump
+# doesn't have one.
+_DUMP_KINDS: List[Tuple[str, "re.Pattern"]] = [
+    ("gwlfe", re.compile(r"gwlf-e[/_]run[/_]?$")),
+    ("land", re.compile(r"(?:^|[/_])land[/_](?P<layer>[^/]+?)[/_]?$")),
+    ("tr55", re.compile(r"tr55[/_]?$")),
+]
+
+# the columns added to every table to identify the dump each row came from
+_LABEL_COLUMNS = ["job_label", "request_endpoint", "dump_file"]
+
+_MANIFEST_FILENAME = "ingest_manifest.json"
+
+
+#%%
+def _get_dump_kind(request_endpoint: str) -> Tuple[Union[str, None], Dict[str, str]]:
+    """Finds the kind of a dump and any labels that are part of its endpoint (ie, the
+    land use layer)"""
+    for dump_kind, endpoint_pattern in _DUMP_KINDS:
+        endpoint_match = endpoint_pattern.search(request_endpoint)
+        if endpoint_match is not None:
+            return dump_kind, {
+                ("Land_Use_Source" if key == "layer" else key): val
+                for key, val in endpoint_match.groupdict().items()
+            }
+    return None, {}
+
+
+def _read_dump(dump_filename: str) -> Union[Tuple[str, Dict[str, Any], Dict], None]:
+    """Parses one dump in a worker process, returning its kind, labels and result"""
+    try:
+        with open(dump_filename) as fp:
+            req_dump = json.load(fp)
+        if "result_file" in req_dump:
+            # the result was streamed to its own file, beside the dump
+            result = read_streamed_result(
+                str(Path(dump_filename).parent / Path(req_dump["result_file"]).name)
+            )
+        else:
+            result = req_dump["result_response"]["result"]
+    except (OSError, ValueError, KeyError, TypeError) as ex:
+        module_logger.warn("\tCould not ingest {}:\n\t{}".format(dump_filename, ex))
+        return None
+
+    if not isinstance(result, dict):
+        # ie, the streamed result file is missing or unreadable
+        module_logger.warn(
+            "\tCould not ingest {}:\n\tno result in the dump".format(dump_filename)
+        )
+        return None
+
+    file_stem = Path(dump_filename).stem
+    request_endpoint = req_dump.get("request_endpoint", file_stem)
+    dump_kind, endpoint_labels = _get_dump_kind(request_endpoint)
+    if dump_kind is None:
+        dump_kind, endpoint_labels = _get_dump_kind(file_stem)
+    if dump_kind is None:
+        return None
+
+    labels = {
+        "job_label": req_dump.get("job_label", file_stem),
+        **endpoint_labels,
+        "request_endpoint": request_endpoint,
+        "dump_file": Path(dump_filename).name,
+    }
+    if dump_kind == "land":
+        if "survey" not in result:
+            module_logger.warn(
+                "\tCould not ingest {}:\n\tthe land result has no survey".format(
+                    dump_filename
+                )
+            )
+            return None
+        # only the survey is made into a table; don't send the rest back
+        result = {"survey": result["survey"]}
+    return dump_kind, labels, result
+
+
+class ModelMyWatershedDumpIngester:
+    """Rebuilds result tables from a directory of job dumps saved by
+    `ModelMyWatershedAPI.dump_job_json`, parsing the dumps in a pool of processes.
+
+    The dumps are found by the `get_dump_filename` naming convention: GWLF-E runs
+    (`*_gwlf-e_run.json`), land use analyses (`*_land_<layer>.json`) and TR-55 runs
+    (`*_tr55.json`).  Each is sent to the normalizer for its endpoint and the tables
+    are written as csv's to the table path.
+
+    Ingests are incremental: the modification time and size of every ingested dump are
+    kept in a manifest with the tables, and on the next ingest only new or changed
+    dumps are parsed.  The rows of changed or deleted dumps are replaced or dropped.
+    """
+
+    ingest_logger = module_logger.getChild(__qualname__)
+
+    # the tables made from each kind of dump
+    table_names: Dict[str, List[str]] = {
+        "gwlfe": [
+            "gwlfe_monthly",
+            "gwlfe_load_summaries",
+            "gwlfe_lu_loads",
+            "gwlfe_metadata",
+            "gwlfe_summaries",
+        ],
+        "land": ["land_use"],
+        "tr55": [
+            "tr55_censuses",
+            "tr55_runoff_distributions",
+            "tr55_runoff_totals",
+            "step_l_qualities",
+        ],
+    }
+
+    dump_patterns: List[str] = ["*_gwlf-e_run.json", "*_land_*.json", "*_tr55.json"]
+
+    def __init__(
+        self,
+        save_path: str,
+        table_path: Union[str, None] = None,
+        max_workers: Union[int, None] = None,
+    ):
+        """Create a new dump ingester
+
+        Args:
+            save_path (str): The directory of job dumps, the `save_path` of the API
+                client that wrote them
+            table_path (Union[str, None], optional): The directory to write the tables
+                and manifest to. Defaults to a "tables" directory in the save path.
+            max_workers (Union[int, None], optional): The number of processes to parse
+                dumps with. Defaults to None, for the number of processors.
+        """
+        self.save_path = save_path
+        self.table_path = (
+            table_path if table_path is not None else str(Path(save_path) / "tables")
+        )
+        self.max_workers = max_workers
+
+    def _get_manifest_filename(self) -> Path:
+        return Path(self.table_path) / _MANIFEST_FILENAME
+
+    def _get_table_filename(self, table_name: str) -> Path:
+        return Path(self.table_path) / "{}.csv".format(table_name)
+
+    def read_manifest(self) -> Dict[str, List[int]]:
+        """Reads the modification time (in nanoseconds) and size of every dump in the
+        last ingest, by file name"""
+        if not self._get_manifest_filename().is_file():
+            return {}
+        with open(self._get_manifest_filename()) as fp:
+            try:
+                return json.load(fp)
+            except json.JSONDecodeError:
+                self.ingest_logger.warn("\tIgnoring unreadable ingest manifest")
+                return {}
+
+    def find_dumps(self) -> Dict[str, List[int]]:
+        """Finds the dumps to ingest
+
+        Returns:
+            Dict[str, List[int]]: The modification time (in nanoseconds) and size of
+                each dump, by file name
+        """
+        dump_stats = {}
+        for dump_pattern in self.dump_patterns:
+            for dump_filename in Path(self.save_path).glob(dump_pattern):
+                if dump_filename.name.endswith("_result.json"):
+                    # a streamed result, read through its dump
+                    continue
+                dump_stat = dump_filename.stat()
+                dump_stats[dump_filename.name] = [
+                    dump_stat.st_mtime_ns,
+                    dump_stat.st_size,
+                ]
+        return dump_stats
+
+    def read_tables(self) -> Dict[str, Union["pd.DataFrame", None]]:
+        """Reads the tables written by the last ingest
+
+        Returns:
+            Dict[str, Union[pd.DataFrame, None]]: The tables, or None for tables that
+                haven't been written
+        """
+        import pandas as pd
+
+        tables = {}
+        for table_names in self.table_names.values():
+            for table_name in table_names:
+                table_filename = self._get_table_filename(table_name)
+                tables[table_name] = (
+                    pd.read_csv(
+                        table_filename,
+                        # keep labels like HUC codes as strings
+                        dtype={
+                            column: str
+                            for column in _LABEL_COLUMNS + ["Land_Use_Source"]
+                        },
+                    )
+                    if table_filename.is_file()
+                    else None
+                )
+        return tables
+
+    def _write_file(self, filename: Path, write_function) -> None:
+        # write to a temporary file and rename it, so a crash can't leave a partial file
+        fd, temp_name = tempfile.mkstemp(dir=self.table_path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", newline="") as fp:
+                write_function(fp)
+            os.replace(temp_name, filename)
+        except Exception:
+            os.remove(temp_name)
+            raise
+
+    def ingest(self, full: bool = False) -> Dict[str, Union["pd.DataFrame", None]]:
+        """Ingests the new and changed dumps and writes the updated tables
+
+        Args:
+            full (bool, optional): Ignore the last ingest and parse every dump.
+                Defaults to False.
+
+        Returns:
+            Dict[str, Union[pd.DataFrame, None]]: All of the tables, including the
+                rows from earlier ingests
+        """
+        import pandas as pd
+
+        old_manifest = {} if full else self.read_manifest()
+        dump_stats = self.find_dumps()
+        changed_dumps = sorted(
+            dump_file
+            for dump_file, dump_stat in dump_stats.items()
+            if old_manifest.get(dump_file) != dump_stat
+        )
+        stale_dumps = set(changed_dumps) | (set(old_manifest) - set(dump_stats))
+        self.ingest_logger.info(
+            "\tIngesting {} of {} dumps".format(len(changed_dumps), len(dump_stats))
+        )
+        if len(stale_dumps) == 0 and not full:
+            return self.read_tables()
+
+        # parse the dumps in a pool of processes, a chunk at a time
+        labeled_results: Dict[str, List[Tuple[Dict[str, Any], Dict]]] = {
+            dump_kind: [] for dump_kind in self.table_names.keys()
+        }
+        new_manifest = {
+            dump_file: dump_stat
+            for dump_file, dump_stat in old_manifest.items()
+            if dump_file not in stale_dumps
+        }
+        if len(changed_dumps) > 0:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as dump_executor:
+                dump_reads = dump_executor.map(
+                    _read_dump,
+                    [
+                        str(Path(self.save_path) / dump_file)
+                        for dump_file in changed_dumps
+                    ],
+                    chunksize=max(1, min(64, len(changed_dumps) // 32)),
+                )
+                for dump_file, dump_read in zip(changed_dumps, dump_reads):
+                    if dump_read is None:
+                        continue
+                    dump_kind, labels, result = dump_read
+                    labeled_results[dump_kind].append((labels, result))
+                    new_manifest[dump_file] = dump_stats[dump_file]
+
+        new_tables: Dict[str, "pd.DataFrame"] = {}
+        for dump_kind, kind_results in labeled_results.items():
+            if len(kind_results) == 0:
+                continue
+            try:
+                if dump_kind == "gwlfe":
+                    new_tables.update(normalize_gwlfe_results(kind_results))
+                elif dump_kind == "land":
+                    new_tables["land_use"] = normalize_analysis_results(kind_results)
+                elif dump_kind == "tr55":
+                    new_tables.update(normalize_tr55_results(kind_results))
+            except (KeyError, TypeError) as ex:
+                self.ingest_logger.warn(
+                    "\tCould not make the {} tables:\n\t{}".format(dump_kind, ex)
+                )
+                for labels, _ in kind_results:
+                    new_manifest.pop(labels["dump_file"], None)
+
+        # replace the rows of the changed and deleted dumps
+        tables = self.read_tables() if not full else {}
+        for table_names in self.table_names.values():
+            for table_name in table_names:
+                old_table = tables.get(table_name)
+                if old_table is not None:
+                    old_table = old_table[~old_table["dump_file"].isin(stale_dumps)]
+                table_pieces = [
+                    table
+                    for table in [old_table, new_tables.get(table_name)]
+                    if table is not None and len(table) > 0
+                ]
+                tables[table_name] = (
+                    pd.concat(table_pieces, ignore_index=True)
+                    if len(table_pieces) > 0
+                    else None
+                )
+
+        Path(self.table_path).mkdir(parents=True, exist_ok=True)
+        for table_name, table in tables.items():
+            if table is not None:
+                self._write_file(
+                    self._get_table_filename(table_name),
+                    lambda fp: table.to_csv(fp, index=False),
+                )
+            elif self._get_table_filename(table_name).is_file():
+                os.remove(self._get_table_filename(table_name))
+        # the manifest goes last, so a crash part way through is ingested again
+        self._write_file(
+            self._get_manifest_filename(),
+            lambda fp: json.dump(new_manifest, fp, separators=(",", ":")),
+        )
+        return tables
@@ -0,0 +1,297 @@
+"""
+A priority queue for ModelMyWatershed jobs, with deadlines, cancellation and a shared
+request budget.
+"""
+#%%
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Tuple, Union
+
+from .job_record import ModelMyWatershedJobRecord, ModelMyWatershedJobState
+from .model_client import ModelMyWatershedAPI, ModelMyWatershedJob
+from .rate_limiter import ModelMyWatershedRateLimiter
+
+module_logger = logging.getLogger(__name__)
+
+
+#%%
+class ModelMyWatershedQueuedJob:
+    """A job waiting in (or taken from) a `ModelMyWatershedJobQueue`"""
+
+    __slots__ = (
+        "request_endpoint",
+        "job_label",
+        "payload",
+        "priority",
+        "deadline",
+        "size_class",
+        "status",
+        "job_dict",
+        "job_record",
+        "_cancel_event",
+        "_done_event",
+    )
+
+    def __init__(
+        self,
+        request_endpoint: str,
+        job_label: str,
+        payload: Any,
+        priority: str,
+        deadline: Union[float, None],
+        size_class: Union[str, None],
+    ):
+        self.request_endpoint = request_endpoint
+        self.job_label = job_label
+        self.payload = payload
+        self.priority = priority
+        # as a time.monotonic() value
+        self.deadline = deadline
+        self.size_class = size_class
+        self.status = "queued"
+        self.job_dict: Union[ModelMyWatershedJob, None] = None
+        self.job_record: Union[ModelMyWatershedJobRecord, None] = None
+        self._cancel_event = threading.Event()
+        self._done_event = threading.Event()
+
+    def cancel(self) -> None:
+        """Cancels the job.  A queued job is never started, and a running job stops
+        being polled for results."""
+        self._cancel_event.set()
+
+    def cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def should_stop(self) -> bool:
+        return self.cancelled() or self.expired()
+
+    def done(self) -> bool:
+        return self._done_event.is_set()
+
+    def result(
+        self, timeout: Union[float, None] = None
+    ) -> Union[ModelMyWatershedJob, None]:
+        """Waits for the job to finish
+
+        Args:
+            timeout (Union[float, None], optional): The longest to wait, in seconds.
+                Defaults to None, to wait until the job finishes.
+
+        Returns:
+            Union[ModelMyWatershedJob, None]: The job request and result, or None if the
+                job was never started or didn't finish in time
+        """
+        self._done_event.wait(timeout)
+        return self.job_dict
+
+    def __repr__(self) -> str:
+        return "ModelMyWatershedQueuedJob({}, {}, {})".format(
+            self.job_label, self.priority, self.status
+        )
+
+
+class ModelMyWatershedJobQueue:
+    """Runs jobs from any number of callers through one API client, highest priority
+    first.
+
+    - Jobs are run in order of priority class, then deadline, then submission.
+    - A job whose deadline passes before it starts is never started, and one whose
+      deadline passes while it is running stops being polled for results; its status
+      is "expired".
+    - Cancelled jobs are dropped the same way, with the status "cancelled".
+    - Job starts share a rate limiter where some of the budget is reserved for the
+      "interactive" class, so a background batch can't hold up interactive requests.
+      By default this is the API client's own limiter, so jobs started directly
+      through the client share the same budget and can't use the reserve either.
+
+    Example:
+        with ModelMyWatershedJobQueue(mmw_run) as job_queue:
+            batch_jobs = [
+                job_queue.submit(mmw_run.land_endpoint.format("2019_2019"), huc, payload, priority="background")
+                for huc, payload in batch_payloads
+            ]
+            my_job = job_queue.submit(
+                mmw_run.tr55_endpoint, "my_huc", tr55_payload, priority="interactive", deadline=120
+            )
+            my_result = my_job.result()
+    """
+
+    queue_logger = module_logger.getChild(__qualname__)
+
+    # the priority classes, from first to last
+    priorities: Dict[str, int] = {"interactive": 0, "normal": 1, "background": 2}
+
+    def __init__(
+        self,
+        mmw_api: ModelMyWatershedAPI,
+        max_workers: int = 4,
+        rate_limiter: Union[ModelMyWatershedRateLimiter, None] = None,
+    ):
+        """Create a new job queue
+
+        Args:
+            mmw_api (ModelMyWatershedAPI): The API client to run the jobs with
+            max_workers (int, optional): The number of jobs to run at once.
+                Defaults to 4.
+            rate_limiter (Union[ModelMyWatershedRateLimiter, None], optional): The
+                limiter for starting jobs, used instead of the client's for the jobs in
+                the queue. Defaults to None, for the client's `rate_limiter`.
+        """
+        self.mmw_api = mmw_api
+        self.max_workers = max_workers
+        self.rate_limiter = (
+            rate_limiter if rate_limiter is not None else mmw_api.rate_limiter
+        )
+        self._queue: List[Tuple[int, float, int, ModelMyWatershedQueuedJob]] = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._workers: List[threading.Thread] = []
+        self._closed = False
+
+    def __enter__(self) -> "ModelMyWatershedJobQueue":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def submit(
+        self,
+        request_endpoint: str,
+        job_label: str,
+        payload: Any = None,
+        priority: str = "normal",
+        deadline: Union[float, None] = None,
+        size_class: Union[str, None] = None,
+    ) -> ModelMyWatershedQueuedJob:
+        """Adds a job to the queue
+
+        Args:
+            request_endpoint (str): The endpoint for the request
+            job_label (str): A label to use to save the output files
+            payload (Any, optional): The payload going to the request. Defaults to None.
+            priority (str, optional): The priority class, one of "interactive",
+                "normal" or "background". Defaults to "normal".
+            deadline (Union[float, None], optional): The number of seconds from now
+                until the job's results are no longer wanted. Defaults to None.
+            size_class (Union[str, None], optional): The size class of the job's AOI,
+                for the cost model. Defaults to None.
+
+        Returns:
+            ModelMyWatershedQueuedJob: The queued job, to wait for or cancel
+        """
+        if priority not in self.priorities:
+            raise ValueError("Unknown priority class {}".format(priority))
+        if self._closed:
+            raise RuntimeError("The job queue has been closed")
+        queued_job = ModelMyWatershedQueuedJob(
+            request_endpoint,
+            job_label,
+            payload,
+            priority,
+            None if deadline is None else time.monotonic() + deadline,
+            size_class,
+        )
+        with self._condition:
+            heapq.heappush(
+                self._queue,
+                (
+                    self.priorities[priority],
+                    (
+                        queued_job.deadline
+                        if queued_job.deadline is not None
+                        else float("inf")
+                    ),
+                    next(self._counter),
+                    queued_job,
+                ),
+            )
+            if len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._work, daemon=True)
+                self._workers.append(worker)
+                worker.start()
+            self._condition.notify()
+        return queued_job
+
+    def _finish(self, queued_job: ModelMyWatershedQueuedJob, status: str) -> None:
+        queued_job.status = status
+        queued_job._done_event.set()
+
+    def _work(self) -> None:
+        """Takes jobs from the queue and runs them, until the queue is closed"""
+        while True:
+            with self._condition:
+                while len(self._queue) == 0 and not self._closed:
+                    self._condition.wait()
+                if len(self._queue) == 0:
+                    return
+                _, _, _, queued_job = heapq.heappop(self._queue)
+
+            if queued_job.should_stop():
+                self._finish(
+                    queued_job, "cancelled" if queued_job.cancelled() else "expired"
+                )
+                continue
+
+            # wait for budget, checking now and then if the job is still wanted
+            use_reserve = queued_job.priority == "interactive"
+            while not self.rate_limiter.acquire(use_reserve, timeout=1.0):
+                if queued_job.should_stop():
+                    break
+            if queued_job.should_stop():
+                self._finish(
+                    queued_job, "cancelled" if queued_job.cancelled() else "expired"
+                )
+                continue
+
+            queued_job.status = "running"
+            try:
+                queued_job.job_record = self.mmw_api.run_mmw_job_record(
+                    request_endpoint=queued_job.request_endpoint,
+                    job_label=queued_job.job_label,
+                    payload=queued_job.payload,
+                    size_class=queued_job.size_class,
+                    should_stop=queued_job.should_stop,
+                    # the token has already been taken from the queue's limiter
+                    limit_rate=False,
+                )
+            except Exception as ex:
+                self.queue_logger.warn(
+                    "\tUnexpected exception in {}:\n\t{}".format(
+                        queued_job.job_label, ex
+                    )
+                )
+                self._finish(queued_job, "failed")
+                continue
+
+            queued_job.job_dict = queued_job.job_record.to_job_dict()
+            if queued_job.job_record.state == ModelMyWatershedJobState.CANCELLED:
+                self._finish(
+                    queued_job, "cancelled" if queued_job.cancelled() else "expired"
+                )
+            else:
+                self._finish(
+                    queued_job,
+                    "succeeded" if queued_job.job_record.succeeded else "failed",
+                )
+
+    def close(self, cancel_pending: bool = False) -> None:
+        """Stops the queue once the queued jobs are finished
+
+        Args:
+            cancel_pending (bool, optional): Cancel the jobs that haven't started yet,
+                rather than running them. Defaults to False.
+        """
+        with self._condition:
+            self._closed = True
+            if cancel_pending:
+                for _, _, _, queued_job in self._queue:
+                    queued_job.cancel()
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
@@ -0,0 +1,270 @@
+"""
+A compact record of a ModelMyWatershed job and the states it has been through.
+"""
+#%%
+import enum
+import json
+import logging
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple, Union
+
+if TYPE_CHECKING:
+    from .model_client import ModelMyWatershedJob
+
+module_logger = logging.getLogger(__name__)
+
+
+#%%
+class ModelMyWatershedJobState(enum.IntEnum):
+    NOT_STARTED = 0
+    STARTING = 1
+    RUNNING = 2
+    SUCCEEDED = 3
+    FAILED = 4
+    CANCELLED = 5
+
+
+_ALLOWED_TRANSITIONS: Dict[ModelMyWatershedJobState, List[ModelMyWatershedJobState]] = {
+    ModelMyWatershedJobState.NOT_STARTED: [
+        ModelMyWatershedJobState.STARTING,
+        ModelMyWatershedJobState.CANCELLED,
+    ],
+    ModelMyWatershedJobState.STARTING: [
+        ModelMyWatershedJobState.RUNNING,
+        ModelMyWatershedJobState.FAILED,
+        ModelMyWatershedJobState.CANCELLED,
+    ],
+    ModelMyWatershedJobState.RUNNING: [
+        ModelMyWatershedJobState.SUCCEEDED,
+        ModelMyWatershedJobState.FAILED,
+        ModelMyWatershedJobState.CANCELLED,
+    ],
+    ModelMyWatershedJobState.SUCCEEDED: [],
+    ModelMyWatershedJobState.FAILED: [],
+    ModelMyWatershedJobState.CANCELLED: [],
+}
+
+
+class ModelMyWatershedJobRecord:
+    """The state of a job, with the time of each change of state, the number of
+    requests made for it and the server's id for it.
+
+    The record is the compact form of a job for ledgers and metrics; `to_json` leaves
+    out the payload and responses.  `to_job_dict` and `from_job_dict` convert to and
+    from the `ModelMyWatershedJob` dictionaries used by the rest of the client.
+    """
+
+    __slots__ = (
+        "job_label",
+        "request_host",
+        "request_endpoint",
+        "state",
+        "transitions",
+        "attempts",
+        "job_uuid",
+        "payload",
+        "start_job_response",
+        "result_response",
+        "result_file",
+        "error_response",
+    )
+
+    def __init__(self, job_label: str, request_host: str, request_endpoint: str):
+        self.job_label = job_label
+        self.request_host = request_host
+        self.request_endpoint = request_endpoint
+        self.state = ModelMyWatershedJobState.NOT_STARTED
+        # pairs of the new state and the time it was entered
+        self.transitions: List[Tuple[ModelMyWatershedJobState, float]] = [
+            (self.state, time.time())
+        ]
+        self.attempts = 0
+        self.job_uuid: Union[str, None] = None
+        self.payload: Any = None
+        self.start_job_response: Any = None
+        self.result_response: Any = None
+        # the file a streamed job result was written to, instead of the result response
+        self.result_file: Union[str, None] = None
+        self.error_response: Any = None
+
+    def transition(self, new_state: ModelMyWatershedJobState) -> None:
+        """Moves the job to a new state
+
+        Args:
+            new_state (ModelMyWatershedJobState): The new state
+
+        Raises:
+            ValueError: If the job can't go from its current state to the new one
+        """
+        if new_state not in _ALLOWED_TRANSITIONS[self.state]:
+            raise ValueError(
+                "A job can't go from {} to {}".format(self.state.name, new_state.name)
+            )
+        self.state = new_state
+        self.transitions.append((new_state, time.time()))
+
+    @property
+    def finished(self) -> bool:
+        return len(_ALLOWED_TRANSITIONS[self.state]) == 0
+
+    @property
+    def succeeded(self) -> bool:
+        return self.state == ModelMyWatershedJobState.SUCCEEDED
+
+    @property
+    def duration(self) -> Union[float, None]:
+        """The seconds from the server accepting the job until it finished, or None if
+        it hasn't run.  The time spent waiting for the rate limiter to start the job
+        isn't counted, so that it is the cost of the job alone."""
+        if not self.finished:
+            return None
+        for state, entered_at in self.transitions:
+            if state == ModelMyWatershedJobState.RUNNING:
+                return self.transitions[-1][1] - entered_at
+        return None
+
+    @property
+    def result(self) -> Union[Dict, None]:
+        """The "result" of a successful job, read from its result file if it was
+        streamed to disk"""
+        if not self.succeeded:
+            return None
+        if self.result_file is not None:
+            from .streaming import read_streamed_result
+
+            return read_streamed_result(self.result_file)
+        if self.result_response is None:
+            return None
+        return self.result_response.get("result")
+
+    def to_json(self, metadata: Union[Dict[str, Any], None] = None) -> str:
+        """Serializes the record, without the payload or responses, as compact JSON
+
+        Args:
+            metadata (Union[Dict[str, Any], None], optional): Metadata to add to the
+                record, ie, for the expiration policy of a ledger ("m"). Defaults to
+                None.
+
+        Returns:
+            str: The JSON, ie, for a line of a ledger
+        """
+        compact = {
+            "l": self.job_label,
+            "h": self.request_host,
+            "e": self.request_endpoint,
+            "s": int(self.state),
+            "t": [[int(state), round(at, 3)] for state, at in self.transitions],
+            "a": self.attempts,
+            "u": self.job_uuid,
+        }
+        if metadata is not None:
+            compact["m"] = metadata
+        return json.dumps(compact, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, record_json: Union[str, bytes]) -> "ModelMyWatershedJobRecord":
+        """Reads a record serialized with `to_json`"""
+        compact = json.loads(record_json)
+        job_record = cls(compact["l"], compact["h"], compact["e"])
+        job_record.state = ModelMyWatershedJobState(compact["s"])
+        job_record.transitions = [
+            (ModelMyWatershedJobState(state), at) for state, at in compact["t"]
+        ]
+        job_record.attempts = compact["a"]
+        job_record.job_uuid = compact["u"]
+        return job_record
+
+    def to_job_dict(self) -> "ModelMyWatershedJob":
+        """Creates the `ModelMyWatershedJob` dictionary for the job
+
+        Returns:
+            ModelMyWatershedJob: The job, with the status strings used by the rest of
+                the client
+        """
+        states_entered = [state for state, _ in self.transitions]
+        was_started = ModelMyWatershedJobState.RUNNING in states_entered
+        if was_started:
+            start_job_status = "succeeded"
+        elif ModelMyWatershedJobState.STARTING in states_entered and self.finished:
+            start_job_status = "failed"
+        else:
+            start_job_status = "Not Started"
+
+        if not was_started:
+            job_result_status = "Not Started"
+        elif self.state == ModelMyWatershedJobState.SUCCEEDED:
+            job_result_status = "succeeded"
+        elif self.state == ModelMyWatershedJobState.FAILED:
+            job_result_status = "failed"
+        elif self.state == ModelMyWatershedJobState.CANCELLED:
+            job_result_status = "cancelled"
+        else:
+            job_result_status = "Not Started"
+
+        job_dict: "ModelMyWatershedJob" = {
+            "job_label": self.job_label,
+            "request_host": self.request_host,
+            "request_endpoint": self.request_endpoint,
+            "payload": self.payload,
+            "start_job_status": start_job_status,
+            "job_result_status": job_result_status,
+            "attempts": self.attempts,
+        }
+        if self.start_job_response is not None:
+            job_dict["start_job_response"] = self.start_job_response
+        if self.result_response is not None:
+            job_dict["result_response"] = self.result_response
+        if self.result_file is not None:
+            job_dict["result_file"] = self.result_file
+        if self.error_response is not None:
+            job_dict["error_response"] = self.error_response
+        return job_dict
+
+    @classmethod
+    def from_job_dict(
+        cls, job_dict: "ModelMyWatershedJob"
+    ) -> "ModelMyWatershedJobRecord":
+        """Creates a record from a `ModelMyWatershedJob` dictionary.  The dictionary
+        doesn't keep the time of each state, so they are all set to now.
+
+        Args:
+            job_dict (ModelMyWatershedJob): The job dictionary
+
+        Returns:
+            ModelMyWatershedJobRecord: The record of the job
+        """
+        job_record = cls(
+            job_dict["job_label"],
+            job_dict["request_host"],
+            job_dict["request_endpoint"],
+        )
+        job_record.payload = job_dict.get("payload")
+        job_record.attempts = job_dict.get("attempts", 0)
+        job_record.start_job_response = job_dict.get("start_job_response")
+        job_record.result_response = job_dict.get("result_response")
+        job_record.result_file = job_dict.get("result_file")
+        job_record.error_response = job_dict.get("error_response")
+        if isinstance(job_record.start_job_response, dict):
+            job_record.job_uuid = job_record.start_job_response.get(
+                "job_uuid", job_record.start_job_response.get("job")
+            )
+
+        if job_dict["start_job_status"] == "Not Started":
+            return job_record
+        job_record.transition(ModelMyWatershedJobState.STARTING)
+        if job_dict["start_job_status"] != "succeeded":
+            job_record.transition(ModelMyWatershedJobState.FAILED)
+            return job_record
+        job_record.transition(ModelMyWatershedJobState.RUNNING)
+        if job_dict["job_result_status"] == "succeeded":
+            job_record.transition(ModelMyWatershedJobState.SUCCEEDED)
+        elif job_dict["job_result_status"] == "cancelled":
+            job_record.transition(ModelMyWatershedJobState.CANCELLED)
+        elif job_dict["job_result_status"] != "Not Started":
+            job_record.transition(ModelMyWatershedJobState.FAILED)
+        return job_record
+
+    def __repr__(self) -> str:
+        return "ModelMyWatershedJobRecord({}, {})".format(
+            self.job_label, self.state.name
+        )
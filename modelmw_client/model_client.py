@@ -4,10 +4,16 @@ Created by Sara Geleskie Damiano
 #%%
 import time
 import copy
+import os
 import re
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from typing import Dict, List, TypedDict, Union, Any
+from typing import TYPE_CHECKING, Callable, Dict, List, Tuple, TypedDict, Union, Any
+from urllib.parse import urlsplit
 from typing_extensions import NotRequired
 import collections
 from collections import OrderedDict
@@ -15,13 +21,49 @@ from collections import OrderedDict
 import requests
 from requests import Request, Response, Session
 from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from urllib3.exceptions import HTTPError
 
-import pandas as pd
+# pandas is only imported by the functions that make data frames, so that starting
+# and polling jobs doesn't pay for importing it
+if TYPE_CHECKING:
+    import pandas as pd
 
 import json
 import logging
 
+from .aoi import ModelMyWatershedAOI
+from .cache import ModelMyWatershedResultCache
+from .cache_policy import ModelMyWatershedCachePolicies, ModelMyWatershedCachePolicy
+from .circuit_breaker import (
+    ModelMyWatershedCircuitBreaker,
+    ModelMyWatershedCircuitRetry,
+    ModelMyWatershedCircuitState,
+    ModelMyWatershedHostHealth,
+)
+from .cost_model import ModelMyWatershedCostModel
+from .dump_index import ModelMyWatershedDumpIndex
+from .dump_reader import read_result_key
+from .hosts import ModelMyWatershedHost, ModelMyWatershedHostRouter
+from .job_record import ModelMyWatershedJobRecord, ModelMyWatershedJobState
+from .modifications import (
+    ModelMyWatershedModificationSet,
+    deduplicate_modification_sets,
+)
+from .payload import ModelMyWatershedPayloadTemplate, gzip_payload
+from .rate_limiter import ModelMyWatershedRateLimiter
+from .results import (
+    normalize_analysis_results,
+    normalize_gwlfe_results,
+    normalize_tr55_results,
+)
+from .reclassification import ModelMyWatershedLandCoverReclassifier
+from .streaming import (
+    read_streamed_json,
+    read_streamed_result,
+    stream_response,
+)
+from .subbasins import ModelMyWatershedSubbasinCache, ModelMyWatershedSubbasinGeometry
+
 module_logger = logging.getLogger(__name__)
 
 
@@ -35,7 +77,9 @@ class ModelMyWatershedJob(TypedDict):
     start_job_response: NotRequired[Any]
     job_result_status: str
     result_response: NotRequired[Any]
+    result_file: NotRequired[str]
     error_response: NotRequired[Dict]
+    attempts: NotRequired[int]
 
 
 class ModemMyWatershedLayerOverride(TypedDict):
@@ -44,6 +88,29 @@ class ModemMyWatershedLayerOverride(TypedDict):
 
 
 class ModelMyWatershedAPI:
+    """A client for ModelMyWatershed's analysis, modeling and project API's.
+
+    One client can be shared by the threads of a worker pool, so they all use the same
+    connection pool, caches and request budget:
+
+    - The session is created once, on the first request, and its headers are never
+      changed after that.  The headers that differ between requests (content type,
+      origin, referer and the CSRF token from `login`) are set on each request.
+    - Job starts take a token from the client's rate limiter (or, with several hosts,
+      from the budget of the host they go to), so the threads together stay under the
+      API's limit of requests per minute.  A `ModelMyWatershedJobQueue` takes its
+      tokens from the same limiter, using the reserved ones for interactive jobs.
+    - The result cache, sub-basin cache, dump index, cost model and job ledger each
+      guard their own state with a lock, and write their files atomically or with a
+      single append per line.
+    - `login` can be called while other threads are making requests; requests started
+      before it finishes are sent without the CSRF token.
+
+    Each job, job dictionary and job record belongs to the thread that started it.
+    Changing the client's settings (ie, `save_path` or `mmw_host`) while other threads
+    are using it isn't safe.
+    """
+
     api_logger = module_logger.getChild(__qualname__)
 
     # the ModelMyWatershed page
@@ -87,6 +154,17 @@ class ModelMyWatershedAPI:
     # project endpoint
     project_endpoint: str = old_modeling_endpoint + "projects/"
 
+    # the families of endpoints that get their own circuit breaker on each host, by
+    # the start of their paths; the first match wins
+    endpoint_families: List[Tuple[str, str]] = [
+        ("jobs", api_endpoint + "jobs/"),
+        ("jobs", old_modeling_endpoint + "jobs/"),
+        ("analyze", analyze_endpoint),
+        ("modeling", modeling_endpoint),
+        ("tr55", tr55_endpoint),
+        ("projects", project_endpoint),
+    ]
+
     # NOTE:  These are NLCD layers ONLY!  The Shippensburg 2100 predictions are called
     # from the Drexel-provided API, and are not available as a geoprocessing layer
     # from https://github.com/WikiWatershed/model-my-watershed/blob/develop/src/mmw/js/src/modeling/utils.js
@@ -150,11 +228,37 @@ class ModelMyWatershedAPI:
         "d751713988987e9331980363e24189ced751713988987e9331980363e24189ce"
     )
 
+    # The hashes for an unmodified TR-55 run with the default precipitation
+    tr55_inputmod_hash: str = (
+        "c41c79294c722aac7febf21a5bfc95e7d751713988987e9331980363e24189ce"
+    )
+    modification_hash: str = "d751713988987e9331980363e24189ce"
+
+    # MapShed job ids are only kept by the server for about an hour, so cached MapShed
+    # results are only used for 50 minutes, leaving time to start a GWLF-E job
+    mapshed_job_seconds: float = 3000.0
+
+    # how long to wait after starting a job before first polling for its results
+    first_poll_seconds: float = 3.5
+
+    # look for saved dumps missing from the dump index on the file system too, ie,
+    # dumps copied into the save path by other tools; off, so lookups never stat files
+    check_unindexed_dumps: bool = False
+
+    # JSON request bodies at least this large are gzipped, if gzip is turned on
+    gzip_min_bytes: int = 10240
+
     def __init__(
         self,
         api_key: str,
         save_path: str = None,
         use_staging: bool = False,
+        gzip_requests: bool = False,
+        job_ledger_path: str = None,
+        host_health: ModelMyWatershedHostHealth = None,
+        hosts: List[ModelMyWatershedHost] = None,
+        cache_policies: ModelMyWatershedCachePolicies = None,
+        rate_limiter: ModelMyWatershedRateLimiter = None,
     ):
         """Create a new class for accessing ModelMyWatershed's API's
 
@@ -163,15 +267,141 @@ class ModelMyWatershedAPI:
             api_key (str): Your API key (needed for analysis requests)
             use_staging (bool, optional): Use the staging version of ModelMyWatershed rather than the
                 production website. Defaults to False.
+            gzip_requests (bool, optional): Gzip large JSON request bodies for the API
+                endpoints.  Only turn this on for a host that accepts gzip encoded
+                requests. Defaults to False.
+            job_ledger_path (str, optional): A file to record every finished job in,
+                one json line per job.  Several clients (or processes) can share one
+                ledger. Defaults to None, for no ledger.
+            host_health (ModelMyWatershedHostHealth, optional): The circuit breakers
+                for the hosts, which can be shared by several clients. Defaults to
+                None, for new circuit breakers that open after 5 failures in a row.
+            hosts (List[ModelMyWatershedHost], optional): Several hosts to split the
+                analysis and modeling jobs between, by weight and health, each with its
+                own request budget.  The first is the main host, used for everything
+                else.  Defaults to None, to send everything to the one host picked by
+                `use_staging`.
+            cache_policies (ModelMyWatershedCachePolicies, optional): The expiration
+                policies for the result cache and job ledger. Defaults to None, for
+                `get_default_cache_policies`.
+            rate_limiter (ModelMyWatershedRateLimiter, optional): The limiter for
+                starting jobs, which can be shared by several clients and job queues.
+                Jobs sent to a host with its own request budget use that instead.
+                Defaults to None, for 20 job starts per minute with one start reserved
+                for high-priority jobs.
         """
         # set up instance variables
         self.mmw_host = (
             self.staging_mmw_host if use_staging else self.production_mmw_host
         )
+        if hosts is not None and len(hosts) > 0:
+            self.mmw_host = hosts[0]["mmw_host"]
 
         self.api_key = api_key
         self.save_path = save_path
+        self.gzip_requests = gzip_requests
+        self.job_ledger_path = job_ledger_path
+        self.cost_model = ModelMyWatershedCostModel(
+            save_path + "job_durations.jsonl" if save_path is not None else None
+        )
+        self._job_ledger_lock = threading.Lock()
+        self.rate_limiter = (
+            rate_limiter
+            if rate_limiter is not None
+            else ModelMyWatershedRateLimiter()
+        )
+        self.host_health = (
+            host_health if host_health is not None else ModelMyWatershedHostHealth()
+        )
+        self.host_router = (
+            ModelMyWatershedHostRouter(hosts, self.host_health)
+            if hosts is not None and len(hosts) > 0
+            else None
+        )
+        # the index of saved dumps is only read on the first lookup or write
+        self.dump_index = (
+            ModelMyWatershedDumpIndex(save_path) if save_path is not None else None
+        )
+        self.cache_policies = (
+            cache_policies
+            if cache_policies is not None
+            else self.get_default_cache_policies()
+        )
+        self.result_cache = ModelMyWatershedResultCache(
+            save_path + "result_cache/" if save_path is not None else None,
+            policies=self.cache_policies,
+        )
+        self.subbasin_cache = ModelMyWatershedSubbasinCache(
+            save_path + "subbasin_cache/" if save_path is not None else None
+        )
+
+        # the session is created on the first request
+        self._mmw_session: Union[Session, None] = None
+        self._session_lock = threading.Lock()
+        # the CSRF token from logging in, added to the headers of each request
+        self._csrf_token: Union[str, None] = None
+        self._login_lock = threading.Lock()
+        self._land_cover_reclassifier: Union[
+            ModelMyWatershedLandCoverReclassifier, None
+        ] = None
+
+    @property
+    def mmw_session(self) -> Session:
+        """The requests session for ModelMyWatershed, created on first use"""
+        if self._mmw_session is None:
+            with self._session_lock:
+                if self._mmw_session is None:
+                    self._mmw_session = self._create_session()
+        return self._mmw_session
+
+    @property
+    def land_cover_reclassifier(self) -> ModelMyWatershedLandCoverReclassifier:
+        """The NLCD to MapShed land cover reclassifier, made from `nlcd_to_mapshed`
+        and `mapshed_to_area_id` on first use"""
+        if self._land_cover_reclassifier is None:
+            self._land_cover_reclassifier = ModelMyWatershedLandCoverReclassifier(
+                self.nlcd_to_mapshed, self.mapshed_to_area_id
+            )
+        return self._land_cover_reclassifier
+
+    def get_default_cache_policies(self) -> ModelMyWatershedCachePolicies:
+        """Creates the default expiration policies for cached results:
+
+        - Land analyses expire when the version of their land use layer changes.  The
+          versions start as the layer names in `land_use_layers`; when a layer is
+          updated on the server, set its new version with
+          `cache_policies.set_layer_version`.
+        - MapShed (GWLF-E and sub-basin prepare) results expire after
+          `mapshed_job_seconds`, because GWLF-E needs a MapShed job id the server still
+          has.
+        - Everything else, ie, geometry and model runs, never expires.
 
+        Returns:
+            ModelMyWatershedCachePolicies: The policies
+        """
+        return ModelMyWatershedCachePolicies(
+            [
+                ModelMyWatershedCachePolicy(
+                    self.analyze_endpoint + "land/", layer_versioned=True
+                ),
+                ModelMyWatershedCachePolicy(
+                    self.gwlfe_prepare_endpoint,
+                    max_age_seconds=self.mapshed_job_seconds,
+                ),
+                ModelMyWatershedCachePolicy(
+                    self.subbasin_prepare_endpoint,
+                    max_age_seconds=self.mapshed_job_seconds,
+                ),
+            ],
+            layer_versions=self.land_use_layers,
+        )
+
+    def _create_session(self) -> Session:
+        """Creates a requests session with timeouts, retries and the default headers
+
+        Returns:
+            Session: The new session
+        """
         # TODO(SRGDamia1): Find out the max response time from Terence
         DEFAULT_TIMEOUT = 30  # seconds
 
@@ -191,23 +421,26 @@ class ModelMyWatershedAPI:
                     kwargs["timeout"] = self.timeout
                 return super().send(request, **kwargs)
 
-        retry_strategy = Retry(
+        # the retries stop early if the circuit for the host opens
+        retry_strategy = ModelMyWatershedCircuitRetry(
             total=5,
             backoff_factor=1,
             status_forcelist=[413, 429, 500, 502, 503, 504],
             method_whitelist=["HEAD", "GET", "PUT", "DELETE", "OPTIONS", "TRACE"],
+            get_breaker=self._get_circuit_breaker,
         )
         adapter = TimeoutHTTPAdapter(max_retries=retry_strategy)
         # create a request session
-        self.mmw_session = Session()
-        self.mmw_session.verify = True
+        mmw_session = Session()
+        mmw_session.verify = True
         # mount the session for all requests, attaching the timeout/retry adapter
-        self.mmw_session.mount("https://", adapter)
-        self.mmw_session.mount("http://", adapter)
+        mmw_session.mount("https://", adapter)
+        mmw_session.mount("http://", adapter)
 
-        self.mmw_session.headers.update(
+        # the Host header comes from the url of each request, and the Origin and
+        # Referer are set for each request by `_get_request_headers`
+        mmw_session.headers.update(
             {
-                "Host": "staging.modelmywatershed.org",
                 "Authorization": "Token " + self.api_key,
                 "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:85.0) Gecko/20100101 Firefox/85.0",
                 "Accept": "*/*",
@@ -216,10 +449,9 @@ class ModelMyWatershedAPI:
                 "Accept-Language": "en-US,en;q=0.5",
                 "DNT": "1",
                 "Upgrade-Insecure-Requests": "1",
-                "Origin": "https://staging.modelmywatershed.org",
-                "Referer": "{}/".format(self.mmw_host),
             }
         )
+        return mmw_session
 
     def _print_headers(self, headers: Dict) -> str:
         """Helper function for tracing errors in requests - prints out the header dictionary
@@ -306,19 +538,19 @@ class ModelMyWatershedAPI:
         login_page = "{}/user/login".format(self.mmw_host)
 
         try:
-            # log in
-            self.mmw_session.post(
-                login_page,
-                data=auth_payload,
-                headers={
-                    "Referer": self.mmw_host,
-                    "Pragma": "no-cache",
-                    "Cache-Control": "no-cache",
-                },
-            )
-            self.mmw_session.headers.update(
-                {"X-CSRFToken": self.mmw_session.cookies["csrftoken"]}
-            )
+            # log in; the token is kept for the request headers rather than put in the
+            # session's headers, which other threads are reading
+            with self._login_lock:
+                self.mmw_session.post(
+                    login_page,
+                    data=auth_payload,
+                    headers={
+                        "Referer": self.mmw_host,
+                        "Pragma": "no-cache",
+                        "Cache-Control": "no-cache",
+                    },
+                )
+                self._csrf_token = self.mmw_session.cookies["csrftoken"]
         except Exception as ex:
             self.api_logger.warn("Failed to log in: {}".format(ex))
             return False
@@ -326,33 +558,48 @@ class ModelMyWatershedAPI:
         # self.api_logger.debug("\nSession cookies: {}".format(self.mmw_session.cookies))
         return True
 
-    def _set_request_headers(self, request_endpoint: str) -> None:
-        """Adds the right referer and datatype headers to a request
+    def _get_request_headers(
+        self, request_endpoint: str, request_host: Union[str, None] = None
+    ) -> Dict[str, str]:
+        """Gets the right origin, referer, datatype and CSRF token headers for a
+        request.  Each call returns a new dictionary, which the caller can add to.
 
         Args:
             request_endpoint (str): The endpoint for the request
+            request_host (Union[str, None], optional): The host the request is going
+                to. Defaults to None, for the main host.
+
+        Returns:
+            Dict[str, str]: The headers to add to the request
         """
+        if request_host is None:
+            request_host = self.mmw_host
 
         if self.project_endpoint in request_endpoint:
             headers = {
                 "Content-Type": "application/json",
-                "Referer": "https://staging.modelmywatershed.org/project/",
+                "Referer": "{}/project/".format(request_host),
                 "X-Requested-With": "XMLHttpRequest",
             }
         elif self.old_modeling_endpoint in request_endpoint:
             headers = {
                 "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
-                "Referer": "https://staging.modelmywatershed.org/project/",
+                "Referer": "{}/project/".format(request_host),
                 "X-Requested-With": "XMLHttpRequest",
             }
         else:
             headers = {
                 "Content-Type": "application/json",
-                "Referer": "https://staging.modelmywatershed.org/analyze",
+                "Referer": "{}/analyze".format(request_host),
                 "X-Requested-With": "XMLHttpRequest",
             }
+        headers["Origin"] = request_host
+        # the login is only for the main host
+        csrf_token = self._csrf_token
+        if csrf_token is not None and request_host == self.mmw_host:
+            headers["X-CSRFToken"] = csrf_token
 
-        self.mmw_session.headers.update(headers)
+        return headers
 
     def _pprint_endpoint(self, request_endpoint: str) -> None:
         """Prints out the request endpoint in a format usable for a Windows endpoint
@@ -367,8 +614,33 @@ class ModelMyWatershedAPI:
             .strip(" _")
         )
 
+    def _get_circuit_breaker(self, request_url: str) -> ModelMyWatershedCircuitBreaker:
+        """Gets the circuit breaker for the host and endpoint family of a request
+
+        Args:
+            request_url (str): The full url of the request
+
+        Returns:
+            ModelMyWatershedCircuitBreaker: The circuit breaker
+        """
+        split_url = urlsplit(request_url)
+        return self.host_health.get_breaker(
+            split_url.netloc, self._get_endpoint_family(split_url.path)
+        )
+
+    def _get_endpoint_family(self, request_endpoint: str) -> str:
+        """Gets the family of an endpoint (ie, analyze or jobs) for its circuit breaker"""
+        request_endpoint = request_endpoint.lstrip("/")
+        for family, family_endpoint in self.endpoint_families:
+            if request_endpoint.startswith(family_endpoint):
+                return family
+        return "other"
+
     def _make_mmw_request(
-        self, req: Request, required_json_fields: Union[List[str], None] = None
+        self,
+        req: Request,
+        required_json_fields: Union[List[str], None] = None,
+        stream_to: Union[str, None] = None,
     ) -> Dict:
         """Make a request to ModelMW with retries including handeling for throttling.
 
@@ -377,6 +649,11 @@ class ModelMyWatershedAPI:
             required_json_fields (List[str]): A list of fields, at least one of which
                 must be present in the response json.  If none of these fields are
                 present, the request will be retried.
+            stream_to (Union[str, None], optional): A file to stream a successful
+                response body to, as it arrives and still compressed.  Only the small
+                top-level fields of the body are parsed into the response json; the
+                names of the rest are in "skipped_fields". Defaults to None, to read
+                the whole body into memory.
 
         Returns:
             Dict: The response json and details about the response
@@ -385,17 +662,35 @@ class ModelMyWatershedAPI:
         # "prepare" the request, in the session
         prepped = self.mmw_session.prepare_request(req)
         throttle_time = 30.0
+        circuit_breaker = self._get_circuit_breaker(prepped.url)
+        circuit_open = False
 
         attempts = 0
+        n_sent = 0
         req_resp = None
         req_resp_json = None
+        skipped_fields = []
+        stream_info = None
 
         while attempts < 5:
+            # fail fast while the host is down, rather than waiting out every retry
+            if not circuit_breaker.allow_request():
+                self.api_logger.warn(
+                    "\tCircuit for {} is open; not sending the request".format(
+                        circuit_breaker.name
+                    )
+                )
+                circuit_open = True
+                break
+
             # use the session to send the request
             # NOTE:  The http method is already part of the prepared request, so here we just "send"
             try:
-                req_resp = self.mmw_session.send(prepped)
+                n_sent += 1
+                req_resp = self.mmw_session.send(prepped, stream=stream_to is not None)
                 self._print_req_trace(req_resp, logging.DEBUG)
+            # the session's retries have already recorded every try that timed out,
+            # couldn't connect or got an error status with the circuit breaker
             except requests.exceptions.Timeout:
                 self.api_logger.warn("\t***Request timed out!***")
                 attempts += 1
@@ -404,18 +699,46 @@ class ModelMyWatershedAPI:
                 self.api_logger.warn("\tMaximum retries exceeded")
                 attempts = 5
                 break
+            except requests.exceptions.ConnectionError:
+                self.api_logger.warn("\t***Could not connect!***")
+                attempts += 1
+                continue
+            except Exception:
+                circuit_breaker.record_failure()
+                raise
+
+            if req_resp.status_code >= 500:
+                circuit_breaker.record_failure()
+            else:
+                circuit_breaker.record_success()
 
             # make sure we got valid json - all responses from ModelMW - except for DELETE's - should be json, even errors
             try:
-                if prepped.method != "DELETE":
+                if stream_to is not None and req_resp.status_code in [200, 201]:
+                    # write the body to disk as it arrives; parse only its small fields
+                    req_resp_json, skipped_fields, stream_info = stream_response(
+                        req_resp, stream_to
+                    )
+                elif prepped.method != "DELETE":
                     req_resp_json = req_resp.json(object_pairs_hook=OrderedDict)
             except (requests.exceptions.JSONDecodeError, json.JSONDecodeError):
                 self.api_logger.warn(
                     "\t***Proper JSON not returned for ModelMW request!***"
                 )
-                self.api_logger.debug(
-                    "\t***Got {} with text {}!***".format(req_resp, req_resp.text)
+                if stream_to is None:
+                    self.api_logger.debug(
+                        "\t***Got {} with text {}!***".format(req_resp, req_resp.text)
+                    )
+            except (ValueError, zlib.error, HTTPError, OSError) as ex:
+                self.api_logger.warn(
+                    "\t***Could not stream the response to {}!***\n\t{}".format(
+                        stream_to, ex
+                    )
                 )
+                req_resp_json = None
+            finally:
+                if stream_info is not None or stream_to is not None and req_resp.ok:
+                    req_resp.close()
 
             # if we got a positive response code, we have proper json, and it has the required fields, return it
             if (
@@ -443,11 +766,17 @@ class ModelMyWatershedAPI:
                 )
                 or (req_resp.status_code in [204, 404] and prepped.method == "DELETE")
             ):
-                return {
+                # the json was parsed for this response alone, so it needs no copy
+                succeeded_response = {
                     "succeeded": True,
-                    "json_response": copy.deepcopy(req_resp_json),
+                    "json_response": req_resp_json,
                     "error_response": None,
+                    "attempts": n_sent,
                 }
+                if stream_to is not None:
+                    succeeded_response["skipped_fields"] = skipped_fields
+                    succeeded_response["stream_info"] = stream_info
+                return succeeded_response
 
             # If we didn't get a positive response code, or we didn't get proper json,
             # or the expected fields aren't in it
@@ -472,13 +801,10 @@ class ModelMyWatershedAPI:
             req_resp_details = ""
             if (
                 req_resp_json is not None
-                and (
-                    type(req_resp_details) is dict
-                    or type(req_resp_details) is OrderedDict
-                )
-                and "detail" in req_resp_details.keys()
+                and (type(req_resp_json) is dict or type(req_resp_json) is OrderedDict)
+                and "detail" in req_resp_json.keys()
             ):
-                req_resp_details = req_resp_details["detail"]
+                req_resp_details = str(req_resp_json["detail"])
             if "throttled" in req_resp_details:
                 search_pat = "Expected available in (?P<throttle_time>[\d\.]+) seconds."
                 throttle_match = re.search(search_pat, req_resp_details)
@@ -494,7 +820,10 @@ class ModelMyWatershedAPI:
                 attempts = 5
                 break
 
-            if attempts < 4:
+            if (
+                attempts < 4
+                and circuit_breaker.state != ModelMyWatershedCircuitState.OPEN
+            ):
                 self.api_logger.debug("\tretrying in {}s...".format(throttle_time))
                 time.sleep(throttle_time)
 
@@ -504,40 +833,92 @@ class ModelMyWatershedAPI:
         self.api_logger.error("\t***ERROR IN ModelMW REQUEST***")
         if req_resp is not None:
             self._print_req_trace(req_resp, logging.ERROR)
+        # never hand back the response object itself; it can't be saved or serialized
+        if req_resp_json is not None:
+            error_response = req_resp_json
+        elif req_resp is not None:
+            error_response = {
+                "status_code": req_resp.status_code,
+                "reason": req_resp.reason,
+                "url": req_resp.url,
+                "text": req_resp.text,
+            }
+        elif circuit_open:
+            error_response = {
+                "detail": "Circuit for {} is open; try again in {:.0f}s".format(
+                    circuit_breaker.name, circuit_breaker.seconds_until_retry()
+                ),
+                "circuit_open": True,
+            }
+        else:
+            error_response = {
+                "detail": "No response from {}".format(prepped.url),
+                "no_response": True,
+            }
         return {
-            "succeeded": True,
+            "succeeded": False,
             "json_response": None,
-            "error_response": req_resp_json if req_resp_json is not None else req_resp,
+            "error_response": error_response,
+            "attempts": n_sent,
         }
 
     def start_job(
         self,
         request_endpoint: str,
         job_label: str,
-        payload: Dict = None,
+        payload: Union[Dict, bytes] = None,
+        limit_rate: bool = True,
     ) -> ModelMyWatershedJob:
         """Starts an analysis or modeling job
 
         Args:
             request_endpoint (str): The endpoint for the request
-            payload (Dict): The payload going to the request.
-                Either a JSON serializable dictionary or pre-formatted form data.
+            payload (Union[Dict, bytes]): The payload going to the request.
+                Either a JSON serializable dictionary, already serialized JSON bytes,
+                or pre-formatted form data.
             job_label (str): A label to use to save the output files
+            limit_rate (bool, optional): Wait for a token from the client's rate
+                limiter before starting the job.  Only turn this off for callers that
+                have already taken a token, ie, a job queue. Defaults to True.
 
         Returns:
             ModelMyWatershedJob: A typed dictionary with the job inputs and output
         """
+        # with several hosts, the api jobs are split between them; the older modeling
+        # endpoints need the logged in session and projects of the main host
+        use_router = (
+            self.host_router is not None and self.api_endpoint in request_endpoint
+        )
+        request_host = self.mmw_host
+        if use_router:
+            request_host = self.host_router.choose_host(
+                self._get_endpoint_family(request_endpoint)
+            )
+            if request_host is None:
+                # every host is down; let the main host's circuit fail the job
+                request_host = self.mmw_host
+        if limit_rate and (
+            not use_router or self.host_router.rate_limiters.get(request_host) is None
+        ):
+            # the router has already taken a request from the budget of hosts that
+            # have one
+            self.rate_limiter.acquire()
+
         job_dict: ModelMyWatershedJob = {
             "job_label": job_label,
-            "request_host": self.mmw_host,
+            "request_host": request_host,
             "request_endpoint": request_endpoint,
-            "payload": payload,
+            "payload": payload.decode("utf-8")
+            if isinstance(payload, bytes)
+            else payload,
             "start_job_status": "Not Started",
             "job_result_status": "Not Started",
         }
 
-        self._set_request_headers(request_endpoint)
-        if self.api_endpoint in request_endpoint:
+        if self.api_endpoint in request_endpoint and isinstance(payload, bytes):
+            # the json has already been serialized, send it as is
+            json_data = None
+        elif self.api_endpoint in request_endpoint:
             # the api endpoint expects json, expected to be dumped from a dictionary
             json_data = payload
             payload = None
@@ -548,15 +929,56 @@ class ModelMyWatershedAPI:
             payload = payload
             json_data = None
 
-        outgoing_request: Request = Request(
-            "POST",
-            "{}/{}".format(self.mmw_host, request_endpoint),
-            data=payload,
-            json=json_data,
-        )
-        start_job_req: Dict = self._make_mmw_request(
-            outgoing_request, ["job", "job_uuid"]
-        )
+        gzip_headers = {}
+        if self.gzip_requests and self.api_endpoint in request_endpoint:
+            if json_data is not None:
+                payload = json.dumps(json_data).encode("utf-8")
+                json_data = None
+            if payload is not None and len(payload) >= self.gzip_min_bytes:
+                payload = gzip_payload(payload)
+                gzip_headers["Content-Encoding"] = "gzip"
+
+        tried_hosts = []
+        job_dict["attempts"] = 0
+        while True:
+            outgoing_request: Request = Request(
+                "POST",
+                "{}/{}".format(request_host, request_endpoint),
+                data=payload,
+                json=json_data,
+                headers={
+                    **self._get_request_headers(request_endpoint, request_host),
+                    **gzip_headers,
+                },
+            )
+            start_job_req: Dict = self._make_mmw_request(
+                outgoing_request, ["job", "job_uuid"]
+            )
+            job_dict["attempts"] += start_job_req["attempts"]
+            job_dict["request_host"] = request_host
+
+            # fail over to another host if this one didn't answer
+            error_response = start_job_req["error_response"]
+            if (
+                not use_router
+                or start_job_req["succeeded"]
+                or not isinstance(error_response, dict)
+                or not (
+                    error_response.get("circuit_open", False)
+                    or error_response.get("no_response", False)
+                )
+            ):
+                break
+            tried_hosts.append(request_host)
+            next_host = self.host_router.choose_host(
+                self._get_endpoint_family(request_endpoint), exclude=tried_hosts
+            )
+            if next_host is None:
+                break
+            self.api_logger.warn(
+                "\tNo answer from {}; trying {}".format(request_host, next_host)
+            )
+            request_host = next_host
 
         if start_job_req["succeeded"] == True:
             job_dict["start_job_status"] = "succeeded"
@@ -567,12 +989,24 @@ class ModelMyWatershedAPI:
         return job_dict
 
     def get_job_result(
-        self, start_job_dict: ModelMyWatershedJob
+        self,
+        start_job_dict: ModelMyWatershedJob,
+        should_stop: Union[Callable[[], bool], None] = None,
+        stream_results: bool = False,
     ) -> ModelMyWatershedJob:
         """Given a job input, waits for and retrievs the job results
 
         Args:
             start_job_dict (ModelMyWatershedJob): The dictionary with the job input information
+            should_stop (Union[Callable[[], bool], None], optional): A function checked
+                between polls; if it returns True, polling stops and the job result
+                status is "cancelled". Defaults to None.
+            stream_results (bool, optional): Stream the job results to a file in the
+                save path, still compressed, instead of reading them into memory.  Use
+                this for very large results, ie, sub-basin jobs.  The "result_file" of
+                the job is the saved results response, which can be read with
+                `read_streamed_result`, and its "result_response" has only the small
+                fields (status, timestamps, etc). Defaults to False.
 
         Returns:
             ModelMyWatershedJob: A copy of the input dictionary with the job output appended.
@@ -614,23 +1048,66 @@ class ModelMyWatershedAPI:
 
         finished_job_dict = copy.deepcopy(start_job_dict)
 
-        self._set_request_headers(start_job_dict["request_endpoint"])
+        # the results are only on the host that ran the job
+        request_host = start_job_dict.get("request_host", self.mmw_host)
         if self.api_endpoint in start_job_dict["request_endpoint"]:
             job_endpoint = "{}/{}jobs/{}/".format(
-                self.mmw_host, self.api_endpoint, job_id
+                request_host, self.api_endpoint, job_id
             )
         elif self.old_modeling_endpoint in start_job_dict["request_endpoint"]:
             job_endpoint = "{}/{}jobs/{}/".format(
-                self.mmw_host, self.old_modeling_endpoint, job_id
+                request_host, self.old_modeling_endpoint, job_id
+            )
+
+        job_results_headers = self._get_request_headers(
+            start_job_dict["request_endpoint"], request_host
+        )
+        stream_to = None
+        if stream_results:
+            if self.save_path is None:
+                raise ValueError("A save path is needed to stream job results")
+            # only ask for compression that can be decompressed without extra packages
+            job_results_headers["Accept-Encoding"] = "gzip"
+            Path(self.save_path).mkdir(parents=True, exist_ok=True)
+            fd, stream_to = tempfile.mkstemp(
+                dir=self.save_path, prefix=".{}.".format(job_id), suffix=".tmp"
+            )
+            os.close(fd)
+        job_results_req = Request("GET", job_endpoint, headers=job_results_headers)
+        try:
+            finished_job_dict = self._poll_job_result(
+                start_job_dict,
+                finished_job_dict,
+                job_results_req,
+                should_stop,
+                stream_to,
             )
+        finally:
+            if stream_to is not None and Path(stream_to).is_file():
+                os.remove(stream_to)
+        return finished_job_dict
 
-        job_results_req = Request("GET", job_endpoint)
+    def _poll_job_result(
+        self,
+        start_job_dict: ModelMyWatershedJob,
+        finished_job_dict: ModelMyWatershedJob,
+        job_results_req: Request,
+        should_stop: Union[Callable[[], bool], None],
+        stream_to: Union[str, None],
+    ) -> ModelMyWatershedJob:
+        """Polls for the results of a started job until it finishes; see
+        `get_job_result`"""
         job_results_json = {}
 
         is_finished = False
         while is_finished == False:
-            job_results_resp = self._make_mmw_request(job_results_req, ["status"])
+            job_results_resp = self._make_mmw_request(
+                job_results_req, ["status"], stream_to=stream_to
+            )
             job_results_json = job_results_resp["json_response"]
+            finished_job_dict["attempts"] = (
+                finished_job_dict.get("attempts", 0) + job_results_resp["attempts"]
+            )
 
             if job_results_resp["succeeded"] == False:
                 finished_job_dict["error_response"] = job_results_resp["error_response"]
@@ -655,18 +1132,46 @@ class ModelMyWatershedAPI:
                 self.api_logger.error(
                     "\t***ERROR GETTING JOB RESULTS***\n\t{}".format(job_results_resp)
                 )
-                finished_job_dict["error_response"] = job_results_resp.text
+                finished_job_dict["error_response"] = job_results_resp["error_response"]
                 finished_job_dict["job_result_status"] = "failed"
                 return finished_job_dict
 
             is_finished = job_results_json["status"] == "complete"
             if not is_finished:
+                if should_stop is not None and should_stop():
+                    self.api_logger.info(
+                        "\tStopped waiting for {} results for {}".format(
+                            self._pprint_endpoint(start_job_dict["request_endpoint"]),
+                            start_job_dict["job_label"],
+                        )
+                    )
+                    finished_job_dict["job_result_status"] = "cancelled"
+                    return finished_job_dict
                 self.api_logger.debug("ModelMW job has not yet finished.")
                 time.sleep(0.5)
 
-        if "result" in job_results_json.keys() and job_results_json["result"] != "":
+        if (
+            "result" in job_results_json.keys() and job_results_json["result"] != ""
+        ) or "result" in job_results_resp.get("skipped_fields", []):
             finished_job_dict["result_response"] = job_results_json
             finished_job_dict["job_result_status"] = "succeeded"
+            if stream_to is not None:
+                # keep the streamed response, still compressed, next to the dump
+                result_file = "{}_result.json{}".format(
+                    self.get_dump_filename(
+                        start_job_dict["request_endpoint"], start_job_dict["job_label"]
+                    )[: -len(".json")],
+                    ".gz"
+                    if job_results_resp["stream_info"]["content_encoding"] == "gzip"
+                    else "",
+                )
+                self.dump_index.add_file(
+                    stream_to,
+                    result_file,
+                    job_results_resp["stream_info"]["size"],
+                    job_results_resp["stream_info"]["sha256"],
+                )
+                finished_job_dict["result_file"] = result_file
             self.api_logger.info(
                 "\tGot {} results for {}".format(
                     self._pprint_endpoint(start_job_dict["request_endpoint"]),
@@ -688,6 +1193,9 @@ class ModelMyWatershedAPI:
         request_endpoint: str,
         job_label: str,
         payload: Union[Dict, None] = None,
+        size_class: Union[str, None] = None,
+        should_stop: Union[Callable[[], bool], None] = None,
+        stream_results: bool = False,
     ) -> ModelMyWatershedJob:
         """Starts a ModelMyWatershed job and waits for and returns the results
 
@@ -696,15 +1204,79 @@ class ModelMyWatershedAPI:
             payload (Dict): The payload going to the request.
                 Either a JSON serializable dictionary or pre-formatted form data.
             job_label (str): A label to use to save the output files
+            size_class (Union[str, None], optional): The size class of the job's AOI,
+                from `ModelMyWatershedAOI.size_class`.  If given, the job's duration
+                is recorded in the cost model. Defaults to None.
+            should_stop (Union[Callable[[], bool], None], optional): A function checked
+                while waiting for the results; if it returns True, the job is abandoned
+                with a "cancelled" result status. Defaults to None.
+            stream_results (bool, optional): Stream the results to a "result_file"
+                instead of reading them into memory; see `get_job_result`.
+                Defaults to False.
 
         Returns:
             ModelMyWatershedJob: The job request and result
         """
+        return self.run_mmw_job_record(
+            request_endpoint=request_endpoint,
+            job_label=job_label,
+            payload=payload,
+            size_class=size_class,
+            should_stop=should_stop,
+            stream_results=stream_results,
+        ).to_job_dict()
+
+    def run_mmw_job_record(
+        self,
+        request_endpoint: str,
+        job_label: str,
+        payload: Union[Dict, None] = None,
+        size_class: Union[str, None] = None,
+        should_stop: Union[Callable[[], bool], None] = None,
+        stream_results: bool = False,
+        limit_rate: bool = True,
+    ) -> ModelMyWatershedJobRecord:
+        """Starts a ModelMyWatershed job and waits for the results, the same as
+        `run_mmw_job`, but returns a record of the job's states instead of a job
+        dictionary.
+
+        Args:
+            request_endpoint (str): The endpoint for the request
+            job_label (str): A label to use to save the output files
+            payload (Dict): The payload going to the request.
+                Either a JSON serializable dictionary or pre-formatted form data.
+            size_class (Union[str, None], optional): The size class of the job's AOI,
+                for the cost model. Defaults to None.
+            should_stop (Union[Callable[[], bool], None], optional): A function checked
+                before starting and while waiting for the results; if it returns True,
+                the job is cancelled. Defaults to None.
+            stream_results (bool, optional): Stream the results to a "result_file"
+                instead of reading them into memory; see `get_job_result`.
+                Defaults to False.
+            limit_rate (bool, optional): Wait for a token from the client's rate
+                limiter before starting the job; see `start_job`. Defaults to True.
+
+        Returns:
+            ModelMyWatershedJobRecord: The record of the job, with its responses
+        """
+        job_record = ModelMyWatershedJobRecord(
+            job_label, self.mmw_host, request_endpoint
+        )
+        if should_stop is not None and should_stop():
+            job_record.transition(ModelMyWatershedJobState.CANCELLED)
+            return job_record
+
+        job_record.transition(ModelMyWatershedJobState.STARTING)
         start_job_dict = self.start_job(
             request_endpoint=request_endpoint,
             payload=payload,
             job_label=job_label,
+            limit_rate=limit_rate,
         )
+        job_record.payload = start_job_dict["payload"]
+        job_record.request_host = start_job_dict["request_host"]
+        job_record.attempts = start_job_dict.get("attempts", 0)
+        job_record.start_job_response = start_job_dict.get("start_job_response")
 
         if start_job_dict["start_job_status"] != "succeeded":
             self.api_logger.warn(
@@ -713,13 +1285,95 @@ class ModelMyWatershedAPI:
                     job_label,
                 )
             )
-            return copy.deepcopy(start_job_dict)
+            job_record.error_response = job_record.start_job_response
+            job_record.transition(ModelMyWatershedJobState.FAILED)
+            self._write_job_ledger(job_record)
+            return job_record
 
-        time.sleep(3.5)  # max of 20 requests per minute!
+        job_record.job_uuid = job_record.start_job_response.get(
+            "job_uuid", job_record.start_job_response.get("job")
+        )
+        job_record.transition(ModelMyWatershedJobState.RUNNING)
 
-        finished_job_dict = copy.deepcopy(self.get_job_result(start_job_dict))
+        time.sleep(self.first_poll_seconds)
 
-        return finished_job_dict
+        finished_job_dict = self.get_job_result(
+            start_job_dict, should_stop=should_stop, stream_results=stream_results
+        )
+        job_record.attempts = finished_job_dict.get("attempts", job_record.attempts)
+        job_record.result_response = finished_job_dict.get("result_response")
+        job_record.result_file = finished_job_dict.get("result_file")
+        job_record.error_response = finished_job_dict.get("error_response")
+        if finished_job_dict["job_result_status"] == "succeeded":
+            job_record.transition(ModelMyWatershedJobState.SUCCEEDED)
+        elif finished_job_dict["job_result_status"] == "cancelled":
+            job_record.transition(ModelMyWatershedJobState.CANCELLED)
+        else:
+            job_record.transition(ModelMyWatershedJobState.FAILED)
+
+        self._write_job_ledger(job_record)
+        if size_class is not None and job_record.succeeded:
+            self.cost_model.record(request_endpoint, size_class, job_record.duration)
+
+        return job_record
+
+    def _write_job_ledger(self, job_record: ModelMyWatershedJobRecord) -> None:
+        """Appends a finished job to the job ledger file"""
+        if self.job_ledger_path is None:
+            return
+        # each job is written with a single append, so processes sharing the ledger
+        # don't interleave their lines
+        with self._job_ledger_lock:
+            # the job has already finished, so a failure here is only logged
+            try:
+                Path(self.job_ledger_path).parent.mkdir(parents=True, exist_ok=True)
+                with open(self.job_ledger_path, "a") as fp:
+                    fp.write(
+                        job_record.to_json(
+                            self.cache_policies.make_metadata(
+                                job_record.request_endpoint
+                            )
+                        )
+                        + "\n"
+                    )
+            except OSError as ex:
+                self.api_logger.warn(
+                    "\tCould not write {} to the job ledger {}:\n\t{}".format(
+                        job_record.job_label, self.job_ledger_path, ex
+                    )
+                )
+
+    def read_job_ledger(
+        self, include_expired: bool = False
+    ) -> List[ModelMyWatershedJobRecord]:
+        """Reads the jobs recorded in the job ledger
+
+        Args:
+            include_expired (bool, optional): Include the jobs that have expired under
+                the cache policies, ie, MapShed jobs whose ids the server has
+                forgotten. Defaults to False.
+
+        Returns:
+            List[ModelMyWatershedJobRecord]: The jobs, in the order they finished
+        """
+        if self.job_ledger_path is None or not os.path.isfile(self.job_ledger_path):
+            return []
+        job_records = []
+        now = time.time()
+        with open(self.job_ledger_path) as fp:
+            for line in fp:
+                try:
+                    compact = json.loads(line)
+                    if not include_expired and self.cache_policies.is_expired(
+                        compact.get("m"), now
+                    ):
+                        continue
+                    job_records.append(ModelMyWatershedJobRecord.from_json(line))
+                except (ValueError, KeyError, TypeError):
+                    self.api_logger.warn(
+                        "\tSkipping unreadable job ledger line {}".format(line)
+                    )
+        return job_records
 
     def create_project(
         self,
@@ -768,8 +1422,6 @@ class ModelMyWatershedAPI:
         """
 
         request_endpoint = self.project_endpoint
-        self._set_request_headers(request_endpoint)
-
         if huc is None and wkaoi is None and area_of_interest is None:
             self.api_logger.error(
                 "\t***Either a HUC code, an WKAoI, or a geojson is required to create a project!***"
@@ -797,7 +1449,10 @@ class ModelMyWatershedAPI:
             payload["layer_overrides"] = layer_overrides
 
         create_project_req: Request = Request(
-            "POST", "{}/{}".format(self.mmw_host, request_endpoint), json=payload
+            "POST",
+            "{}/{}".format(self.mmw_host, request_endpoint),
+            json=payload,
+            headers=self._get_request_headers(request_endpoint),
         )
         create_project_resp = self._make_mmw_request(create_project_req, ["id"])
 
@@ -806,10 +1461,71 @@ class ModelMyWatershedAPI:
 
         return {}
 
+    def update_project(
+        self,
+        project_id: Union[str, int],
+        model_package: str,
+        area_of_interest: Dict,
+        name: str = "Untitled Project",
+        mapshed_job_uuid: Union[str, None] = None,
+        subbasin_mapshed_job_uuid: Union[str, None] = None,
+        layer_overrides: Union[ModemMyWatershedLayerOverride, None] = None,
+    ) -> Dict:
+        """Updates an existing project on ModelMyWatershed, ie, to point it at a new
+        area of interest.  The ModelMW project API only accepts a new area of interest
+        as a geojson shape; HUC codes and WKAoI's are only resolved to a shape when a
+        project is created.
+
+        YOU MUST BE LOGGED IN TO USE THIS FEATURE!
+
+        Args:
+            project_id (Union[str,int]): The project id.
+            model_package (str): The model package to use.
+                Must be either "gwlfe" or "tr-55"
+            area_of_interest (Dict): A geojson dictionary with the shape of the new
+                area of interest for the project.
+            name (str): A name for the project, can be any text
+            mapshed_job_uuid (str): The UUID for the GWLF-E prepare (MapShed) job tied
+                to this project, if applicable.
+            subbasin_mapshed_job_uuid (str): The UUID for the subbasin GWLF-E prepare
+                (MapShed) job tied to this project, if applicable.
+            layer_overrides (ModemMyWatershedLayerOverride): Any layer overrides to
+                use in the project
+
+        Returns:
+            Dict: A dictionary with information about the updated project
+        """
+
+        request_endpoint = self.project_endpoint + "{}".format(project_id)
+        payload = {
+            "name": name,
+            "model_package": model_package,
+            "area_of_interest": area_of_interest,
+        }
+        if mapshed_job_uuid is not None and mapshed_job_uuid != "":
+            payload["mapshed_job_uuid"] = mapshed_job_uuid
+        if subbasin_mapshed_job_uuid is not None and subbasin_mapshed_job_uuid != "":
+            payload["subbasin_mapshed_job_uuid"] = subbasin_mapshed_job_uuid
+        if layer_overrides is not None:
+            payload["layer_overrides"] = layer_overrides
+
+        update_project_req: Request = Request(
+            "PUT",
+            "{}/{}".format(self.mmw_host, request_endpoint),
+            json=payload,
+            headers=self._get_request_headers(request_endpoint),
+        )
+        update_project_resp = self._make_mmw_request(update_project_req, ["id"])
+
+        if update_project_resp["succeeded"] == True:
+            return update_project_resp["json_response"]
+
+        return {}
+
     def delete_project(
         self,
         project_id: Union[str, int],
-    ) -> None:
+    ) -> bool:
         """Deletes a ModelMW project.  If you're using the API to get information based
         on API-created skeleton projects, you probably want to be able to delete the
         project so as not to clutter up your user data with zillions of project
@@ -819,16 +1535,17 @@ class ModelMyWatershedAPI:
                 project_id (Union[str,int]): The project id.
 
         Returns:
-            None
+            bool: True if the project was deleted (or did not exist)
         """
 
         request_endpoint = self.project_endpoint + "{}".format(project_id)
-        self._set_request_headers(request_endpoint)
-
         delete_project_req: Request = Request(
-            "DELETE", "{}/{}".format(self.mmw_host, request_endpoint)
+            "DELETE",
+            "{}/{}".format(self.mmw_host, request_endpoint),
+            headers=self._get_request_headers(request_endpoint),
         )
-        self._make_mmw_request(delete_project_req)
+        delete_project_resp = self._make_mmw_request(delete_project_req)
+        return delete_project_resp["succeeded"]
 
     def get_project_weather(
         self, project_id: Union[str, int], weather_layer: str
@@ -852,10 +1569,10 @@ class ModelMyWatershedAPI:
         request_endpoint = self.project_endpoint + "{}/weather/{}".format(
             project_id, weather_layer
         )
-        self._set_request_headers(request_endpoint)
-
         weather_data_req = Request(
-            "GET", "{}/{}".format(self.mmw_host, request_endpoint)
+            "GET",
+            "{}/{}".format(self.mmw_host, request_endpoint),
+            headers=self._get_request_headers(request_endpoint),
         )
         weather_data_resp = self._make_mmw_request(
             weather_data_req, ["output"]  # "WxYrBeg"
@@ -889,15 +1606,63 @@ class ModelMyWatershedAPI:
             list: A list of geojsons for the HUC-12's in the subbasins contained in the MapShed job
         """
 
-        request_endpoint = self.old_modeling_endpoint + "subbasins"
-        self._set_request_headers(request_endpoint)
+        # HUC-12 boundaries don't change, so a job whose sub-basins are all cached
+        # doesn't need a request
+        cached_geometries = self.subbasin_cache.get_job(mapshed_job_uuid)
+        if cached_geometries is not None:
+            self.api_logger.info(
+                "\tRead information about {} HUC-12 subbasins from the cache".format(
+                    len(cached_geometries)
+                )
+            )
+            return [geometry.to_detail() for geometry in cached_geometries.values()]
 
+        request_endpoint = self.old_modeling_endpoint + "subbasins"
         params = {"mapshed_job_uuid": mapshed_job_uuid}
+        subbasin_detail_headers = self._get_request_headers(request_endpoint)
+
+        # with a save path, the (often tens of MB of) geojsons are streamed to a file
+        # there and parsed from it, rather than held in memory as the response body
+        stream_to = None
+        if self.save_path is not None:
+            subbasin_detail_headers["Accept-Encoding"] = "gzip"
+            Path(self.save_path).mkdir(parents=True, exist_ok=True)
+            fd, stream_to = tempfile.mkstemp(
+                dir=self.save_path,
+                prefix=".{}.".format(mapshed_job_uuid),
+                suffix=".tmp",
+            )
+            os.close(fd)
 
         subbasin_detail_req = Request(
-            "POST", "{}/{}".format(self.mmw_host, request_endpoint), params=params
+            "POST",
+            "{}/{}".format(self.mmw_host, request_endpoint),
+            params=params,
+            headers=subbasin_detail_headers,
         )
-        subbasin_detail_resp = self._make_mmw_request(subbasin_detail_req)
+        try:
+            subbasin_detail_resp = self._make_mmw_request(
+                subbasin_detail_req, stream_to=stream_to
+            )
+            if stream_to is not None and subbasin_detail_resp["succeeded"]:
+                stream_info = subbasin_detail_resp["stream_info"]
+                subbasin_filename = "{}{}_subbasin_geojsons.json{}".format(
+                    self.save_path,
+                    mapshed_job_uuid,
+                    ".gz" if stream_info["content_encoding"] == "gzip" else "",
+                )
+                self.dump_index.add_file(
+                    stream_to,
+                    subbasin_filename,
+                    stream_info["size"],
+                    stream_info["sha256"],
+                )
+                subbasin_detail_resp["json_response"] = read_streamed_json(
+                    subbasin_filename
+                )
+        finally:
+            if stream_to is not None and Path(stream_to).is_file():
+                os.remove(stream_to)
         subbasin_detail_resp_json = subbasin_detail_resp["json_response"]
 
         if (
@@ -916,138 +1681,168 @@ class ModelMyWatershedAPI:
                     len(subbasin_detail_resp_json)
                 )
             )
-
-            # dump out the subbasins
-            # if self.save_path is not None:
-            #     with open(
-            #         self.save_path + mapshed_job_uuid + "_subbasin_geojsons.json",
-            #         "w",
-            #     ) as fp:
-            #         json.dump(subbasin_detail_resp_json, fp, indent=2)
+            try:
+                self.subbasin_cache.put_job(
+                    mapshed_job_uuid,
+                    [
+                        ModelMyWatershedSubbasinGeometry.from_detail(subbasin_detail)
+                        for subbasin_detail in subbasin_detail_resp_json
+                    ],
+                )
+            except (KeyError, TypeError, ValueError) as ex:
+                self.api_logger.warn(
+                    "\tCould not cache the subbasin geometries:\n\t{}".format(ex)
+                )
             return subbasin_detail_resp_json
 
         self.api_logger.error("\t***ERROR GETTING SUB-BASIN DETAILS***")
         return []
 
+    def get_subbasin_geometries(
+        self,
+        mapshed_job_uuid: Union[str, None] = None,
+        huc12s: Union[List[str], None] = None,
+    ) -> Dict[str, ModelMyWatershedSubbasinGeometry]:
+        """Gets the HUC-12 subbasin boundaries as packed coordinate arrays, from the
+        subbasin cache if possible.  Unlike `get_subbasin_details`, nothing is built
+        into GeoJSON dictionaries for a cached subbasin.
+
+        Args:
+            mapshed_job_uuid (Union[str, None], optional): The UUID for the SUBBASIN
+                GWLF-E prepare (MapShed) job, used to fetch any subbasins that aren't
+                cached. Defaults to None.
+            huc12s (Union[List[str], None], optional): The HUC-12 codes of the
+                subbasins, if known.  If they are all cached, no request is made, even
+                for a job that hasn't been seen before. Defaults to None, for every
+                subbasin of the job.
+
+        Returns:
+            Dict[str, ModelMyWatershedSubbasinGeometry]: The geometries by HUC-12 code,
+                or an empty dictionary if they couldn't be fetched
+        """
+        if huc12s is not None:
+            cached_geometries = self.subbasin_cache.get_many(huc12s)
+        elif mapshed_job_uuid is not None:
+            cached_geometries = self.subbasin_cache.get_job(mapshed_job_uuid)
+        else:
+            raise ValueError("Either a MapShed job UUID or HUC-12 codes are needed")
+        if cached_geometries is not None:
+            return cached_geometries
+        if mapshed_job_uuid is None:
+            self.api_logger.error(
+                "\t***SUB-BASINS NOT CACHED AND NO JOB TO FETCH THEM FROM***"
+            )
+            return {}
+
+        # fetching the job's subbasins adds them all to the cache
+        self.get_subbasin_details(mapshed_job_uuid)
+        job_geometries = self.subbasin_cache.get_job(mapshed_job_uuid)
+        if job_geometries is None:
+            return {}
+        if huc12s is None:
+            return job_geometries
+        return {
+            huc12: job_geometries[huc12] for huc12 in huc12s if huc12 in job_geometries
+        }
+
     def run_batch_analysis(
         self, list_of_aois: List, analysis_endpoint: str
-    ) -> pd.DataFrame:
+    ) -> "pd.DataFrame":
         """Given a list of areas of interest (AOIs), runs all of them for the same analysis endpoint.  Depending on the number of site in the list, this may take a very long time to return.
 
         Args:
-            list_of_aois (List): A list of AOI's.  They can be strings or geojsons.
+            list_of_aois (List): A list of AOI's.  They can be strings, geojsons or
+                ModelMyWatershedAOI's.
             analysis_endpoint (str): The analysis endpoint to use.
 
         Returns:
             pd.DataFrame: A pandas data frame with the results from all of the runs.
         """
-        run_frames = []
+        analysis_results = []
         run_number: int = 1
         for aoi in list_of_aois:
-            # TODO(SRGDamia1): validate strings
-            # if it's a string with underscores, we're assuming it's a WKAoI from the hidden well-known area of interest table
-            # this is not expected, but we'll support it
-            if isinstance(aoi, str) and "__" in aoi:
-                job_label = aoi
-                payload = {"wkaoi": aoi}
-            # if it doesn't have underscores, we're assuiming it's a HUC
-            elif isinstance(aoi, str) and (
-                len(aoi) == 8 or len(aoi) == 10 or len(aoi) == 12
-            ):
-                job_label = aoi
-                payload = {"huc": aoi}
-            # if it's not a string, hopefully it's a valid geojson
-            # TODO(SRGDamia1): validate geojson!  Must be a valid single-ringed Multipolygon GeoJSON representation of the shape to analyze
-            # NOTE:  In order to validate geojson, we'd need to add some sort of geo dependency.  I'm not sure if we want to add that.
-            else:
-                if (
-                    isinstance(aoi, Dict)
-                    and "properties" in aoi.keys()
-                    and "name" in aoi["properties"].keys
-                ):
-                    job_label = aoi["properties"]["name"]
-                else:
-                    job_label = "shape_{}".format(run_number)
-                payload = aoi
+            # parse the AOI once - a HUC, a WKAoI or a GeoJSON shape
+            try:
+                mmw_aoi = ModelMyWatershedAOI.from_any(aoi, run_number)
+                mmw_aoi.validate(single_ring=False)
+            except ValueError as ex:
+                self.api_logger.warn("\tSkipping invalid AOI: {}".format(ex))
+                continue
+            job_label = mmw_aoi.job_label
+            payload = mmw_aoi.analysis_payload_json()
 
             try:
                 req_dump = self.run_mmw_job(
                     request_endpoint=analysis_endpoint,
                     job_label=job_label,
                     payload=payload,
+                    size_class=mmw_aoi.size_class(),
                 )
-                res_frame = pd.DataFrame(
-                    copy.deepcopy(
-                        req_dump["result_response"]["result"]["survey"]["categories"]
-                    )
-                )
+                analysis_result = req_dump["result_response"]["result"]
+                if "categories" not in analysis_result["survey"]:
+                    raise KeyError("categories")
             except Exception as ex:
                 self.api_logger.warn("\tUnexpected exception:\n\t{}".format(ex))
                 continue
 
-            res_frame["job_label"] = job_label
-            res_frame["request_endpoint"] = analysis_endpoint
-            run_frames.append(res_frame)
+            analysis_results.append(
+                (
+                    {"job_label": job_label, "request_endpoint": analysis_endpoint},
+                    analysis_result,
+                )
+            )
             run_number += 1
 
-        # join all of the frames together into one frame with the batch results
-        if len(run_frames) > 0:
-            lu_results = pd.concat(run_frames, ignore_index=True)
-            return lu_results
+        # join all of the results together into one frame with the batch results
+        if len(analysis_results) > 0:
+            return normalize_analysis_results(analysis_results)
         return None
 
     def run_batch_gwlfe(
         self, list_of_aois: List, layer_overrides: ModemMyWatershedLayerOverride = None
-    ) -> Dict[str, pd.DataFrame]:
+    ) -> Dict[str, "pd.DataFrame"]:
         """Given a list of areas of interest (AOIs), runs mapshed and GWLF-E on all of them.
 
         Args:
-            list_of_aois (List): A list of AOI's.  They can be strings or geojsons.
+            list_of_aois (List): A list of AOI's.  They can be strings, geojsons or
+                ModelMyWatershedAOI's.
             layer_overrides (ModemMyWatershedLayerOverride): Any layer overrides to use in the model
 
         Returns:
             Dict[str,pd.DataFrame]: A dictionary of dataframes with the GWLF-E model results.
         """
+        # the MapShed and GWLF-E payloads only differ by AOI and job, so the rest of
+        # each is serialized just once
+        mapshed_template = ModelMyWatershedPayloadTemplate(
+            {"layer_overrides": layer_overrides} if layer_overrides is not None else {}
+        )
+        gwlfe_template = ModelMyWatershedPayloadTemplate(
+            {
+                # NOTE:  The value of the inputmod_hash doesn't really matter here
+                # Internally, the ModelMW site uses the inputmod_hash in scenerios to
+                # determine whether it can use cached results or if it needs to
+                # re-run the job
+                "inputmod_hash": self.inputmod_hash,
+            }
+        )
+
         # empty lists to hold results
         mapshed_z_files = []
-
-        gwlfe_monthlies = []
-        gwlfe_load_summaries = []
-        gwlfe_lu_loads = []
-        gwlfe_metas = []
-        gwlfe_summaries = []
+        gwlfe_results = []
 
         run_number: int = 1
         for aoi in list_of_aois:
-            mapshed_payload = {}
-            if layer_overrides is not None:
-                mapshed_payload["layer_overrides"] = layer_overrides
-
-            # TODO(SRGDamia1): validate strings
-            # if it's a string with underscores, we're assuming it's a WKAoI from the hidden well-known area of interest table
-            # this is not expected, but we'll support it
-            if isinstance(aoi, str) and "__" in aoi:
-                job_label = aoi
-                mapshed_payload["wkaoi"] = aoi
-            # if it doesn't have underscores, we're assuiming it's a HUC
-            elif isinstance(aoi, str) and (
-                len(aoi) == 8 or len(aoi) == 10 or len(aoi) == 12
-            ):
-                job_label = aoi
-                mapshed_payload["huc"] = aoi
-            # if it's not a string, hopefully it's a valid geojson
-            # TODO(SRGDamia1): validate geojson!  Must be a valid single-ringed Multipolygon GeoJSON representation of the shape to analyze
-            # NOTE:  In order to validate geojson, we'd need to add some sort of geo dependency.  I'm not sure if we want to add that.
-            else:
-                if (
-                    isinstance(aoi, Dict)
-                    and "properties" in aoi.keys()
-                    and "name" in aoi["properties"].keys
-                ):
-                    job_label = aoi["properties"]["name"]
-                else:
-                    job_label = "shape_{}".format(run_number)
-                mapshed_payload["area_of_interest"] = aoi
+            # parse the AOI once - a HUC, a WKAoI or a GeoJSON shape
+            try:
+                mmw_aoi = ModelMyWatershedAOI.from_any(aoi, run_number)
+                mmw_aoi.validate(single_ring=False)
+            except ValueError as ex:
+                self.api_logger.warn("\tSkipping invalid AOI: {}".format(ex))
+                continue
+            job_label = mmw_aoi.job_label
+            mapshed_payload = mapshed_template.render(
+                **{mmw_aoi.payload_key: mmw_aoi.json_bytes}
+            )
 
             mapshed_job_id = None
             mapshed_result = None
@@ -1057,6 +1852,7 @@ class ModelMyWatershedAPI:
                 request_endpoint=self.gwlfe_prepare_endpoint,
                 job_label=job_label,
                 payload=mapshed_payload,
+                size_class=mmw_aoi.size_class(),
             )
             if "result_response" in mapshed_job_dict.keys():
                 mapshed_job_id = mapshed_job_dict["start_job_response"]["job_uuid"]
@@ -1070,63 +1866,28 @@ class ModelMyWatershedAPI:
 
                 land_use_modification_set = "[{}]"
 
-                gwlfe_payload = {
-                    # NOTE:  The value of the inputmod_hash doesn't really matter here
-                    # Internally, the ModelMW site uses the inputmod_hash in scenerios to
-                    # determine whether it can use cached results or if it needs to
-                    # re-run the job
-                    "inputmod_hash": self.inputmod_hash,
-                    "modifications": land_use_modification_set,
-                    "job_uuid": mapshed_job_id,
-                }
+                gwlfe_payload = gwlfe_template.render(
+                    modifications=land_use_modification_set,
+                    job_uuid=mapshed_job_id,
+                )
                 gwlfe_job_dict = self.run_mmw_job(
                     request_endpoint=self.gwlfe_run_endpoint,
                     job_label=job_label,
                     payload=gwlfe_payload,
+                    size_class=mmw_aoi.size_class(),
                 )
                 if "result_response" in gwlfe_job_dict.keys():
                     gwlfe_result_raw = gwlfe_job_dict["result_response"]
                     gwlfe_result = copy.deepcopy(gwlfe_result_raw)["result"]
 
             if gwlfe_result is not None:
-                gwlfe_monthly = pd.DataFrame(gwlfe_result.pop("monthly"))
-                gwlfe_monthly["month"] = gwlfe_monthly.index + 1
-                gwlfe_load_summary = pd.DataFrame(gwlfe_result.pop("SummaryLoads"))
-                gwlfe_lu_load = pd.DataFrame(gwlfe_result.pop("Loads"))
-                gwlfe_meta = pd.DataFrame(gwlfe_result.pop("meta"), index=[1])
-                gwlfe_summary = pd.DataFrame(gwlfe_result, index=[1])
-
-                for frame in [
-                    gwlfe_monthly,
-                    gwlfe_load_summary,
-                    gwlfe_lu_load,
-                    gwlfe_meta,
-                    gwlfe_summary,
-                ]:
-                    frame["job_label"] = job_label
-                gwlfe_monthlies.append(gwlfe_monthly)
-                gwlfe_load_summaries.append(gwlfe_load_summary)
-                gwlfe_lu_loads.append(gwlfe_lu_load)
-                gwlfe_metas.append(gwlfe_meta)
-                gwlfe_summaries.append(gwlfe_summary)
+                gwlfe_results.append(({"job_label": job_label}, gwlfe_result))
+
+            run_number += 1
 
         # join various result
-        if len(gwlfe_metas) < 0:
-            gwlfe_results = {}
-            gwlfe_results["gwlfe_monthly"] = pd.concat(
-                gwlfe_monthlies, ignore_index=True
-            )
-            gwlfe_results["gwlfe_load_summaries"] = pd.concat(
-                gwlfe_load_summaries, ignore_index=True
-            )
-            gwlfe_results["gwlfe_lu_loads"] = pd.concat(
-                gwlfe_lu_loads, ignore_index=True
-            )
-            gwlfe_results["gwlfe_metadata"] = pd.concat(gwlfe_metas, ignore_index=True)
-            gwlfe_results["gwlfe_summaries"] = pd.concat(
-                gwlfe_summaries, ignore_index=True
-            )
-            return gwlfe_results
+        if len(gwlfe_results) > 0:
+            return normalize_gwlfe_results(gwlfe_results)
 
         return {
             "gwlfe_monthly": None,
@@ -1136,6 +1897,304 @@ class ModelMyWatershedAPI:
             "gwlfe_summaries": None,
         }
 
+    def _run_cached_job(
+        self,
+        request_endpoint: str,
+        job_label: str,
+        payload: Union[Dict, bytes],
+        cache_key: Union[str, None] = None,
+        size_class: Union[str, None] = None,
+        refresh: bool = False,
+    ) -> Union[Dict, None]:
+        """Runs a job, unless a result for the same inputs is already in the result
+        cache, and returns its result.
+
+        Args:
+            request_endpoint (str): The endpoint for the request
+            job_label (str): A label to use to save the output files
+            payload (Union[Dict, bytes]): The payload going to the request
+            cache_key (Union[str, None], optional): The cache key for the job, if
+                already known. Defaults to the hash of the endpoint and payload.
+            size_class (Union[str, None], optional): The size class of the job's AOI,
+                for the cost model. Defaults to None.
+            refresh (bool, optional): Run the job even if its result is cached, ie,
+                because the cached result is stale. Defaults to False.
+
+        Returns:
+            Union[Dict, None]: The "result" of the job, or None if the job failed
+        """
+        if cache_key is None:
+            cache_key = self.result_cache.make_key(request_endpoint, payload)
+        cached_result = None if refresh else self.result_cache.get(cache_key)
+        if cached_result is not None:
+            self.api_logger.info(
+                "\tUsing cached {} results for {}".format(
+                    self._pprint_endpoint(request_endpoint), job_label
+                )
+            )
+            return cached_result
+
+        job_dict = self.run_mmw_job(
+            request_endpoint=request_endpoint,
+            job_label=job_label,
+            payload=payload,
+            size_class=size_class,
+        )
+        if "result_response" not in job_dict.keys():
+            return None
+        result = job_dict["result_response"]["result"]
+        self.result_cache.put(cache_key, result, request_endpoint)
+        return result
+
+    def run_gwlfe_modification_sets(
+        self,
+        mapshed_job_uuid: str,
+        modification_sets: List[
+            Union[str, Dict, ModelMyWatershedModificationSet, None]
+        ],
+        job_label: str,
+        abs_tol: float = 0.0,
+        rel_tol: float = 0.0,
+        mapshed_key: Union[str, None] = None,
+        size_class: Union[str, None] = None,
+    ) -> List[Union[Dict, None]]:
+        """Runs GWLF-E on one MapShed result with each of a sweep of modification sets,
+        running each distinct set only once.
+
+        Sets that duplicate an earlier set - exactly, or within the tolerance - share
+        its result.  Results are cached by the MapShed inputs and the `inputmod_hash`
+        of the set, so a repeated sweep doesn't run again either.
+
+        Args:
+            mapshed_job_uuid (str): The job id of the MapShed (GWLF-E prepare) job
+            modification_sets (List[Union[str, Dict, ModelMyWatershedModificationSet, None]]):
+                The modification sets, as modification sets, dictionaries or the JSON
+                of GWLF-E payload modifications
+            job_label (str): A label to use to save the output files, which is
+                followed by the number of each distinct set
+            abs_tol (float, optional): The absolute tolerance for near-duplicate sets.
+                Defaults to 0, for only exact duplicates.
+            rel_tol (float, optional): The relative tolerance for near-duplicate sets.
+                Defaults to 0.
+            mapshed_key (Union[str, None], optional): A stable key for what went in to
+                MapShed, ie, the cache key of its request. Defaults to None, to use
+                the MapShed job id, which changes on every MapShed run.
+            size_class (Union[str, None], optional): The size class of the AOI, for
+                the cost model. Defaults to None.
+
+        Returns:
+            List[Union[Dict, None]]: The GWLF-E "result" for each given set, or None
+                where the run failed
+        """
+        distinct_sets, set_positions = deduplicate_modification_sets(
+            modification_sets, abs_tol, rel_tol
+        )
+        gwlfe_template = ModelMyWatershedPayloadTemplate({"job_uuid": mapshed_job_uuid})
+
+        distinct_results: List[Union[Dict, None]] = []
+        for set_number, modification_set in enumerate(distinct_sets, start=1):
+            inputmod_hash = modification_set.inputmod_hash()
+            distinct_results.append(
+                self._run_cached_job(
+                    self.gwlfe_run_endpoint,
+                    "{}_mods_{}".format(job_label, set_number),
+                    gwlfe_template.render(
+                        inputmod_hash=inputmod_hash,
+                        modifications=modification_set.json,
+                    ),
+                    self.result_cache.make_key(
+                        self.gwlfe_run_endpoint,
+                        {
+                            "mapshed": (
+                                mapshed_key
+                                if mapshed_key is not None
+                                else mapshed_job_uuid
+                            ),
+                            "inputmod_hash": inputmod_hash,
+                        },
+                    ),
+                    size_class=size_class,
+                )
+            )
+        return [distinct_results[position] for position in set_positions]
+
+    def get_tr55_template(self) -> ModelMyWatershedPayloadTemplate:
+        """Creates a payload template for unmodified TR-55 (Site Storm) model runs
+
+        Returns:
+            ModelMyWatershedPayloadTemplate: A template for the "model_input" form
+                field, to be rendered with `render_tr55_payload`
+        """
+        return ModelMyWatershedPayloadTemplate(
+            {
+                # NOTE:  The value of the inputmod_hash and modification_hash don't really matter here.
+                # Internally, the ModelMW site uses the inputmod_hash in scenerios to
+                # determine whether it can use cached results or if it needs to
+                # re-run the job
+                "modification_pieces": [],
+                "aoi_census": None,
+                "modification_censuses": None,
+                "inputmod_hash": self.tr55_inputmod_hash,
+                "modification_hash": self.modification_hash,
+            },
+            form_field="model_input",
+        )
+
+    def render_tr55_payload(
+        self,
+        tr55_template: ModelMyWatershedPayloadTemplate,
+        mmw_aoi: ModelMyWatershedAOI,
+        land_use_layer: str,
+        precipitation: float,
+    ) -> bytes:
+        """Renders the form payload for one TR-55 (Site Storm) model run
+
+        Args:
+            tr55_template (ModelMyWatershedPayloadTemplate): The template from
+                `get_tr55_template`
+            mmw_aoi (ModelMyWatershedAOI): The area of interest
+            land_use_layer (str): The key of the land use layer, from `land_use_layers`
+            precipitation (float): The 24-hour precipitation depth, in inches
+
+        Returns:
+            bytes: The form-encoded payload
+        """
+        # NOTE:  when using the layer overrides, we need the full layer
+        # title, ie, "nlcd-2019-30m-epsg5070-512-byte".  We can get this
+        # from the land use dictionary.
+        return tr55_template.render(
+            inputs=[
+                {
+                    "name": "precipitation",
+                    "value": precipitation,
+                    "type": "",
+                    "effectiveArea": None,
+                    "effectiveUnits": None,
+                    "effectiveShape": None,
+                    "shape": None,
+                    "area": "0",
+                    "units": "m²",
+                    "isValidForAnalysis": False,
+                }
+            ],
+            layer_overrides={"__LAND__": self.land_use_layers[land_use_layer]},
+            **{mmw_aoi.payload_key: mmw_aoi.json_bytes}
+        )
+
+    def run_batch_tr55(
+        self,
+        list_of_aois: List,
+        precipitation: Union[float, List[float]],
+        land_use_layers: Union[List[str], None] = None,
+        max_workers: int = 4,
+    ) -> Dict[str, "pd.DataFrame"]:
+        """Given a list of areas of interest (AOIs), runs the TR-55 (Site Storm) model for
+        every combination of AOI, precipitation and land use layer.  The jobs are run
+        concurrently, the longest expected jobs first, and results for inputs that have
+        already been run are taken from the result cache.
+
+        Args:
+            list_of_aois (List): A list of AOI's.  They can be strings, geojsons or
+                ModelMyWatershedAOI's.
+            precipitation (Union[float, List[float]]): The 24-hour precipitation depth(s)
+                to model, in inches.
+            land_use_layers (Union[List[str], None], optional): The keys of the land use
+                layers (from `land_use_layers`) to model. Defaults to all of them.
+            max_workers (int, optional): The number of jobs to run at once. Defaults to 4.
+
+        Returns:
+            Dict[str,pd.DataFrame]: A dictionary of dataframes with the TR-55 results:
+                "tr55_censuses", "tr55_runoff_distributions", "tr55_runoff_totals" and
+                "step_l_qualities".
+        """
+        precipitations = (
+            [precipitation]
+            if isinstance(precipitation, (int, float))
+            else list(precipitation)
+        )
+        if land_use_layers is None:
+            land_use_layers = list(self.land_use_layers.keys())
+
+        tr55_template = self.get_tr55_template()
+
+        tr55_jobs = []
+        run_number: int = 1
+        for aoi in list_of_aois:
+            try:
+                mmw_aoi = ModelMyWatershedAOI.from_any(aoi, run_number)
+                mmw_aoi.validate(single_ring=False)
+            except ValueError as ex:
+                self.api_logger.warn("\tSkipping invalid AOI: {}".format(ex))
+                continue
+            run_number += 1
+
+            for land_use_layer in land_use_layers:
+                for rain_inches in precipitations:
+                    job_label = "{}_{}".format(mmw_aoi.job_label, land_use_layer)
+                    if len(precipitations) > 1:
+                        job_label += "_{}in".format(rain_inches)
+                    tr55_payload = self.render_tr55_payload(
+                        tr55_template, mmw_aoi, land_use_layer, rain_inches
+                    )
+                    tr55_jobs.append(
+                        (
+                            {
+                                "job_label": mmw_aoi.job_label,
+                                "Land_Use_Source": land_use_layer,
+                                "precipitation": rain_inches,
+                            },
+                            job_label,
+                            tr55_payload,
+                            mmw_aoi.size_class(),
+                        )
+                    )
+
+        # start the longest jobs first, so a large AOI late in the list doesn't leave
+        # one job running by itself at the end
+        job_estimates = [
+            self.cost_model.estimate(self.tr55_endpoint, size_class)
+            for _, _, _, size_class in tr55_jobs
+        ]
+        self.api_logger.info(
+            "\tRunning {} TR-55 jobs; expected to take about {:.0f} seconds".format(
+                len(tr55_jobs),
+                self.cost_model.estimate_batch_seconds(job_estimates, max_workers),
+            )
+        )
+        job_order = sorted(
+            range(len(tr55_jobs)), key=lambda job_number: -job_estimates[job_number]
+        )
+        with ThreadPoolExecutor(max_workers=max_workers) as job_executor:
+            job_futures = {}
+            for job_number in job_order:
+                _, job_label, payload, size_class = tr55_jobs[job_number]
+                job_futures[job_number] = job_executor.submit(
+                    self._run_cached_job,
+                    self.tr55_endpoint,
+                    job_label,
+                    payload,
+                    size_class=size_class,
+                )
+            # collect the results in the original order
+            labeled_results = []
+            for job_number, (labels, _, _, _) in enumerate(tr55_jobs):
+                try:
+                    tr55_result = job_futures[job_number].result()
+                except Exception as ex:
+                    self.api_logger.warn("\tUnexpected exception:\n\t{}".format(ex))
+                    continue
+                if tr55_result is not None:
+                    labeled_results.append((labels, tr55_result))
+
+        if len(labeled_results) > 0:
+            return normalize_tr55_results(labeled_results)
+        return {
+            "tr55_censuses": None,
+            "tr55_runoff_distributions": None,
+            "tr55_runoff_totals": None,
+            "step_l_qualities": None,
+        }
+
     def convert_predictions_to_modifications(
         self,
         modified_analysis_result_file: str,
@@ -1166,19 +2225,40 @@ class ModelMyWatershedAPI:
             Dict: a dictionary of land use modifications
         """
 
-        _, lu_modifications = self.read_dumped_result(
-            "",
-            "",
-            self.save_path + modified_analysis_result_file,
-            "survey",
+        # only the land use survey and the MapShed areas are needed, so read just those
+        # keys rather than the whole (possibly very large) MapShed result
+        survey = read_result_key(
+            self.save_path + modified_analysis_result_file, "survey"
+        )
+        mapshed_area = read_result_key(
+            self.save_path + unmodified_mapshed_result_file, "Area"
         )
-        _, mapshed_base = self.read_dumped_result(
-            "",
-            "",
-            self.save_path + unmodified_mapshed_result_file,
-            "Area",
+
+        return self.predictions_to_modifications(
+            {"survey": survey} if survey is not None else None,
+            {"Area": mapshed_area} if mapshed_area is not None else None,
         )
 
+    def predictions_to_modifications(
+        self,
+        lu_modifications: Union[Dict, None],
+        mapshed_base: Union[Dict, None],
+    ) -> Union[str, None]:
+        """Converts the results of a land analysis (ie, of the Shippensburg 2100
+        predictions) into a set of land use modifications for a GWLF-E run.  This is
+        the same as `convert_predictions_to_modifications`, but takes the results
+        themselves rather than the names of their saved files.
+
+        Args:
+            lu_modifications (Union[Dict, None]): The "result" of the land analysis
+                to be used for modifications, with the "survey" key
+            mapshed_base (Union[Dict, None]): The "result" of a MapShed (GWLF-E
+                prepare) job on the **unmodified** layer, with the "Area" key
+
+        Returns:
+            str: the land use modifications, serialized for a GWLF-E payload
+        """
+
         # note:  In the ModelMyWatershed javascript, the mapshed total area value is called the "autoTotal" and the analysis-derived total area is called the "presetTotal".  I do not understand at all why they aren't the same.
 
         # var totalArea = _.sum(attrs.dataModel['Area']);
@@ -1210,38 +2290,13 @@ class ModelMyWatershedAPI:
         #     return l * autoTotal / presetTotal;
         # });
 
-        if lu_modifications is not None and mapshed_base is not None:
-            lu_modified = pd.DataFrame(lu_modifications["survey"]["categories"]).rename(
-                columns={"area": "area_m2"}
-            )
-            mapshed_auto_total = sum(mapshed_base["Area"])
-        else:
+        if lu_modifications is None or mapshed_base is None:
             return None
 
-        # use the NLCD to MapShed dictionary to convert land uses
-        lu_modified["area_ha"] = lu_modified["area_m2"] / 10000
-        lu_modified["mapshed_lu"] = lu_modified["type"].replace(self.nlcd_to_mapshed)
-        lu_modified["area_id"] = lu_modified["mapshed_lu"].replace(
-            self.mapshed_to_area_id
-        )
-
-        # sum up the area for each mapshed type
-        lu_conv_modified = (
-            lu_modified.dropna(subset=["mapshed_lu"])
-            .groupby(["mapshed_lu", "area_id"])["area_ha"]
-            .sum()
-            .reset_index()
-        )
-        lu_modified_preset_total = lu_conv_modified["area_ha"].sum()
-
-        lu_conv_modified["factored_area"] = (
-            lu_conv_modified["area_ha"] * mapshed_auto_total / lu_modified_preset_total
-        )
-
-        mod_dict = (
-            lu_conv_modified[["area_id", "factored_area"]]
-            .set_index("area_id")
-            .to_dict(orient="dict")["factored_area"]
+        # reclassify the NLCD areas to MapShed land covers and scale them to the total
+        # MapShed area, through the integer lookup tables of the reclassifier
+        mod_dict = self.land_cover_reclassifier.to_modifications(
+            lu_modifications["survey"]["categories"], sum(mapshed_base["Area"])
         )
         # mod_dict_preset = {
         #     "entry_landcover_preset": "drb_2100_land_{}".format(
@@ -1250,9 +2305,8 @@ class ModelMyWatershedAPI:
         # }
         # mod_dict_2 = dict(mod_dict_preset, **mod_dict)
         # mod_dict_dump = "[{}]".format(json.dumps(mod_dict_2).replace(" ", ""))
-        mod_dict_dump = "[{}]".format(json.dumps(mod_dict).replace(" ", ""))
 
-        return mod_dict_dump
+        return ModelMyWatershedModificationSet(mod_dict).json
 
     def analyse_protected_lands(self, job_label, payload) -> ModelMyWatershedJob:
         return self.run_mmw_job(self.protected_lands_endpoint, job_label, payload)
@@ -1384,17 +2438,21 @@ class ModelMyWatershedAPI:
 
         saved_result = None
         req_dump = None
-        dump_filename = self.get_dump_filename(request_endpoint, job_label)
-        if Path(dump_filename).is_file() or (
-            alt_filename != "" and Path(alt_filename).is_file()
-        ):
-            f = (
-                open(dump_filename)
-                if Path(dump_filename).is_file()
-                else open(alt_filename)
-            )
-            req_dump = json.load(f)
-            f.close()
+        dump_filename = self._find_dump(request_endpoint, job_label, alt_filename)
+        if dump_filename is not None:
+            try:
+                with open(dump_filename) as f:
+                    req_dump = json.load(f)
+            except FileNotFoundError:
+                # deleted since it was indexed
+                return (req_dump, saved_result)
+            if "result_file" in req_dump.keys() and isinstance(
+                req_dump.get("result_response"), dict
+            ):
+                # the result was streamed to its own file, beside the dump
+                req_dump["result_response"]["result"] = read_streamed_result(
+                    str(Path(dump_filename).parent / Path(req_dump["result_file"]).name)
+                )
 
             if needed_result_key != "":
                 if (
@@ -1436,14 +2494,64 @@ class ModelMyWatershedAPI:
             )
         return (req_dump, saved_result)
 
+    def read_dumped_result_key(
+        self,
+        request_endpoint: str,
+        job_label: str,
+        result_key: str,
+        alt_filename: str = "",
+    ) -> Any:
+        """Reads a single key of the result from a json file saved by this library,
+        without loading the rest of the file.  Use this instead of
+        `read_dumped_result` when only part of a large result is needed.
+
+        Args:
+            request_endpoint (str): The request endpoint that was used
+            job_label (str): the custom job label
+            result_key (str): The key in the job result to read, ie, "SummaryLoads"
+            alt_filename (str, optional): an alternate file name to look for, if the file was saved with a name other than that generated by `get_dump_filename(...)`. Defaults to "".
+
+        Returns:
+            Any: The value of the key, or None if the file or the key doesn't exist
+        """
+        dump_filename = self._find_dump(request_endpoint, job_label, alt_filename)
+        if dump_filename is None:
+            return None
+        return read_result_key(dump_filename, result_key)
+
+    def _find_dump(
+        self, request_endpoint: str, job_label: str, alt_filename: str = ""
+    ) -> Union[str, None]:
+        """Finds a saved dump, looking in the dump index rather than checking the
+        file system for the conventional file name.  Dumps written into the save path
+        by other means since the index was made are only found after
+        `dump_index.rebuild`, or with `check_unindexed_dumps` turned on."""
+        dump_filename = self.get_dump_filename(request_endpoint, job_label)
+        if self.dump_index is not None and dump_filename in self.dump_index:
+            return dump_filename
+        if self.check_unindexed_dumps and Path(dump_filename).is_file():
+            # written since the index was made; index it for the next lookup
+            if self.dump_index is not None:
+                self.dump_index.add_file(
+                    dump_filename,
+                    dump_filename,
+                    Path(dump_filename).stat().st_size,
+                    None,
+                )
+            return dump_filename
+        if alt_filename != "" and Path(alt_filename).is_file():
+            return alt_filename
+        return None
+
     def dump_job_json(self, job_dict: ModelMyWatershedJob) -> None:
 
         # dump out the whole job for posterity
         if self.save_path is not None:
-            with open(
+            # written in one piece to a temporary file and renamed, so a crash or
+            # another job with the same label can't leave a partial or mixed file
+            self.dump_index.write(
                 self.get_dump_filename(
                     job_dict["request_endpoint"], job_dict["job_label"]
                 ),
-                "w",
-            ) as fp:
-                json.dump(job_dict, fp, indent=2)
+                json.dumps(job_dict, indent=2).encode("utf-8"),
+            )
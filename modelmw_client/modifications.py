@@ -0,0 +1,314 @@
+"""
+Canonical GWLF-E modification sets, hashed the way the ModelMyWatershed site hashes them.
+"""
+#%%
+import hashlib
+import json
+import logging
+import math
+import re
+from typing import Any, Dict, List, Tuple, Union
+
+module_logger = logging.getLogger(__name__)
+
+# MapShed inputs with one value per land cover class or source, ie, "Area__2"
+_INDEXED_KEY = re.compile(r"^(.*)__(\d+)$")
+
+
+#%%
+def _sort_key(key: str) -> Tuple[str, int]:
+    """Orders keys by name and then by their numeric index, so "Area__2" comes before
+    "Area__10" """
+    indexed_match = _INDEXED_KEY.match(key)
+    if indexed_match is None:
+        return (key, -1)
+    return (indexed_match.group(1), int(indexed_match.group(2)))
+
+
+def _js_number(value: Union[int, float]) -> str:
+    """Formats a number the way JavaScript's `JSON.stringify` does: whole numbers
+    without a decimal point, and exponents only for very large or small numbers"""
+    if not math.isfinite(value):
+        return "null"
+    if value == int(value) and abs(value) < 1e21:
+        return str(int(value))
+    number_text = repr(float(value))
+    if "e" not in number_text:
+        return number_text
+    mantissa, exponent_text = number_text.split("e")
+    exponent = int(exponent_text)
+    if -7 < exponent < 0:
+        # Python uses an exponent from 1e-5 down, but JavaScript only from 1e-7
+        sign = "-" if mantissa.startswith("-") else ""
+        digits = mantissa.lstrip("-").replace(".", "")
+        return "{}0.{}{}".format(sign, "0" * (-exponent - 1), digits)
+    return "{}e{}{}".format(mantissa, "+" if exponent > 0 else "", exponent)
+
+
+def js_json(value: Any) -> str:
+    """Serializes a value the way JavaScript's `JSON.stringify` does, so that it hashes
+    the same as it does on the ModelMyWatershed site
+
+    Args:
+        value (Any): A JSON-serializable value
+
+    Returns:
+        str: The compact JSON, with object keys in their given order
+    """
+    if isinstance(value, bool) or value is None:
+        return json.dumps(value)
+    if isinstance(value, (int, float)):
+        return _js_number(value)
+    if isinstance(value, str):
+        return json.dumps(value, ensure_ascii=False)
+    if isinstance(value, dict):
+        return "{{{}}}".format(
+            ",".join(
+                "{}:{}".format(json.dumps(str(key), ensure_ascii=False), js_json(item))
+                for key, item in value.items()
+            )
+        )
+    if isinstance(value, (list, tuple)):
+        return "[{}]".format(",".join(js_json(item) for item in value))
+    raise TypeError("Can't serialize a {} to JSON".format(type(value).__name__))
+
+
+def md5_hash(text: str) -> str:
+    """The hexadecimal MD5 hash of a string, as the ModelMyWatershed site makes its
+    `inputmod_hash`"""
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+
+class ModelMyWatershedModificationSet:
+    """A set of GWLF-E modifications: new values for MapShed (GWLF-E prepare) inputs,
+    ie, the area in hectares of each MapShed land cover class ("Area__2").
+
+    The modifications are put in a canonical order - by input name and then by class
+    position - and serialized compactly, the way the site's JavaScript does, so equal
+    sets give the same payload and the same hash however they were built.  The hash is
+    the MD5 hash of the list of modifications; with no inputs, the `inputmod_hash` of
+    an unmodified set is the site's hash for an unmodified scenario
+    (`ModelMyWatershedAPI.inputmod_hash`).
+    """
+
+    __slots__ = ("modifications", "_json", "_hash")
+
+    def __init__(self, modifications: Union[Dict[str, Any], None] = None):
+        """Creates a modification set
+
+        Args:
+            modifications (Union[Dict[str, Any], None], optional): The new values, by
+                MapShed input key. Defaults to None, for no modifications.
+        """
+        modifications = {} if modifications is None else modifications
+        self.modifications: Dict[str, Any] = {
+            key: modifications[key] for key in sorted(modifications, key=_sort_key)
+        }
+        self._json: Union[str, None] = None
+        self._hash: Union[str, None] = None
+
+    @classmethod
+    def from_json(
+        cls, modification_json: Union[str, bytes]
+    ) -> "ModelMyWatershedModificationSet":
+        """Parses the modifications of a GWLF-E payload, ie, "[{}]" or
+        '[{"Area__2":16.5}]'; when the list has several sets of modifications, later
+        ones replace the values of earlier ones
+
+        Raises:
+            ValueError: If the JSON isn't a list of modification dictionaries
+        """
+        try:
+            modification_list = json.loads(modification_json)
+        except json.JSONDecodeError as ex:
+            raise ValueError("The modifications aren't valid JSON: {}".format(ex))
+        if isinstance(modification_list, dict):
+            modification_list = [modification_list]
+        if not isinstance(modification_list, list) or not all(
+            isinstance(modification, dict) for modification in modification_list
+        ):
+            raise ValueError(
+                "The modifications aren't a list of dictionaries: {}".format(
+                    modification_json
+                )
+            )
+        modifications: Dict[str, Any] = {}
+        for modification in modification_list:
+            modifications.update(modification)
+        return cls(modifications)
+
+    @classmethod
+    def from_any(
+        cls,
+        modifications: Union[str, bytes, Dict, "ModelMyWatershedModificationSet", None],
+    ) -> "ModelMyWatershedModificationSet":
+        """Returns the input if it is already a modification set, or makes one from a
+        dictionary or the JSON of a GWLF-E payload"""
+        if isinstance(modifications, cls):
+            return modifications
+        if isinstance(modifications, (str, bytes)):
+            return cls.from_json(modifications)
+        return cls(modifications)
+
+    def __repr__(self) -> str:
+        return "ModelMyWatershedModificationSet({})".format(self.json)
+
+    def __eq__(self, other) -> bool:
+        return (
+            isinstance(other, ModelMyWatershedModificationSet)
+            and self.hash == other.hash
+        )
+
+    def __hash__(self) -> int:
+        return hash(self.hash)
+
+    def __len__(self) -> int:
+        return len(self.modifications)
+
+    @property
+    def json(self) -> str:
+        """The modifications for a GWLF-E payload, serialized once; "[{}]" for none"""
+        if self._json is None:
+            self._json = "[{}]".format(js_json(self.modifications))
+        return self._json
+
+    @property
+    def hash(self) -> str:
+        """The MD5 hash of the canonical list of modifications, which is empty ("[]")
+        when there are none"""
+        if self._hash is None:
+            self._hash = md5_hash(self.json if len(self.modifications) > 0 else "[]")
+        return self._hash
+
+    def inputmod_hash(self, inputs: Union[List, None] = None) -> str:
+        """The `inputmod_hash` of a GWLF-E run with these modifications: the hash of
+        the scenario inputs followed by the hash of the modifications
+
+        Args:
+            inputs (Union[List, None], optional): The scenario inputs. Defaults to
+                None, for none.
+
+        Returns:
+            str: The hash, for a GWLF-E payload or as a cache key
+        """
+        return md5_hash(js_json([] if inputs is None else inputs)) + self.hash
+
+    def _split_values(self) -> Tuple[Tuple, List[float]]:
+        """Splits the modifications into a signature of the keys and non-numeric
+        values, and the list of numeric values"""
+        signature = []
+        numeric_values = []
+        for key, value in self.modifications.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                signature.append(key)
+                numeric_values.append(float(value))
+            else:
+                signature.append((key, js_json(value)))
+        return tuple(signature), numeric_values
+
+    def is_close(
+        self,
+        other: "ModelMyWatershedModificationSet",
+        abs_tol: float = 0.0,
+        rel_tol: float = 0.0,
+    ) -> bool:
+        """Checks whether two modification sets change the same inputs to values that
+        are within a tolerance of each other, the same as `math.isclose`
+
+        Args:
+            other (ModelMyWatershedModificationSet): The other set
+            abs_tol (float, optional): The absolute tolerance, ie, in hectares for
+                areas. Defaults to 0.
+            rel_tol (float, optional): The relative tolerance. Defaults to 0.
+
+        Returns:
+            bool: Whether the sets are the same within the tolerance
+        """
+        signature, numeric_values = self._split_values()
+        other_signature, other_values = other._split_values()
+        return signature == other_signature and all(
+            math.isclose(value, other_value, abs_tol=abs_tol, rel_tol=rel_tol)
+            for value, other_value in zip(numeric_values, other_values)
+        )
+
+
+def deduplicate_modification_sets(
+    modification_sets: List[
+        Union[str, bytes, Dict, ModelMyWatershedModificationSet, None]
+    ],
+    abs_tol: float = 0.0,
+    rel_tol: float = 0.0,
+) -> Tuple[List[ModelMyWatershedModificationSet], List[int]]:
+    """Finds the distinct modification sets in a sweep, so that each only needs to be
+    run once.  Sets are duplicates when they hash the same, or when they change the same
+    inputs to values within the tolerance of an earlier distinct set.
+
+    Args:
+        modification_sets (List[Union[str, bytes, Dict, ModelMyWatershedModificationSet, None]]):
+            The modification sets, as anything `ModelMyWatershedModificationSet.from_any`
+            takes
+        abs_tol (float, optional): The absolute tolerance. Defaults to 0, for only
+            exact duplicates.
+        rel_tol (float, optional): The relative tolerance. Defaults to 0.
+
+    Returns:
+        Tuple[List[ModelMyWatershedModificationSet], List[int]]: The distinct sets, in
+            order of first appearance, and the position among them of each given set
+    """
+    distinct_sets: List[ModelMyWatershedModificationSet] = []
+    distinct_positions: List[int] = []
+    positions_by_hash: Dict[str, int] = {}
+    # for the tolerance, the numeric values of the distinct sets changing the same
+    # inputs, as one growing array for each signature, compared all at once
+    values_by_signature: Dict[Tuple, Tuple[Any, List[int]]] = {}
+
+    for modification_set in modification_sets:
+        modification_set = ModelMyWatershedModificationSet.from_any(modification_set)
+        position = positions_by_hash.get(modification_set.hash)
+        if position is None and (abs_tol > 0 or rel_tol > 0):
+            import numpy as np
+
+            signature, numeric_values = modification_set._split_values()
+            values = np.array(numeric_values, dtype=float)
+            if signature in values_by_signature:
+                distinct_values, signature_positions = values_by_signature[signature]
+                kept_values = distinct_values[: len(signature_positions)]
+                is_close = np.all(
+                    np.abs(kept_values - values)
+                    <= np.maximum(
+                        rel_tol * np.maximum(np.abs(kept_values), np.abs(values)),
+                        abs_tol,
+                    ),
+                    axis=1,
+                )
+                if np.any(is_close):
+                    position = signature_positions[int(np.argmax(is_close))]
+                else:
+                    if len(signature_positions) == len(distinct_values):
+                        distinct_values = np.concatenate(
+                            [distinct_values, np.empty_like(distinct_values)]
+                        )
+                    distinct_values[len(signature_positions)] = values
+                    signature_positions.append(len(distinct_sets))
+                    values_by_signature[signature] = (
+                        distinct_values,
+                        signature_positions,
+                    )
+            else:
+                values_by_signature[signature] = (
+                    values[np.newaxis, :],
+                    [len(distinct_sets)],
+                )
+        if position is None:
+            position = len(distinct_sets)
+            distinct_sets.append(modification_set)
+            positions_by_hash[modification_set.hash] = position
+        distinct_positions.append(position)
+
+    if len(distinct_sets) < len(distinct_positions):
+        module_logger.info(
+            "\tRunning {} distinct modification sets of {}".format(
+                len(distinct_sets), len(distinct_positions)
+            )
+        )
+    return distinct_sets, distinct_positions
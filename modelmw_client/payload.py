@@ -0,0 +1,113 @@
+"""
+Pre-serialized payload templates for repeated ModelMyWatershed requests.
+"""
+#%%
+import gzip
+import json
+import logging
+from typing import Any, Dict, Union
+from urllib.parse import quote_plus
+
+module_logger = logging.getLogger(__name__)
+
+
+#%%
+def _dump_json(value: Any) -> bytes:
+    """Serializes a value to compact JSON bytes; bytes are taken to already be JSON"""
+    if isinstance(value, bytes):
+        return value
+    return json.dumps(value, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+class ModelMyWatershedPayloadTemplate:
+    """A JSON payload whose invariant part is serialized once, with the fields that
+    change from job to job spliced in when the payload is rendered.
+
+    Batch runs send many payloads that only differ in a few fields - ie, GWLF-E run
+    payloads only differ in the `job_uuid` and `modifications` - and re-serializing
+    the rest of the payload (especially large GeoJSON shapes) for every job is a real
+    share of the client's work.  Values given as bytes are taken to be JSON that was
+    already serialized, like `ModelMyWatershedAOI.json_bytes`, and are spliced in as
+    is.
+
+    For the older form-encoded modeling endpoints (TR-55), give a `form_field`; the
+    JSON is then URL-encoded into that form field, ie, `model_input=...`.
+
+    Example:
+        gwlfe_template = ModelMyWatershedPayloadTemplate(
+            {"inputmod_hash": mmw_run.inputmod_hash}
+        )
+        mmw_run.start_job(
+            mmw_run.gwlfe_run_endpoint,
+            job_label,
+            gwlfe_template.render(job_uuid=mapshed_job_id, modifications="[{}]"),
+        )
+    """
+
+    __slots__ = ("invariant", "form_field", "_prefix", "_encoded_prefix")
+
+    def __init__(self, invariant: Dict, form_field: Union[str, None] = None):
+        """Serializes the invariant part of a payload
+
+        Args:
+            invariant (Dict): The fields that are the same for every job
+            form_field (Union[str, None], optional): The name of the form field to put
+                the JSON in, for form-encoded endpoints. Defaults to None, for a plain
+                JSON payload.
+        """
+        self.invariant = invariant
+        self.form_field = form_field
+        # everything but the closing brace, so more fields can be appended
+        self._prefix = _dump_json(invariant)[:-1]
+        self._encoded_prefix = (
+            None
+            if form_field is None
+            else (quote_plus(form_field) + "=" + quote_plus(self._prefix)).encode(
+                "ascii"
+            )
+        )
+
+    def _render_fields(self, fields: Dict[str, Any]) -> bytes:
+        pieces = []
+        for field_name in sorted(fields.keys()):
+            if field_name in self.invariant:
+                raise ValueError(
+                    "{} is already part of the payload template".format(field_name)
+                )
+            pieces.append(
+                _dump_json(field_name) + b":" + _dump_json(fields[field_name])
+            )
+        fields_json = b",".join(pieces)
+        if len(self._prefix) > 1 and len(fields_json) > 0:
+            fields_json = b"," + fields_json
+        return fields_json + b"}"
+
+    def render(self, **fields: Any) -> bytes:
+        """Creates the payload for one job
+
+        Args:
+            **fields: The fields that change from job to job.  Bytes values must
+                already be serialized JSON.
+
+        Returns:
+            bytes: The serialized payload, ready to be passed to `start_job`
+        """
+        fields_json = self._render_fields(fields)
+        if self.form_field is None:
+            return self._prefix + fields_json
+        # URL-encoding works character by character, so the pieces can be encoded
+        # separately and joined
+        return self._encoded_prefix + quote_plus(fields_json).encode("ascii")
+
+
+def gzip_payload(payload: bytes, compress_level: int = 6) -> bytes:
+    """Compresses a serialized payload for a gzip encoded request body
+
+    Args:
+        payload (bytes): The serialized payload
+        compress_level (int, optional): The gzip compression level. Defaults to 6.
+
+    Returns:
+        bytes: The compressed payload
+    """
+    return gzip.compress(payload, compresslevel=compress_level, mtime=0)
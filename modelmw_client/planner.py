@@ -0,0 +1,387 @@
+"""
+Incremental re-run planning, so only jobs whose results are missing, stale or changed are run.
+"""
+#%%
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Tuple, Union
+
+from .cache import ModelMyWatershedResultCache
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+    from .model_client import ModelMyWatershedAPI
+
+module_logger = logging.getLogger(__name__)
+
+
+#%%
+class ModelMyWatershedPlannedJob:
+    """A job that should have a current result: its label, request endpoint and
+    canonical payload, and once planned, its status"""
+
+    __slots__ = (
+        "job_label",
+        "request_endpoint",
+        "payload",
+        "cache_key",
+        "size_class",
+        "status",
+        "previous_key",
+        "estimated_seconds",
+    )
+
+    def __init__(
+        self,
+        job_label: str,
+        request_endpoint: str,
+        payload: Union[bytes, str, Dict, None],
+        cache_key: Union[str, None] = None,
+        size_class: Union[str, None] = None,
+    ):
+        """Declares a job
+
+        Args:
+            job_label (str): A label for the job, which stays the same when its inputs
+                change, ie, "<HUC>_<land use layer>"
+            request_endpoint (str): The endpoint for the request
+            payload (Union[bytes, str, Dict, None]): The payload of the request,
+                serialized canonically (ie, by a payload template or
+                `ModelMyWatershedAOI`) or as a dictionary.  It can be None for jobs
+                that are only planned, not run, by the planner.
+            cache_key (Union[str, None], optional): The result cache key for the job.
+                Defaults to the hash of the endpoint and payload.
+            size_class (Union[str, None], optional): The size class of the job's AOI,
+                for the cost model. Defaults to None.
+        """
+        self.job_label = job_label
+        self.request_endpoint = request_endpoint
+        self.payload = payload
+        self.cache_key = (
+            cache_key
+            if cache_key is not None
+            else ModelMyWatershedResultCache.make_key(request_endpoint, payload)
+        )
+        self.size_class = size_class
+        # "missing", "changed", "stale" or "current" once planned, and "succeeded" or
+        # "failed" once run
+        self.status = "Not Planned"
+        # the cache key the label was last run with, if it differs
+        self.previous_key: Union[str, None] = None
+        self.estimated_seconds = 0.0
+
+    def __repr__(self) -> str:
+        return "ModelMyWatershedPlannedJob({}, {})".format(self.job_label, self.status)
+
+
+class ModelMyWatershedRunPlan:
+    """The planned jobs, and how long the ones that need running are expected to take"""
+
+    # the statuses of jobs that need to be run
+    run_statuses: List[str] = ["missing", "changed", "stale"]
+
+    def __init__(
+        self, jobs: List[ModelMyWatershedPlannedJob], estimated_seconds: float
+    ):
+        self.jobs = jobs
+        self.estimated_seconds = estimated_seconds
+
+    @property
+    def to_run(self) -> List[ModelMyWatershedPlannedJob]:
+        """The jobs that are missing, changed or stale"""
+        return [job for job in self.jobs if job.status in self.run_statuses]
+
+    def counts(self) -> Dict[str, int]:
+        """The number of jobs with each status"""
+        status_counts: Dict[str, int] = {}
+        for job in self.jobs:
+            status_counts[job.status] = status_counts.get(job.status, 0) + 1
+        return status_counts
+
+    def summary(self) -> str:
+        """A one line description of the plan, ie, for a dry run"""
+        status_counts = self.counts()
+        return "{} jobs to run ({} missing, {} changed, {} stale) and {} current; expected to take about {:.0f} seconds".format(
+            len(self.to_run),
+            status_counts.get("missing", 0),
+            status_counts.get("changed", 0),
+            status_counts.get("stale", 0),
+            status_counts.get("current", 0),
+            self.estimated_seconds,
+        )
+
+    def to_frame(self) -> "pd.DataFrame":
+        """The planned jobs as a table
+
+        Returns:
+            pd.DataFrame: The "job_label", "request_endpoint", "status", "cache_key",
+                "previous_key" and "estimated_seconds" of each job
+        """
+        import pandas as pd
+
+        return pd.DataFrame(
+            [
+                {
+                    "job_label": job.job_label,
+                    "request_endpoint": job.request_endpoint,
+                    "status": job.status,
+                    "cache_key": job.cache_key,
+                    "previous_key": job.previous_key,
+                    "estimated_seconds": job.estimated_seconds,
+                }
+                for job in self.jobs
+            ],
+            columns=[
+                "job_label",
+                "request_endpoint",
+                "status",
+                "cache_key",
+                "previous_key",
+                "estimated_seconds",
+            ],
+        )
+
+
+class ModelMyWatershedRunPlanner:
+    """Compares a desired set of jobs against the API client's result cache, and only
+    runs the ones that are missing, stale or changed.
+
+    The planner keeps a manifest of the cache key and time of the last run of each job
+    label and endpoint, one json line per run, so a job is:
+
+    - "current" if the result for its endpoint and payload is cached and, if a maximum
+      age is set, was run recently enough.  Cached results the manifest doesn't know
+      about (ie, cached by a batch run) are taken to be current.
+    - "stale" if its result is cached but older than the maximum age for its endpoint.
+    - "changed" if its result isn't cached, but the same label was run before with
+      other inputs (ie, a new AOI boundary or land use layer).
+    - "missing" if its result isn't cached and the label hasn't been run.
+
+    A daily refresh of a large matrix then only runs the difference, and a dry run
+    shows what would be run and the cost model's estimate of how long it would take.
+    """
+
+    planner_logger = module_logger.getChild(__qualname__)
+
+    def __init__(
+        self,
+        mmw_api: "ModelMyWatershedAPI",
+        manifest_path: Union[str, None] = None,
+        max_age_seconds: Union[float, Dict[str, float], None] = None,
+        max_workers: int = 4,
+    ):
+        """Create a new planner
+
+        Args:
+            mmw_api (ModelMyWatershedAPI): The API client, for its result cache and
+                cost model and to run the jobs
+            manifest_path (Union[str, None], optional): The file to keep the manifest
+                of runs in. Defaults to None, for "run_manifest.jsonl" in the API
+                client's save path, or only in memory without one.
+            max_age_seconds (Union[float, Dict[str, float], None], optional): The age
+                after which a result is stale, for every endpoint or by endpoint.
+                Defaults to None, for results that never go stale.
+            max_workers (int, optional): The number of jobs to run at once.
+                Defaults to 4.
+        """
+        self.mmw_api = mmw_api
+        if manifest_path is None and mmw_api.save_path is not None:
+            manifest_path = mmw_api.save_path + "run_manifest.jsonl"
+        self.manifest_path = manifest_path
+        self.max_age_seconds = max_age_seconds
+        self.max_workers = max_workers
+        # the cache key and time of the last run, by job label and endpoint
+        self._manifest: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        # how much of the manifest file has been read
+        self._manifest_offset = 0
+        self._manifest_lock = threading.Lock()
+
+    def _read_manifest(self) -> None:
+        """Reads the runs appended to the manifest since it was last read.  Call with
+        the manifest lock held."""
+        if self.manifest_path is None:
+            return
+        try:
+            with open(self.manifest_path, "rb") as fp:
+                fp.seek(self._manifest_offset)
+                appended = fp.read()
+        except FileNotFoundError:
+            return
+        # leave a line that is still being written for the next read
+        complete_end = appended.rfind(b"\n") + 1
+        for line in appended[:complete_end].splitlines():
+            try:
+                entry = json.loads(line)
+                self._manifest[(entry["l"], entry["e"])] = (entry["k"], entry["t"])
+            except (ValueError, KeyError, TypeError):
+                self.planner_logger.warn(
+                    "\tSkipping unreadable manifest line {}".format(line)
+                )
+        self._manifest_offset += complete_end
+
+    def _get_max_age(self, request_endpoint: str) -> Union[float, None]:
+        if isinstance(self.max_age_seconds, dict):
+            return self.max_age_seconds.get(request_endpoint)
+        return self.max_age_seconds
+
+    def record(self, job: ModelMyWatershedPlannedJob) -> None:
+        """Records that a job was run with its current inputs
+
+        Args:
+            job (ModelMyWatershedPlannedJob): The job
+        """
+        run_time = round(time.time(), 3)
+        with self._manifest_lock:
+            self._manifest[(job.job_label, job.request_endpoint)] = (
+                job.cache_key,
+                run_time,
+            )
+            if self.manifest_path is None:
+                return
+            Path(self.manifest_path).parent.mkdir(parents=True, exist_ok=True)
+            # a single append of the whole line, so processes sharing the manifest
+            # don't interleave their lines
+            with open(self.manifest_path, "a") as fp:
+                fp.write(
+                    json.dumps(
+                        {
+                            "l": job.job_label,
+                            "e": job.request_endpoint,
+                            "k": job.cache_key,
+                            "t": run_time,
+                        },
+                        separators=(",", ":"),
+                    )
+                    + "\n"
+                )
+
+    def plan(self, jobs: List[ModelMyWatershedPlannedJob]) -> ModelMyWatershedRunPlan:
+        """Finds which jobs need to be run, without running anything
+
+        Args:
+            jobs (List[ModelMyWatershedPlannedJob]): The jobs that should have a
+                current result
+
+        Returns:
+            ModelMyWatershedRunPlan: The jobs with their statuses, and the estimated
+                time to run the ones that need it
+        """
+        with self._manifest_lock:
+            self._read_manifest()
+            manifest = dict(self._manifest)
+        now = time.time()
+        for job in jobs:
+            last_run = manifest.get((job.job_label, job.request_endpoint))
+            job.previous_key = (
+                last_run[0]
+                if last_run is not None and last_run[0] != job.cache_key
+                else None
+            )
+            max_age = self._get_max_age(job.request_endpoint)
+            if job.cache_key not in self.mmw_api.result_cache:
+                job.status = "missing" if job.previous_key is None else "changed"
+            elif (
+                max_age is not None
+                and last_run is not None
+                and last_run[0] == job.cache_key
+                and now - last_run[1] > max_age
+            ):
+                job.status = "stale"
+            else:
+                job.status = "current"
+            job.estimated_seconds = (
+                self.mmw_api.cost_model.estimate(
+                    job.request_endpoint,
+                    job.size_class if job.size_class is not None else "",
+                )
+                if job.status in ModelMyWatershedRunPlan.run_statuses
+                else 0.0
+            )
+
+        run_plan = ModelMyWatershedRunPlan(
+            jobs,
+            self.mmw_api.cost_model.estimate_batch_seconds(
+                [
+                    job.estimated_seconds
+                    for job in jobs
+                    if job.status in ModelMyWatershedRunPlan.run_statuses
+                ],
+                self.max_workers,
+            ),
+        )
+        return run_plan
+
+    def _run_planned_job(self, job: ModelMyWatershedPlannedJob) -> bool:
+        """Runs one job, caching its result and recording it in the manifest"""
+        job_dict = self.mmw_api.run_mmw_job(
+            request_endpoint=job.request_endpoint,
+            job_label=job.job_label,
+            payload=job.payload,
+            size_class=job.size_class,
+        )
+        if "result_response" not in job_dict.keys():
+            return False
+        self.mmw_api.result_cache.put(
+            job.cache_key, job_dict["result_response"]["result"], job.request_endpoint
+        )
+        self.record(job)
+        return True
+
+    def execute(self, run_plan: ModelMyWatershedRunPlan) -> ModelMyWatershedRunPlan:
+        """Runs the jobs of a plan that are missing, changed or stale, longest first;
+        their results are put in the API client's result cache
+
+        Args:
+            run_plan (ModelMyWatershedRunPlan): The plan, from `plan`
+
+        Returns:
+            ModelMyWatershedRunPlan: The same plan, with the jobs that were run marked
+                "succeeded" or "failed"
+        """
+        to_run = sorted(run_plan.to_run, key=lambda job: -job.estimated_seconds)
+        if any(job.payload is None for job in to_run):
+            raise ValueError(
+                "Jobs without a payload can be planned, but not run, by the planner"
+            )
+        with ThreadPoolExecutor(max_workers=self.max_workers) as job_executor:
+            job_futures = {
+                job_executor.submit(self._run_planned_job, job): job for job in to_run
+            }
+            for job_future, job in job_futures.items():
+                try:
+                    succeeded = job_future.result()
+                except Exception as ex:
+                    self.planner_logger.warn(
+                        "\tUnexpected exception in {}:\n\t{}".format(job.job_label, ex)
+                    )
+                    succeeded = False
+                job.status = "succeeded" if succeeded else "failed"
+        return run_plan
+
+    def run(
+        self, jobs: List[ModelMyWatershedPlannedJob], dry_run: bool = False
+    ) -> ModelMyWatershedRunPlan:
+        """Plans the jobs and, unless this is a dry run, runs the ones that need it
+
+        Args:
+            jobs (List[ModelMyWatershedPlannedJob]): The jobs that should have a
+                current result
+            dry_run (bool, optional): Only plan the jobs and log the plan.
+                Defaults to False.
+
+        Returns:
+            ModelMyWatershedRunPlan: The plan; the results are in the API client's
+                result cache, under each job's `cache_key`
+        """
+        run_plan = self.plan(jobs)
+        self.planner_logger.info(
+            "\t{}{}".format("Dry run: " if dry_run else "", run_plan.summary())
+        )
+        if dry_run:
+            return run_plan
+        return self.execute(run_plan)
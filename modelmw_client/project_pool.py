@@ -0,0 +1,353 @@
+"""
+A managed pool of skeleton ModelMyWatershed projects.
+"""
+#%%
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Union
+
+from .aoi import ModelMyWatershedAOI
+from .model_client import ModelMyWatershedAPI, ModemMyWatershedLayerOverride
+
+module_logger = logging.getLogger(__name__)
+
+
+#%%
+def _aoi_key(
+    area_of_interest: Union[Dict, None] = None,
+    wkaoi: Union[str, None] = None,
+    huc: Union[str, None] = None,
+) -> str:
+    """Creates a cache key for an area of interest, or an empty string if the area is
+    missing or invalid"""
+    try:
+        mmw_aoi = ModelMyWatershedAOI.from_kwargs(area_of_interest, wkaoi, huc)
+    except ValueError:
+        return ""
+    return mmw_aoi.key if mmw_aoi is not None else ""
+
+
+class ModelMyWatershedProjectPool:
+    """Hands out skeleton projects for project-scoped requests (like weather data) and
+    re-uses them instead of creating and deleting a project for every request.
+
+    - A project is kept for each area of interest it was created for, so repeated
+      requests for the same area don't create new projects.
+    - When a project is no longer in use and a new geojson area of interest is
+      requested, the idle project is re-targeted to the new shape rather than
+      creating another one.  HUC and WKAoI areas can only be set when a project is
+      created.
+    - All remaining projects are deleted together when the pool is closed.  If
+      there are more than `max_idle` idle projects, the oldest are deleted in the
+      background while the pool is still in use.
+    - Every project created and deleted is written to a local ledger file, so that
+      projects left behind by a crashed session can be cleaned up later with
+      `cleanup_orphans`.
+
+    Use the pool as a context manager to guarantee the cleanup happens:
+
+        with ModelMyWatershedProjectPool(mmw_run) as pool:
+            with pool.project(huc="020402050301") as project_id:
+                mmw_run.get_project_weather(project_id, "NASA_NLDAS_2000_2019")
+
+    YOU MUST BE LOGGED IN TO USE THIS FEATURE!
+    """
+
+    pool_logger = module_logger.getChild(__qualname__)
+
+    def __init__(
+        self,
+        mmw_api: ModelMyWatershedAPI,
+        ledger_path: Union[str, None] = None,
+        model_package: str = "gwlfe",
+        max_idle: int = 25,
+    ):
+        """Create a new project pool on top of a logged-in API client
+
+        Args:
+            mmw_api (ModelMyWatershedAPI): The API client to make the requests with
+            ledger_path (Union[str, None], optional): The file to record created and
+                deleted projects in. Defaults to "project_ledger.jsonl" in the save path
+                of the API client, or no ledger if there is no save path.
+            model_package (str, optional): The model package for the skeleton
+                projects. Defaults to "gwlfe".
+            max_idle (int, optional): The number of idle projects to keep for re-use
+                before deleting them in the background. Defaults to 25.
+        """
+        self.mmw_api = mmw_api
+        self.model_package = model_package
+        self.max_idle = max_idle
+
+        if ledger_path is None and mmw_api.save_path is not None:
+            ledger_path = mmw_api.save_path + "project_ledger.jsonl"
+        self.ledger_path = ledger_path
+
+        self._lock = threading.Lock()
+        self._ledger_lock = threading.Lock()
+        # the area of interest each project currently points at
+        self._project_aois: Dict[Union[str, int], str] = {}
+        self._aoi_projects: Dict[str, Union[str, int]] = {}
+        # the number of users of each project; idle projects are in order of release
+        self._in_use: Dict[Union[str, int], int] = {}
+        self._idle: List[Union[str, int]] = []
+        self._aoi_locks: Dict[str, threading.Lock] = {}
+
+        self._cleanup_executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_deletes: List[Future] = []
+
+    def __enter__(self) -> "ModelMyWatershedProjectPool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _write_ledger(self, event: str, project_id: Union[str, int]) -> None:
+        """Appends a project event to the ledger file"""
+        if self.ledger_path is None:
+            return
+        with self._ledger_lock:
+            with open(self.ledger_path, "a") as fp:
+                fp.write(
+                    json.dumps(
+                        {
+                            "event": event,
+                            "project_id": project_id,
+                            "request_host": self.mmw_api.mmw_host,
+                            "time": time.time(),
+                        }
+                    )
+                    + "\n"
+                )
+
+    def read_ledger(self) -> List[Union[str, int]]:
+        """Reads the ledger and returns the projects on the current host that were
+        created but never deleted.
+
+        Returns:
+            List[Union[str, int]]: The ids of the projects that were not deleted
+        """
+        if self.ledger_path is None or not Path(self.ledger_path).is_file():
+            return []
+
+        live_projects: Dict[Union[str, int], bool] = {}
+        with open(self.ledger_path) as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line may be partially written if the session crashed
+                    continue
+                if entry["request_host"] != self.mmw_api.mmw_host:
+                    continue
+                if entry["event"] == "created":
+                    live_projects[entry["project_id"]] = True
+                elif entry["event"] == "deleted":
+                    live_projects.pop(entry["project_id"], None)
+        return list(live_projects.keys())
+
+    def cleanup_orphans(self) -> int:
+        """Deletes any projects recorded in the ledger that were never deleted and are
+        not in use by this pool, ie, because an earlier session crashed.
+
+        Returns:
+            int: The number of orphaned projects that were deleted
+        """
+        with self._lock:
+            pooled_projects = set(self._project_aois.keys())
+        orphans = [
+            project_id
+            for project_id in self.read_ledger()
+            if project_id not in pooled_projects
+        ]
+        n_deleted = 0
+        for project_id in orphans:
+            if self._delete_project(project_id):
+                n_deleted += 1
+        if len(orphans) > 0:
+            self.pool_logger.info(
+                "\tDeleted {} of {} orphaned projects".format(n_deleted, len(orphans))
+            )
+        return n_deleted
+
+    def _delete_project(self, project_id: Union[str, int]) -> bool:
+        deleted = self.mmw_api.delete_project(project_id)
+        if deleted:
+            self._write_ledger("deleted", project_id)
+        else:
+            self.pool_logger.warn(
+                "\tFailed to delete project {}; it remains in the ledger".format(
+                    project_id
+                )
+            )
+        return deleted
+
+    def _get_aoi_lock(self, aoi_key: str) -> threading.Lock:
+        with self._lock:
+            if aoi_key not in self._aoi_locks:
+                self._aoi_locks[aoi_key] = threading.Lock()
+            return self._aoi_locks[aoi_key]
+
+    def _forget_project(self, project_id: Union[str, int]) -> None:
+        """Removes a project from the pool's book-keeping; call with the lock held"""
+        aoi_key = self._project_aois.pop(project_id, None)
+        if aoi_key is not None and self._aoi_projects.get(aoi_key) == project_id:
+            del self._aoi_projects[aoi_key]
+        self._in_use.pop(project_id, None)
+        if project_id in self._idle:
+            self._idle.remove(project_id)
+
+    def acquire(
+        self,
+        area_of_interest: Union[Dict, None] = None,
+        wkaoi: Union[str, None] = None,
+        huc: Union[str, None] = None,
+        layer_overrides: Union[ModemMyWatershedLayerOverride, None] = None,
+    ) -> Union[str, int, None]:
+        """Gets a project for an area of interest, re-using or re-targeting an existing
+        project if possible.  One of the area_of_interest, wkaoi, or huc must be given.
+        Every acquired project must be given back with `release`.
+
+        Args:
+            area_of_interest (Union[Dict, None]): A geojson of the area of interest
+            wkaoi (Union[str, None]): A well known area of interest identifier
+            huc (Union[str, None]): A HUC identifier code (HUC8, HUC10, or HUC12)
+            layer_overrides (ModemMyWatershedLayerOverride): Any layer overrides to
+                use in the project
+
+        Returns:
+            Union[str, int, None]: The project id, or None if no project could be made
+        """
+        try:
+            mmw_aoi = ModelMyWatershedAOI.from_kwargs(area_of_interest, wkaoi, huc)
+        except ValueError as ex:
+            self.pool_logger.error("\t***Invalid area of interest: {}***".format(ex))
+            return None
+        if mmw_aoi is None:
+            self.pool_logger.error(
+                "\t***Either a HUC code, an WKAoI, or a geojson is required to get a project!***"
+            )
+            return None
+        aoi_key = mmw_aoi.key
+        if layer_overrides is not None:
+            aoi_key += ":" + json.dumps(layer_overrides, sort_keys=True)
+
+        # only one caller at a time may make a project for the same area; the others
+        # wait for it and then re-use it
+        with self._get_aoi_lock(aoi_key):
+            retarget_id = None
+            with self._lock:
+                # re-use a project already pointing at this area
+                if aoi_key in self._aoi_projects:
+                    project_id = self._aoi_projects[aoi_key]
+                    self._in_use[project_id] = self._in_use.get(project_id, 0) + 1
+                    if project_id in self._idle:
+                        self._idle.remove(project_id)
+                    return project_id
+                # otherwise, take the oldest idle project to point at a new shape
+                if mmw_aoi.kind == "geojson" and len(self._idle) > 0:
+                    retarget_id = self._idle.pop(0)
+                    self._forget_project(retarget_id)
+
+            if retarget_id is not None:
+                updated_project = self.mmw_api.update_project(
+                    retarget_id,
+                    model_package=self.model_package,
+                    area_of_interest=mmw_aoi.value,
+                    layer_overrides=layer_overrides,
+                )
+                if "id" in updated_project.keys():
+                    self.pool_logger.debug(
+                        "\tRe-targeted project {} to {}".format(retarget_id, aoi_key)
+                    )
+                    return self._add_project(retarget_id, aoi_key)
+                # if the project can't be updated, get rid of it and make a new one
+                self._pending_deletes.append(
+                    self._cleanup_executor.submit(self._delete_project, retarget_id)
+                )
+
+            new_project = self.mmw_api.create_project(
+                model_package=self.model_package,
+                name="Pooled Project",
+                layer_overrides=layer_overrides,
+                **mmw_aoi.project_kwargs()
+            )
+            if "id" not in new_project.keys():
+                self.pool_logger.error(
+                    "\t***Could not create a project for {}***".format(aoi_key)
+                )
+                return None
+            self._write_ledger("created", new_project["id"])
+            return self._add_project(new_project["id"], aoi_key)
+
+    def _add_project(
+        self, project_id: Union[str, int], aoi_key: str
+    ) -> Union[str, int]:
+        with self._lock:
+            self._project_aois[project_id] = aoi_key
+            self._aoi_projects[aoi_key] = project_id
+            self._in_use[project_id] = self._in_use.get(project_id, 0) + 1
+        return project_id
+
+    def release(self, project_id: Union[str, int]) -> None:
+        """Gives a project back to the pool
+
+        Args:
+            project_id (Union[str, int]): The project id from `acquire`
+        """
+        to_delete = []
+        with self._lock:
+            if project_id not in self._in_use:
+                return
+            self._in_use[project_id] -= 1
+            if self._in_use[project_id] > 0:
+                return
+            self._idle.append(project_id)
+            while len(self._idle) > self.max_idle:
+                oldest_id = self._idle[0]
+                self._forget_project(oldest_id)
+                to_delete.append(oldest_id)
+        for oldest_id in to_delete:
+            self._pending_deletes.append(
+                self._cleanup_executor.submit(self._delete_project, oldest_id)
+            )
+
+    @contextmanager
+    def project(
+        self,
+        area_of_interest: Union[Dict, None] = None,
+        wkaoi: Union[str, None] = None,
+        huc: Union[str, None] = None,
+        layer_overrides: Union[ModemMyWatershedLayerOverride, None] = None,
+    ) -> Iterator[Union[str, int, None]]:
+        """Acquires a project for the duration of a with block and then releases it.
+        The arguments are the same as for `acquire`.
+        """
+        project_id = self.acquire(area_of_interest, wkaoi, huc, layer_overrides)
+        try:
+            yield project_id
+        finally:
+            if project_id is not None:
+                self.release(project_id)
+
+    def close(self) -> None:
+        """Deletes all of the projects in the pool and shuts down the cleanup thread."""
+        with self._lock:
+            remaining_projects = list(self._project_aois.keys())
+            for project_id in remaining_projects:
+                self._forget_project(project_id)
+        for project_id in remaining_projects:
+            self._pending_deletes.append(
+                self._cleanup_executor.submit(self._delete_project, project_id)
+            )
+        for delete_future in self._pending_deletes:
+            try:
+                delete_future.result()
+            except Exception as ex:
+                self.pool_logger.warn("\tFailed to delete project: {}".format(ex))
+        self._pending_deletes = []
+        self._cleanup_executor.shutdown(wait=True)
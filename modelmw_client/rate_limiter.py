@@ -0,0 +1,79 @@
+"""
+A token bucket for limiting the rate of requests to ModelMyWatershed.
+"""
+#%%
+import logging
+import threading
+import time
+from typing import Union
+
+module_logger = logging.getLogger(__name__)
+
+
+#%%
+class ModelMyWatershedRateLimiter:
+    """A token bucket for starting jobs, with some of the bucket held back for
+    high-priority jobs.
+
+    Tokens refill at `requests_per_minute`, up to `burst` tokens.  Low-priority jobs
+    can only take a token while more than `reserved` tokens are left, so a burst of
+    background jobs never uses up the budget an interactive job needs to start right
+    away.
+    """
+
+    def __init__(
+        self, requests_per_minute: float = 20, burst: int = 4, reserved: int = 1
+    ):
+        """Create a new rate limiter
+
+        Args:
+            requests_per_minute (float, optional): The long-run rate of requests.
+                Defaults to 20.
+            burst (int, optional): The most requests that can be made at once after a
+                quiet period. Defaults to 4.
+            reserved (int, optional): The number of tokens only high-priority requests
+                can use. Defaults to 1.
+        """
+        self.requests_per_minute = requests_per_minute
+        self.burst = burst
+        self.reserved = min(reserved, burst - 1)
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._condition = threading.Condition()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            self.burst,
+            self._tokens + (now - self._last_refill) * self.requests_per_minute / 60,
+        )
+        self._last_refill = now
+
+    def acquire(
+        self, use_reserve: bool = False, timeout: Union[float, None] = None
+    ) -> bool:
+        """Waits for and takes a token
+
+        Args:
+            use_reserve (bool, optional): Allow taking the reserved tokens.
+                Defaults to False.
+            timeout (Union[float, None], optional): The longest to wait, in seconds.
+                Defaults to None, to wait as long as needed.
+
+        Returns:
+            bool: True if a token was taken, False if the wait timed out
+        """
+        floor = 0 if use_reserve else self.reserved
+        give_up_time = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                self._refill()
+                if self._tokens - 1 >= floor:
+                    self._tokens -= 1
+                    return True
+                wait_time = (floor + 1 - self._tokens) * 60 / self.requests_per_minute
+                if give_up_time is not None:
+                    wait_time = min(wait_time, give_up_time - time.monotonic())
+                    if wait_time <= 0:
+                        return False
+                self._condition.wait(wait_time)
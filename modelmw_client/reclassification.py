@@ -0,0 +1,343 @@
+"""
+Integer-coded reclassification of NLCD land cover into MapShed land cover.
+"""
+#%%
+import logging
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple, Union
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+module_logger = logging.getLogger(__name__)
+
+# The NLCD land cover classes, by code
+NLCD_CLASSES: Dict[int, str] = {
+    11: "Open Water",
+    12: "Perennial Ice/Snow",
+    21: "Developed, Open Space",
+    22: "Developed, Low Intensity",
+    23: "Developed, Medium Intensity",
+    24: "Developed, High Intensity",
+    31: "Barren Land (Rock/Sand/Clay)",
+    41: "Deciduous Forest",
+    42: "Evergreen Forest",
+    43: "Mixed Forest",
+    52: "Shrub/Scrub",
+    71: "Grassland/Herbaceous",
+    81: "Pasture/Hay",
+    82: "Cultivated Crops",
+    90: "Woody Wetlands",
+    95: "Emergent Herbaceous Wetlands",
+}
+
+
+#%%
+class ModelMyWatershedLandCoverReclassifier:
+    """Reclassifies NLCD land cover areas into the MapShed land cover classes of a
+    GWLF-E run, for one or thousands of areas at once.
+
+    The class mappings are turned into integer lookup tables once: a table indexed by
+    NLCD code and a hash index of NLCD names, both giving the position of the MapShed
+    class in the MapShed "Area" list (ie, 2 for "03-Forest", the "Area__2"
+    modification), or -1 for classes without a MapShed equivalent (ie, open water).
+    The areas are then summed by group and MapShed class in a single `bincount`,
+    instead of replacing strings and grouping a frame for each area.
+    """
+
+    reclassifier_logger = module_logger.getChild(__qualname__)
+
+    def __init__(
+        self,
+        nlcd_to_mapshed: Dict[str, Union[str, None]],
+        mapshed_to_area_id: Dict[str, str],
+        nlcd_classes: Dict[int, str] = NLCD_CLASSES,
+    ):
+        """Create the lookup tables for a reclassification
+
+        Args:
+            nlcd_to_mapshed (Dict[str, Union[str, None]]): The MapShed class of each
+                NLCD class name, or None for classes that aren't counted, ie,
+                `ModelMyWatershedAPI.nlcd_to_mapshed`
+            mapshed_to_area_id (Dict[str, str]): The "Area__<position>" modification
+                key of each MapShed class, ie, `ModelMyWatershedAPI.mapshed_to_area_id`
+            nlcd_classes (Dict[int, str], optional): The names of the NLCD classes, by
+                code. Defaults to the NLCD legend.
+        """
+        import numpy as np
+        import pandas as pd
+
+        mapshed_positions = {
+            mapshed_class: int(area_id.split("__")[-1])
+            for mapshed_class, area_id in mapshed_to_area_id.items()
+        }
+        self.n_classes = max(mapshed_positions.values()) + 1
+        # the modification key and MapShed class at each position
+        self.area_ids: List[str] = [
+            "Area__{}".format(position) for position in range(self.n_classes)
+        ]
+        self.mapshed_classes: List[Union[str, None]] = [None] * self.n_classes
+        for mapshed_class, position in mapshed_positions.items():
+            self.mapshed_classes[position] = mapshed_class
+
+        name_positions = {
+            nlcd_name: (
+                mapshed_positions[mapshed_class] if mapshed_class is not None else -1
+            )
+            for nlcd_name, mapshed_class in nlcd_to_mapshed.items()
+        }
+        self.name_index = pd.Index(list(name_positions.keys()))
+        self.name_positions = np.array(list(name_positions.values()), dtype=np.int64)
+
+        self.code_positions = np.full(256, -1, dtype=np.int64)
+        for nlcd_code, nlcd_name in nlcd_classes.items():
+            self.code_positions[nlcd_code] = name_positions.get(nlcd_name, -1)
+
+        # the classes that are left out on purpose, rather than because they're unknown
+        self.uncounted_names = [
+            nlcd_name
+            for nlcd_name, mapshed_class in nlcd_to_mapshed.items()
+            if mapshed_class is None
+        ]
+        self.uncounted_codes = [
+            nlcd_code
+            for nlcd_code, nlcd_name in nlcd_classes.items()
+            if nlcd_name in self.uncounted_names
+        ]
+
+    def classify(
+        self,
+        nlcd_codes: Union["np.ndarray", List, None] = None,
+        nlcd_names: Union["np.ndarray", List, None] = None,
+    ) -> "np.ndarray":
+        """Finds the MapShed class of NLCD classes, by code where there is one and by
+        name otherwise
+
+        Args:
+            nlcd_codes (Union[np.ndarray, List, None], optional): The NLCD codes, with
+                NaN or a negative number where the code isn't known. Defaults to None.
+            nlcd_names (Union[np.ndarray, List, None], optional): The NLCD names, ie,
+                the "type" of land use survey categories. Defaults to None.
+
+        Returns:
+            np.ndarray: The position of the MapShed class of each, or -1
+        """
+        import numpy as np
+
+        positions = None
+        if nlcd_codes is not None:
+            codes = np.asarray(nlcd_codes, dtype=float)
+            known = (codes >= 0) & (codes < len(self.code_positions))
+            positions = np.full(len(codes), -1, dtype=np.int64)
+            positions[known] = self.code_positions[codes[known].astype(np.int64)]
+        if nlcd_names is not None:
+            name_codes = self.name_index.get_indexer(list(nlcd_names))
+            name_positions = np.where(
+                name_codes >= 0, self.name_positions[name_codes], -1
+            )
+            if positions is None:
+                positions = name_positions
+            else:
+                positions = np.where(positions >= 0, positions, name_positions)
+        if positions is None:
+            raise ValueError("Either NLCD codes or names are needed")
+        return positions
+
+    def aggregate(
+        self,
+        positions: "np.ndarray",
+        areas: "np.ndarray",
+        group_codes: Union["np.ndarray", None] = None,
+        n_groups: int = 1,
+    ) -> Tuple["np.ndarray", "np.ndarray"]:
+        """Sums areas by group and MapShed class
+
+        Args:
+            positions (np.ndarray): The MapShed class of each area, from `classify`;
+                areas in class -1 are left out
+            areas (np.ndarray): The areas
+            group_codes (Union[np.ndarray, None], optional): The group (ie, the AOI)
+                of each area, from 0 to `n_groups - 1`. Defaults to None, for one group.
+            n_groups (int, optional): The number of groups. Defaults to 1.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The summed areas and the number of areas
+                summed, each of shape (group x MapShed class)
+        """
+        import numpy as np
+
+        positions = np.asarray(positions)
+        if group_codes is None:
+            group_codes = np.zeros(len(positions), dtype=np.int64)
+        counted = positions >= 0
+        cells = np.asarray(group_codes)[counted] * self.n_classes + positions[counted]
+        cell_areas = np.asarray(areas, dtype=float)[counted]
+        n_cells = n_groups * self.n_classes
+        n_summed = np.bincount(cells, minlength=n_cells)
+
+        # Kahan-compensated sums, the same as pandas' groupby sums, so the results
+        # match those of a groupby to the last bit.  Each pass adds the next area of
+        # every cell at once, so there are only as many passes as the most areas in
+        # one cell (ie, the four NLCD forest and shrub classes).
+        order = np.argsort(cells, kind="stable")
+        cells = cells[order]
+        cell_areas = cell_areas[order]
+        rank_in_cell = np.arange(len(cells)) - np.repeat(
+            np.cumsum(n_summed) - n_summed, n_summed
+        )
+        summed_areas = np.zeros(n_cells)
+        compensation = np.zeros(n_cells)
+        for rank in range(int(n_summed.max()) if len(cells) > 0 else 0):
+            at_rank = rank_in_cell == rank
+            rank_cells = cells[at_rank]
+            compensated = cell_areas[at_rank] - compensation[rank_cells]
+            new_sums = summed_areas[rank_cells] + compensated
+            compensation[rank_cells] = (
+                new_sums - summed_areas[rank_cells]
+            ) - compensated
+            summed_areas[rank_cells] = new_sums
+        return (
+            summed_areas.reshape(n_groups, self.n_classes),
+            n_summed.reshape(n_groups, self.n_classes),
+        )
+
+    def reclassify_table(
+        self,
+        land_use_table: "pd.DataFrame",
+        group_columns: Union[List[str], None] = None,
+    ) -> "pd.DataFrame":
+        """Makes a MapShed land cover table from a table of land use survey categories,
+        ie, from `normalize_analysis_results` or a dump ingest
+
+        Args:
+            land_use_table (pd.DataFrame): The categories, with their "area" in square
+                meters and their "nlcd" code and/or "type" name
+            group_columns (Union[List[str], None], optional): The columns identifying
+                each land use survey. Defaults to None, for "job_label" and, if it is
+                in the table, "Land_Use_Source".
+
+        Returns:
+            pd.DataFrame: One row for each survey, with the group columns and the area
+                in hectares of each MapShed class, by its modification key
+                ("Area__<position>")
+        """
+        import numpy as np
+        import pandas as pd
+
+        if group_columns is None:
+            group_columns = [
+                column
+                for column in ["job_label", "Land_Use_Source"]
+                if column in land_use_table.columns
+            ]
+        positions = self.classify(
+            land_use_table["nlcd"] if "nlcd" in land_use_table.columns else None,
+            land_use_table["type"] if "type" in land_use_table.columns else None,
+        )
+        group_index = pd.MultiIndex.from_frame(land_use_table[group_columns])
+        group_codes, groups = pd.factorize(group_index)
+        summed_areas, _ = self.aggregate(
+            positions,
+            land_use_table["area"].to_numpy(dtype=float) / 10000,
+            group_codes,
+            len(groups),
+        )
+
+        mapshed_table = pd.DataFrame(
+            {
+                column: groups.get_level_values(level)
+                for level, column in enumerate(group_columns)
+            }
+        )
+        for position in np.unique(self.name_positions[self.name_positions >= 0]):
+            mapshed_table[self.area_ids[position]] = summed_areas[:, position]
+        return mapshed_table
+
+    @classmethod
+    def scale_to_totals(
+        cls, summed_areas: "np.ndarray", mapshed_totals: "np.ndarray"
+    ) -> "np.ndarray":
+        """Scales each group's areas so they add up to its MapShed total area, the same
+        as the ModelMyWatershed site does for land cover presets
+
+        Args:
+            summed_areas (np.ndarray): The areas of shape (group x MapShed class), from
+                `aggregate`
+            mapshed_totals (np.ndarray): The total area of each group in its unmodified
+                MapShed (GWLF-E prepare) result, the sum of its "Area"
+
+        Returns:
+            np.ndarray: The scaled areas, all zero for groups with no land cover that
+                has a MapShed class
+        """
+        import numpy as np
+
+        summed_areas = np.asarray(summed_areas, dtype=float)
+        row_sums = summed_areas.sum(axis=1)[:, np.newaxis]
+        empty_groups = np.flatnonzero(row_sums[:, 0] == 0)
+        if len(empty_groups) > 0:
+            cls.reclassifier_logger.warn(
+                "\tNo land cover with a MapShed class to scale in groups {}".format(
+                    empty_groups.tolist()
+                )
+            )
+        return np.divide(
+            summed_areas * np.asarray(mapshed_totals, dtype=float)[:, np.newaxis],
+            row_sums,
+            out=np.zeros_like(summed_areas),
+            where=row_sums != 0,
+        )
+
+    def to_modifications(
+        self, categories: List[Dict[str, Any]], mapshed_total: float
+    ) -> Dict[str, float]:
+        """Converts the categories of one land use survey into GWLF-E land cover
+        modifications
+
+        Args:
+            categories (List[Dict[str, Any]]): The survey "categories" of a land
+                analysis result, each with its "area" in square meters and its "nlcd"
+                code and/or "type" name
+            mapshed_total (float): The sum of the "Area" of the unmodified MapShed
+                (GWLF-E prepare) result
+
+        Returns:
+            Dict[str, float]: The area in hectares of each MapShed class found in the
+                survey, by its modification key, scaled to the MapShed total
+        """
+        import numpy as np
+
+        positions = self.classify(
+            [category.get("nlcd", -1) for category in categories],
+            [category.get("type") for category in categories],
+        )
+        unknown_types = [
+            category.get("type", category.get("nlcd"))
+            for category, position in zip(categories, positions)
+            if position < 0
+            and category.get("nlcd") not in self.uncounted_codes
+            and category.get("type") not in self.uncounted_names
+        ]
+        if len(unknown_types) > 0:
+            self.reclassifier_logger.warn(
+                "\tLeaving out land cover with no MapShed class: {}".format(
+                    unknown_types
+                )
+            )
+        summed_areas, n_summed = self.aggregate(
+            positions,
+            np.array([category["area"] for category in categories], dtype=float)
+            / 10000,
+        )
+        found = n_summed[0] > 0
+        if not found.any():
+            return {}
+        scaled_areas = summed_areas[0] * mapshed_total / summed_areas[0][found].sum()
+        # in order of MapShed class name, as a grouping by class would give them
+        return {
+            self.area_ids[position]: float(scaled_areas[position])
+            for position in sorted(
+                np.flatnonzero(found),
+                key=lambda position: self.mapshed_classes[position],
+            )
+        }
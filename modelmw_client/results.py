@@ -0,0 +1,165 @@
+"""
+Normalization of ModelMyWatershed job results into tables.
+"""
+#%%
+import logging
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+module_logger = logging.getLogger(__name__)
+
+# The scalar keys of a TR-55 runoff result that are not totals
+_TR55_RUNOFF_SKIP_KEYS = ["BMPs", "cell_count", "distribution"]
+
+
+#%%
+class _TableBuilder:
+    """Collects rows column by column, so a frame can be made in one step at the end
+    instead of making and concatenating a frame for each job."""
+
+    __slots__ = ("columns", "n_rows")
+
+    def __init__(self):
+        self.columns: Dict[str, List] = {}
+        self.n_rows = 0
+
+    def add_row(self, row: Dict[str, Any]) -> None:
+        for column in row.keys():
+            if column not in self.columns:
+                # fill in the new column for the rows before it first appeared
+                self.columns[column] = [None] * self.n_rows
+        for column, values in self.columns.items():
+            values.append(row.get(column))
+        self.n_rows += 1
+
+    def to_frame(self) -> "pd.DataFrame":
+        import pandas as pd
+
+        return pd.DataFrame(self.columns)
+
+
+def normalize_analysis_results(
+    labeled_results: List[Tuple[Dict[str, Any], Dict]],
+) -> "pd.DataFrame":
+    """Flattens the survey categories of analysis results (ie, land use) into one
+    table in a single pass.
+
+    Args:
+        labeled_results (List[Tuple[Dict[str, Any], Dict]]): Pairs of identifying
+            columns (ie, the job label and request endpoint) and the analysis "result"
+            json for each job
+
+    Returns:
+        pd.DataFrame: One row for each category of each job
+    """
+    categories = _TableBuilder()
+    for labels, result in labeled_results:
+        for category in result["survey"]["categories"]:
+            categories.add_row({**category, **labels})
+    return categories.to_frame()
+
+
+def normalize_tr55_results(
+    labeled_results: List[Tuple[Dict[str, Any], Dict]],
+    scenario: str = "unmodified",
+) -> Dict[str, "pd.DataFrame"]:
+    """Flattens TR-55 results into four long-format tables in a single pass.
+
+    Args:
+        labeled_results (List[Tuple[Dict[str, Any], Dict]]): Pairs of identifying
+            columns (ie, the job label, AOI and land use layer) and the TR-55 "result"
+            json for each job
+        scenario (str, optional): The runoff and quality scenario to read. Defaults to
+            "unmodified".
+
+    Returns:
+        Dict[str, pd.DataFrame]: The tables "tr55_censuses" (cell counts for each
+            land cover and soil category), "tr55_runoff_distributions" (runoff, ET and
+            infiltration by category), "tr55_runoff_totals" (one row per job) and
+            "step_l_qualities" (loads by measure).
+    """
+    censuses = _TableBuilder()
+    runoff_distributions = _TableBuilder()
+    runoff_totals = _TableBuilder()
+    qualities = _TableBuilder()
+
+    for labels, result in labeled_results:
+        for category, values in result["aoi_census"]["distribution"].items():
+            censuses.add_row({**labels, "category": category, **values})
+
+        runoff = result["runoff"][scenario]
+        for category, values in runoff["distribution"].items():
+            runoff_distributions.add_row({**labels, "category": category, **values})
+        runoff_totals.add_row(
+            {
+                **labels,
+                **{
+                    key: val
+                    for key, val in runoff.items()
+                    if key not in _TR55_RUNOFF_SKIP_KEYS
+                },
+            }
+        )
+
+        for quality in result["quality"][scenario]:
+            qualities.add_row({**labels, **quality})
+
+    return {
+        "tr55_censuses": censuses.to_frame(),
+        "tr55_runoff_distributions": runoff_distributions.to_frame(),
+        "tr55_runoff_totals": runoff_totals.to_frame(),
+        "step_l_qualities": qualities.to_frame(),
+    }
+
+
+def normalize_gwlfe_results(
+    labeled_results: List[Tuple[Dict[str, Any], Dict]],
+) -> Dict[str, "pd.DataFrame"]:
+    """Flattens GWLF-E results into five tables in a single pass.
+
+    Args:
+        labeled_results (List[Tuple[Dict[str, Any], Dict]]): Pairs of identifying
+            columns (ie, the job label, AOI and land use source) and the GWLF-E
+            "result" json for each job
+
+    Returns:
+        Dict[str, pd.DataFrame]: The tables "gwlfe_monthly" (with a 1-based "month"
+            column), "gwlfe_load_summaries", "gwlfe_lu_loads", "gwlfe_metadata" and
+            "gwlfe_summaries" (the remaining scalar results), with one or more rows per
+            job.
+    """
+    monthlies = _TableBuilder()
+    load_summaries = _TableBuilder()
+    lu_loads = _TableBuilder()
+    metas = _TableBuilder()
+    summaries = _TableBuilder()
+
+    for labels, result in labeled_results:
+        for month, monthly in enumerate(result["monthly"], start=1):
+            monthlies.add_row({**monthly, "month": month, **labels})
+        for load_summary in result["SummaryLoads"]:
+            load_summaries.add_row({**load_summary, **labels})
+        for lu_load in result["Loads"]:
+            lu_loads.add_row({**lu_load, **labels})
+        metas.add_row({**result["meta"], **labels})
+        summaries.add_row(
+            {
+                **{
+                    key: val
+                    for key, val in result.items()
+                    if key not in ["monthly", "SummaryLoads", "Loads", "meta"]
+                    and not isinstance(val, (list, dict))
+                },
+                **labels,
+            }
+        )
+
+    return {
+        "gwlfe_monthly": monthlies.to_frame(),
+        "gwlfe_load_summaries": load_summaries.to_frame(),
+        "gwlfe_lu_loads": lu_loads.to_frame(),
+        "gwlfe_metadata": metas.to_frame(),
+        "gwlfe_summaries": summaries.to_frame(),
+    }
@@ -0,0 +1,714 @@
+"""
+A declarative matrix of model scenarios, run as a dependency graph of jobs.
+"""
+#%%
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Any, Dict, List, Set, Tuple, Union
+
+from .aoi import ModelMyWatershedAOI
+from .model_client import ModelMyWatershedAPI
+from .payload import ModelMyWatershedPayloadTemplate
+from .planner import (
+    ModelMyWatershedPlannedJob,
+    ModelMyWatershedRunPlan,
+    ModelMyWatershedRunPlanner,
+)
+from .results import normalize_gwlfe_results, normalize_tr55_results
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+module_logger = logging.getLogger(__name__)
+
+
+#%%
+class ModelMyWatershedScenarioJob:
+    """One job in a scenario matrix and the jobs whose results it needs"""
+
+    __slots__ = (
+        "name",
+        "kind",
+        "aoi",
+        "land_use_layer",
+        "modification",
+        "depends_on",
+        "cache_key",
+        "result",
+        "status",
+    )
+
+    def __init__(
+        self,
+        kind: str,
+        aoi: ModelMyWatershedAOI,
+        land_use_layer: Union[str, None] = None,
+        modification: Union[str, None] = None,
+        depends_on: Union[List[str], None] = None,
+    ):
+        self.kind = kind
+        self.aoi = aoi
+        self.land_use_layer = land_use_layer
+        self.modification = modification
+        self.name = self.make_name(kind, aoi, land_use_layer, modification)
+        self.depends_on: List[str] = depends_on if depends_on is not None else []
+        self.cache_key: Union[str, None] = None
+        self.result: Any = None
+        self.status: str = "Not Started"
+
+    @staticmethod
+    def make_name(
+        kind: str,
+        aoi: ModelMyWatershedAOI,
+        land_use_layer: Union[str, None] = None,
+        modification: Union[str, None] = None,
+    ) -> str:
+        return ":".join(
+            piece
+            for piece in [kind, aoi.job_label, land_use_layer, modification]
+            if piece is not None
+        )
+
+    @property
+    def job_label(self) -> str:
+        """The label the job's output file is saved under"""
+        return "_".join(
+            piece
+            for piece in [self.aoi.job_label, self.land_use_layer, self.modification]
+            if piece is not None
+        )
+
+    def __repr__(self) -> str:
+        return "ModelMyWatershedScenarioJob({}, {})".format(self.name, self.status)
+
+
+class ModelMyWatershedScenarioMatrix:
+    """Runs every combination of areas of interest, land use layers and land use
+    modifications through the requested models.
+
+    The matrix is turned into a graph of jobs, where each job waits only for the
+    jobs whose results it needs:
+
+    - GWLF-E needs a MapShed (GWLF-E prepare) job for its AOI and land use layer.
+    - Modified GWLF-E runs also need the land use modifications, which are made from
+      the DRB 2100 land analysis for the modification source and the MapShed results
+      for the modification base layer.
+    - TR-55 and the land analyses don't depend on any other jobs.
+
+    Jobs are run as soon as their inputs are ready, up to `max_workers` at a time.
+    When more jobs are ready than can be run, the jobs at the head of the longest
+    expected chain of remaining work (from the API client's cost model) go first.
+    Results are kept in the API client's result cache, so a matrix that was
+    interrupted (or re-run with more AOIs or layers) resumes from the finished jobs.
+    Cached GWLF-E results don't need a new MapShed job at all.  Which GWLF-E and TR-55
+    results are still current is decided by a run planner, which can also re-run
+    results that are too old; `plan` shows what a run would do without running it.
+    """
+
+    matrix_logger = module_logger.getChild(__qualname__)
+
+    def __init__(
+        self,
+        mmw_api: ModelMyWatershedAPI,
+        list_of_aois: List,
+        land_use_layers: Union[List[str], None] = None,
+        modifications: Union[List[str], None] = None,
+        models: Union[List[str], None] = None,
+        modification_layer: str = "2019_2019",
+        tr55_precipitation: float = 3.33,
+        max_workers: int = 4,
+        planner: Union[ModelMyWatershedRunPlanner, None] = None,
+    ):
+        """Declares a scenario matrix
+
+        Args:
+            mmw_api (ModelMyWatershedAPI): The API client to run the jobs with
+            list_of_aois (List): A list of AOI's.  They can be strings, geojsons or
+                ModelMyWatershedAOI's.
+            land_use_layers (Union[List[str], None], optional): The keys of the land
+                use layers (from `ModelMyWatershedAPI.land_use_layers`) to model.
+                Defaults to all of them.
+            modifications (Union[List[str], None], optional): The land use
+                modification sources: "unmodified" and/or any of the DRB 2100
+                predictions in `ModelMyWatershedAPI.drb_2011_keys`. Defaults to
+                ["unmodified", "centers", "corridors"].
+            models (Union[List[str], None], optional): The models to run, "gwlfe"
+                and/or "tr55". Defaults to both.
+            modification_layer (str, optional): The land use layer the modifications
+                are applied to; all other layers are only run unmodified. Defaults to
+                "2019_2019".
+            tr55_precipitation (float, optional): The 24-hour precipitation depth for
+                TR-55, in inches. Defaults to 3.33.
+            max_workers (int, optional): The number of jobs to run at once.
+                Defaults to 4.
+            planner (Union[ModelMyWatershedRunPlanner, None], optional): The planner
+                that decides which results are current. Defaults to None, for a planner
+                whose results never go stale, with its manifest in the API client's
+                save path.
+        """
+        self.mmw_api = mmw_api
+        self.aois: List[ModelMyWatershedAOI] = []
+        for run_number, aoi in enumerate(list_of_aois, start=1):
+            try:
+                mmw_aoi = ModelMyWatershedAOI.from_any(aoi, run_number)
+                mmw_aoi.validate(single_ring=False)
+            except ValueError as ex:
+                self.matrix_logger.warn("\tSkipping invalid AOI: {}".format(ex))
+                continue
+            self.aois.append(mmw_aoi)
+
+        self.land_use_layers = (
+            list(mmw_api.land_use_layers.keys())
+            if land_use_layers is None
+            else land_use_layers
+        )
+        self.modifications = (
+            ["unmodified", "centers", "corridors"]
+            if modifications is None
+            else modifications
+        )
+        for modification in self.modifications:
+            if (
+                modification != "unmodified"
+                and modification not in mmw_api.drb_2011_keys
+            ):
+                raise ValueError(
+                    "Unknown land use modification source {}".format(modification)
+                )
+        self.models = ["gwlfe", "tr55"] if models is None else models
+        self.modification_layer = modification_layer
+        self.tr55_precipitation = tr55_precipitation
+        self.max_workers = max_workers
+        self.planner = (
+            planner
+            if planner is not None
+            else ModelMyWatershedRunPlanner(mmw_api, max_workers=max_workers)
+        )
+
+        self._mapshed_template = ModelMyWatershedPayloadTemplate({})
+        self._gwlfe_template = ModelMyWatershedPayloadTemplate(
+            {"inputmod_hash": mmw_api.inputmod_hash}
+        )
+        self._tr55_template = mmw_api.get_tr55_template()
+
+        self.jobs: Dict[str, ModelMyWatershedScenarioJob] = {}
+        # the jobs whose cached results are stale, and must be run again
+        self._stale_jobs: Set[str] = set()
+        # a lock for each MapShed job, so it is only re-run once when it gets too old
+        self._mapshed_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _add_job(self, job: ModelMyWatershedScenarioJob) -> str:
+        if job.name not in self.jobs:
+            self.jobs[job.name] = job
+        return job.name
+
+    def build_jobs(self) -> Dict[str, ModelMyWatershedScenarioJob]:
+        """Builds the graph of jobs for the matrix
+
+        Returns:
+            Dict[str, ModelMyWatershedScenarioJob]: The jobs, keyed by name, in an
+                order where every job comes after the jobs it depends on
+        """
+        self.jobs = {}
+        make_cache_key = self.mmw_api.result_cache.make_key
+        for mmw_aoi in self.aois:
+            for land_use_layer in self.land_use_layers:
+                if "gwlfe" in self.models:
+                    mapshed_name = self._add_job(
+                        ModelMyWatershedScenarioJob("mapshed", mmw_aoi, land_use_layer)
+                    )
+                    self.jobs[mapshed_name].cache_key = make_cache_key(
+                        self.mmw_api.gwlfe_prepare_endpoint,
+                        self._render_mapshed_payload(mmw_aoi, land_use_layer),
+                    )
+                    layer_modifications = (
+                        self.modifications
+                        if land_use_layer == self.modification_layer
+                        else ["unmodified"]
+                    )
+                    for modification in layer_modifications:
+                        gwlfe_depends_on = [mapshed_name]
+                        if modification != "unmodified":
+                            gwlfe_depends_on.append(
+                                self._add_modification_jobs(mmw_aoi, modification)
+                            )
+                        gwlfe_job = ModelMyWatershedScenarioJob(
+                            "gwlfe",
+                            mmw_aoi,
+                            land_use_layer,
+                            modification,
+                            gwlfe_depends_on,
+                        )
+                        # the MapShed job id changes on every run, so GWLF-E results
+                        # are cached by what went in to MapShed and the modifications
+                        gwlfe_job.cache_key = make_cache_key(
+                            self.mmw_api.gwlfe_run_endpoint,
+                            {
+                                "mapshed": self.jobs[mapshed_name].cache_key,
+                                "modification": modification,
+                                "modification_layer": self.modification_layer,
+                            },
+                        )
+                        self._add_job(gwlfe_job)
+
+                if "tr55" in self.models:
+                    tr55_job = ModelMyWatershedScenarioJob(
+                        "tr55", mmw_aoi, land_use_layer
+                    )
+                    tr55_job.cache_key = make_cache_key(
+                        self.mmw_api.tr55_endpoint,
+                        self.mmw_api.render_tr55_payload(
+                            self._tr55_template,
+                            mmw_aoi,
+                            land_use_layer,
+                            self.tr55_precipitation,
+                        ),
+                    )
+                    self._add_job(tr55_job)
+        return self.jobs
+
+    def _add_modification_jobs(
+        self, mmw_aoi: ModelMyWatershedAOI, modification: str
+    ) -> str:
+        """Adds the jobs needed to create a set of land use modifications"""
+        # the land analysis isn't needed for the modifications, but it's kept as a
+        # reference for the modified land use
+        self._add_job(
+            ModelMyWatershedScenarioJob("land", mmw_aoi, self.modification_layer)
+        )
+        forecast_name = self._add_job(
+            ModelMyWatershedScenarioJob(
+                "forecast", mmw_aoi, self.modification_layer, modification
+            )
+        )
+        base_mapshed_name = self._add_job(
+            ModelMyWatershedScenarioJob("mapshed", mmw_aoi, self.modification_layer)
+        )
+        return self._add_job(
+            ModelMyWatershedScenarioJob(
+                "modifications",
+                mmw_aoi,
+                self.modification_layer,
+                modification,
+                [forecast_name, base_mapshed_name],
+            )
+        )
+
+    def _render_mapshed_payload(
+        self, mmw_aoi: ModelMyWatershedAOI, land_use_layer: str
+    ) -> bytes:
+        # NOTE:  when using the layer overrides, we need the full layer
+        # title, ie, "nlcd-2019-30m-epsg5070-512-byte".
+        return self._mapshed_template.render(
+            layer_overrides={"__LAND__": self.mmw_api.land_use_layers[land_use_layer]},
+            **{mmw_aoi.payload_key: mmw_aoi.json_bytes}
+        )
+
+    def _get_needed_jobs(self) -> List[str]:
+        """Finds the jobs that must be run: the wanted results that aren't cached, and
+        everything they depend on"""
+        needed: Dict[str, bool] = {}
+        to_check = [
+            job.name
+            for job in self.jobs.values()
+            if job.kind in ["gwlfe", "tr55", "land"]
+        ]
+        while to_check:
+            job = self.jobs[to_check.pop()]
+            if job.name in needed or job.status == "cached":
+                continue
+            needed[job.name] = True
+            to_check.extend(job.depends_on)
+        return [job_name for job_name in self.jobs.keys() if job_name in needed]
+
+    def _run_job(self, job: ModelMyWatershedScenarioJob) -> Any:
+        """Runs a single job, once all of the jobs it depends on have finished"""
+        mmw_api = self.mmw_api
+        mmw_aoi = job.aoi
+        if job.kind == "mapshed":
+            # MapShed results are only cached for as long as the server keeps the job
+            # id that GWLF-E needs (see `ModelMyWatershedAPI.mapshed_job_seconds`),
+            # counted from when the job was started
+            cached_mapshed = mmw_api.result_cache.get(job.cache_key)
+            if cached_mapshed is not None:
+                return cached_mapshed
+            mapshed_started = time.time()
+            mapshed_job_dict = mmw_api.run_mmw_job(
+                request_endpoint=mmw_api.gwlfe_prepare_endpoint,
+                job_label=job.job_label,
+                payload=self._render_mapshed_payload(mmw_aoi, job.land_use_layer),
+                size_class=mmw_aoi.size_class(),
+            )
+            if "result_response" not in mapshed_job_dict.keys():
+                return None
+            mapshed_result = {
+                "job_uuid": mapshed_job_dict["start_job_response"]["job_uuid"],
+                "result": mapshed_job_dict["result_response"]["result"],
+                "started": mapshed_started,
+            }
+            mmw_api.result_cache.put(
+                job.cache_key,
+                mapshed_result,
+                mmw_api.gwlfe_prepare_endpoint,
+                made_at=mapshed_started,
+            )
+            return mapshed_result
+
+        elif job.kind == "land":
+            return mmw_api._run_cached_job(
+                mmw_api.land_endpoint.format(job.land_use_layer),
+                job.job_label,
+                mmw_aoi.analysis_payload_json(),
+                size_class=mmw_aoi.size_class(),
+            )
+
+        elif job.kind == "forecast":
+            return mmw_api._run_cached_job(
+                mmw_api.forcast_endpoint.format(job.modification),
+                "{}_{}".format(mmw_aoi.job_label, job.land_use_layer),
+                mmw_aoi.analysis_payload_json(),
+                size_class=mmw_aoi.size_class(),
+            )
+
+        elif job.kind == "modifications":
+            forecast_job, base_mapshed_job = [
+                self.jobs[job_name] for job_name in job.depends_on
+            ]
+            return mmw_api.predictions_to_modifications(
+                forecast_job.result, base_mapshed_job.result["result"]
+            )
+
+        elif job.kind == "gwlfe":
+            mapshed_result = self._get_current_mapshed_result(
+                self.jobs[job.depends_on[0]]
+            )
+            if mapshed_result is None:
+                return None
+            land_use_modification_set = (
+                "[{}]"
+                if job.modification == "unmodified"
+                else self.jobs[job.depends_on[1]].result
+            )
+            gwlfe_job_dict = mmw_api.run_mmw_job(
+                request_endpoint=mmw_api.gwlfe_run_endpoint,
+                job_label=job.job_label,
+                payload=self._gwlfe_template.render(
+                    modifications=land_use_modification_set,
+                    job_uuid=mapshed_result["job_uuid"],
+                ),
+                size_class=mmw_aoi.size_class(),
+            )
+            if "result_response" not in gwlfe_job_dict.keys():
+                return None
+            gwlfe_result = gwlfe_job_dict["result_response"]["result"]
+            mmw_api.result_cache.put(
+                job.cache_key, gwlfe_result, mmw_api.gwlfe_run_endpoint
+            )
+            return gwlfe_result
+
+        elif job.kind == "tr55":
+            return mmw_api._run_cached_job(
+                mmw_api.tr55_endpoint,
+                job.job_label,
+                mmw_api.render_tr55_payload(
+                    self._tr55_template,
+                    mmw_aoi,
+                    job.land_use_layer,
+                    self.tr55_precipitation,
+                ),
+                job.cache_key,
+                size_class=mmw_aoi.size_class(),
+                refresh=job.name in self._stale_jobs,
+            )
+
+        raise ValueError("Unknown job kind {}".format(job.kind))
+
+    def _get_current_mapshed_result(
+        self, mapshed_job: ModelMyWatershedScenarioJob
+    ) -> Union[Dict, None]:
+        """Gets the result of a MapShed job for a GWLF-E job that is about to start,
+        re-running the MapShed job first if the server may have forgotten its job id"""
+        with self._lock:
+            mapshed_lock = self._mapshed_locks.setdefault(
+                mapshed_job.name, threading.Lock()
+            )
+        with mapshed_lock:
+            started = (
+                mapshed_job.result.get("started")
+                if mapshed_job.result is not None
+                else None
+            )
+            if (
+                started is not None
+                and time.time() - started > self.mmw_api.mapshed_job_seconds
+            ):
+                self.matrix_logger.info(
+                    "\tThe MapShed job {} is too old for GWLF-E; re-running it".format(
+                        mapshed_job.name
+                    )
+                )
+                mapshed_job.result = self._run_job(mapshed_job)
+            return mapshed_job.result
+
+    def _get_request_endpoint(
+        self, job: ModelMyWatershedScenarioJob
+    ) -> Union[str, None]:
+        """The endpoint a job sends its request to, or None for local jobs"""
+        if job.kind == "mapshed":
+            return self.mmw_api.gwlfe_prepare_endpoint
+        elif job.kind == "land":
+            return self.mmw_api.land_endpoint.format(job.land_use_layer)
+        elif job.kind == "forecast":
+            return self.mmw_api.forcast_endpoint.format(job.modification)
+        elif job.kind == "gwlfe":
+            return self.mmw_api.gwlfe_run_endpoint
+        elif job.kind == "tr55":
+            return self.mmw_api.tr55_endpoint
+        return None
+
+    def _estimate_job_seconds(self, job: ModelMyWatershedScenarioJob) -> float:
+        request_endpoint = self._get_request_endpoint(job)
+        if request_endpoint is None:
+            return 0.0
+        return self.mmw_api.cost_model.estimate(request_endpoint, job.aoi.size_class())
+
+    def _get_priorities(self, job_names: List[str]) -> Dict[str, float]:
+        """Finds the expected time from starting each job until the end of the longest
+        chain of jobs that wait on it"""
+        dependents: Dict[str, List[str]] = {job_name: [] for job_name in job_names}
+        for job_name in job_names:
+            for dependency in self.jobs[job_name].depends_on:
+                if dependency in dependents:
+                    dependents[dependency].append(job_name)
+        priorities: Dict[str, float] = {}
+        # every job comes after its dependencies, so go backwards
+        for job_name in reversed(job_names):
+            priorities[job_name] = self._estimate_job_seconds(
+                self.jobs[job_name]
+            ) + max(
+                [priorities[dependent] for dependent in dependents[job_name]],
+                default=0.0,
+            )
+        return priorities
+
+    def estimate_seconds(self) -> float:
+        """Estimates how long the jobs in the matrix that still need to be run will
+        take, from the API client's cost model
+
+        Returns:
+            float: The estimated time, in seconds
+        """
+        if len(self.jobs) == 0:
+            self.build_jobs()
+        needed_jobs = self._get_needed_jobs()
+        # at best, all of the work is split evenly, and at worst it's the longest chain
+        return max(
+            self.mmw_api.cost_model.estimate_batch_seconds(
+                [self._estimate_job_seconds(self.jobs[name]) for name in needed_jobs],
+                self.max_workers,
+            ),
+            max(self._get_priorities(needed_jobs).values(), default=0.0),
+        )
+
+    def _run_graph(self, job_names: List[str]) -> None:
+        """Runs the jobs with as many at once as allowed, starting each job as soon as
+        everything it depends on has finished"""
+        priorities = self._get_priorities(job_names)
+        waiting = list(job_names)
+        running: Dict[Future, ModelMyWatershedScenarioJob] = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as job_executor:
+            while waiting or running:
+                still_waiting = []
+                ready = []
+                for job_name in waiting:
+                    job = self.jobs[job_name]
+                    dependency_statuses = [
+                        self.jobs[dependency].status for dependency in job.depends_on
+                    ]
+                    if "failed" in dependency_statuses:
+                        job.status = "failed"
+                        self.matrix_logger.warn(
+                            "\tSkipping {}; a job it depends on failed".format(job.name)
+                        )
+                    elif all(
+                        status in ["succeeded", "cached"]
+                        for status in dependency_statuses
+                    ):
+                        ready.append(job_name)
+                    else:
+                        still_waiting.append(job_name)
+
+                # only hand the executor as many jobs as it can run, so a job that
+                # becomes ready later can still go ahead of less important ones
+                ready.sort(key=lambda job_name: -priorities[job_name])
+                n_to_start = max(0, self.max_workers - len(running))
+                for job_name in ready[:n_to_start]:
+                    job = self.jobs[job_name]
+                    job.status = "running"
+                    running[job_executor.submit(self._run_job, job)] = job
+                waiting = ready[n_to_start:] + still_waiting
+
+                if not running:
+                    # every remaining job is waiting on a job that will never run
+                    for job_name in waiting:
+                        self.jobs[job_name].status = "failed"
+                    break
+
+                finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for job_future in finished:
+                    job = running.pop(job_future)
+                    try:
+                        job.result = job_future.result()
+                    except Exception as ex:
+                        self.matrix_logger.warn(
+                            "\tUnexpected exception in {}:\n\t{}".format(job.name, ex)
+                        )
+                        job.result = None
+                    job.status = "succeeded" if job.result is not None else "failed"
+
+    def run(self) -> Dict[str, Union["pd.DataFrame", None]]:
+        """Builds and runs all of the jobs in the matrix
+
+        Returns:
+            Dict[str, Union[pd.DataFrame, None]]: The GWLF-E tables ("gwlfe_monthly",
+                "gwlfe_load_summaries", "gwlfe_lu_loads", "gwlfe_metadata",
+                "gwlfe_summaries") and the TR-55 tables ("tr55_censuses",
+                "tr55_runoff_distributions", "tr55_runoff_totals", "step_l_qualities")
+                for the models that were run.  As in `examples/run_models_hucs.py`,
+                each row is labeled with its AOI ("huc_aoi") and "Land_Use_Source",
+                and the GWLF-E tables are sorted by AOI.
+        """
+        run_plan = self.plan()
+        needed_jobs = self._get_needed_jobs()
+        self.matrix_logger.info(
+            "\tRunning {} of {} jobs in the scenario matrix for {}".format(
+                len(needed_jobs), len(self.jobs), run_plan.summary()
+            )
+        )
+        self._run_graph(needed_jobs)
+        for planned_job in run_plan.to_run:
+            if self.jobs[planned_job.job_label].status == "succeeded":
+                self.planner.record(planned_job)
+        return self.get_tables()
+
+    def plan(self) -> ModelMyWatershedRunPlan:
+        """Builds the jobs of the matrix and finds which need to be run, without
+        running anything, ie, for a dry run
+
+        Returns:
+            ModelMyWatershedRunPlan: The GWLF-E and TR-55 jobs of the matrix with their
+                statuses, and the estimated time to run them along with the MapShed and
+                modification jobs they need
+        """
+        self.build_jobs()
+        run_plan = self.planner.plan(
+            [
+                ModelMyWatershedPlannedJob(
+                    job.name,
+                    self._get_request_endpoint(job),
+                    None,
+                    job.cache_key,
+                    job.aoi.size_class(),
+                )
+                for job in self.jobs.values()
+                if job.kind in ["gwlfe", "tr55"]
+            ]
+        )
+        self._stale_jobs = set()
+        for planned_job in run_plan.jobs:
+            job = self.jobs[planned_job.job_label]
+            if planned_job.status == "current":
+                job.result = self.mmw_api.result_cache.get(job.cache_key)
+                if job.result is not None:
+                    job.status = "cached"
+            elif planned_job.status == "stale":
+                self._stale_jobs.add(job.name)
+        # the GWLF-E jobs also need their MapShed and modification jobs, so the
+        # estimate is for the whole graph of jobs that are still needed
+        run_plan.estimated_seconds = self.estimate_seconds()
+        return run_plan
+
+    @staticmethod
+    def _sort_gwlfe_tables(
+        tables: Dict[str, "pd.DataFrame"],
+    ) -> Dict[str, "pd.DataFrame"]:
+        """Sorts the GWLF-E tables by AOI (and month or source), keeping the order of
+        the land use sources within each"""
+        sort_columns = {
+            "gwlfe_monthly": ["huc_aoi", "month"],
+            "gwlfe_load_summaries": ["huc_aoi", "Source"],
+            "gwlfe_lu_loads": ["huc_aoi", "Source"],
+            "gwlfe_metadata": ["huc_aoi"],
+            "gwlfe_summaries": ["huc_aoi"],
+        }
+        return {
+            name: table.sort_values(
+                by=sort_columns[name], kind="mergesort"
+            ).reset_index(drop=True)
+            for name, table in tables.items()
+        }
+
+    def get_tables(self) -> Dict[str, Union["pd.DataFrame", None]]:
+        """Collects the results of the finished jobs into tables
+
+        Returns:
+            Dict[str, Union[pd.DataFrame, None]]: The tables, as returned by `run`
+        """
+        gwlfe_results: List[Tuple[Dict, Dict]] = []
+        tr55_results: List[Tuple[Dict, Dict]] = []
+        for job in self.jobs.values():
+            if job.result is None or job.status not in ["succeeded", "cached"]:
+                continue
+            if job.kind == "gwlfe":
+                gwlfe_results.append(
+                    (
+                        {
+                            "huc_aoi": job.aoi.job_label,
+                            "Land_Use_Source": (
+                                self.mmw_api.land_use_layers[job.land_use_layer]
+                                if job.modification == "unmodified"
+                                else job.modification
+                            ),
+                        },
+                        job.result,
+                    )
+                )
+            elif job.kind == "tr55":
+                tr55_results.append(
+                    (
+                        {
+                            "huc_aoi": job.aoi.job_label,
+                            "Land_Use_Source": job.land_use_layer,
+                        },
+                        job.result,
+                    )
+                )
+
+        tables: Dict[str, Union["pd.DataFrame", None]] = {}
+        if "gwlfe" in self.models:
+            tables.update(
+                self._sort_gwlfe_tables(normalize_gwlfe_results(gwlfe_results))
+                if len(gwlfe_results) > 0
+                else {
+                    "gwlfe_monthly": None,
+                    "gwlfe_load_summaries": None,
+                    "gwlfe_lu_loads": None,
+                    "gwlfe_metadata": None,
+                    "gwlfe_summaries": None,
+                }
+            )
+        if "tr55" in self.models:
+            tables.update(
+                normalize_tr55_results(tr55_results)
+                if len(tr55_results) > 0
+                else {
+                    "tr55_censuses": None,
+                    "tr55_runoff_distributions": None,
+                    "tr55_runoff_totals": None,
+                    "step_l_qualities": None,
+                }
+            )
+        return tables
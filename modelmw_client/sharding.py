@@ -0,0 +1,259 @@
+"""
+Sharded batch runs across several worker processes, API keys and hosts.
+"""
+#%%
+import heapq
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Any, Dict, List, TypedDict, Union
+
+from typing_extensions import NotRequired
+
+from .aoi import ModelMyWatershedAOI
+from .model_client import ModelMyWatershedAPI
+from .shared_tables import assemble_tables, release_tables, share_tables
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+module_logger = logging.getLogger(__name__)
+
+
+#%%
+class ModelMyWatershedWorker(TypedDict):
+    api_key: str
+    use_staging: NotRequired[bool]
+    mmw_host: NotRequired[str]
+    gzip_requests: NotRequired[bool]
+
+
+def _run_shard(
+    worker: ModelMyWatershedWorker,
+    save_path: Union[str, None],
+    job_ledger_path: Union[str, None],
+    batch_method: str,
+    shard: List[ModelMyWatershedAOI],
+    batch_kwargs: Dict[str, Any],
+    use_shared_memory: bool = False,
+) -> Any:
+    """Runs one shard of AOIs in a worker process, with its own API client"""
+    mmw_api = ModelMyWatershedAPI(
+        worker["api_key"],
+        save_path,
+        use_staging=worker.get("use_staging", False),
+        gzip_requests=worker.get("gzip_requests", False),
+        job_ledger_path=job_ledger_path,
+    )
+    if "mmw_host" in worker.keys():
+        mmw_api.mmw_host = worker["mmw_host"]
+    shard_result = getattr(mmw_api, batch_method)(shard, **batch_kwargs)
+    if use_shared_memory:
+        return share_tables(shard_result)
+    return shard_result
+
+
+class ModelMyWatershedShardedExecutor:
+    """Splits a batch run across several worker processes, each with its own API key
+    and host, so a large run isn't held to the request limit of a single key.
+
+    Each worker process gets its own `ModelMyWatershedAPI` (and so its own session and
+    request budget).  All of the workers save their job dumps and results into the
+    same save path, share the result cache within it, and record their jobs in a
+    single job ledger.
+
+    The AOIs are parsed once and assigned to the workers longest-job-first by their
+    estimated cost, so one worker doesn't end up with all of the large HUC-8's while
+    the others sit idle.
+
+    By default, the workers hand their result tables back through shared memory:
+    the numeric columns are written once into shared memory by the worker and copied
+    once from there into the joined tables, rather than being pickled, sent, unpickled
+    and concatenated.
+
+    Example:
+        sharded_run = ModelMyWatershedShardedExecutor(
+            [{"api_key": key_1}, {"api_key": key_2, "use_staging": True}],
+            save_path,
+        )
+        tr55_tables = sharded_run.run("run_batch_tr55", list_of_hucs, precipitation=3.33)
+    """
+
+    executor_logger = module_logger.getChild(__qualname__)
+
+    # the batch methods of ModelMyWatershedAPI that can be sharded
+    batch_methods: List[str] = [
+        "run_batch_analysis",
+        "run_batch_gwlfe",
+        "run_batch_tr55",
+    ]
+
+    # the relative cost of an AOI, by its size class; a HUC-12 is about 100 km²
+    aoi_costs: Dict[str, float] = {
+        "huc8": 25.0,
+        "huc10": 5.0,
+        "huc12": 1.0,
+        "wkaoi": 1.0,
+    }
+    huc12_area_km2: float = 100.0
+
+    def __init__(
+        self,
+        workers: List[ModelMyWatershedWorker],
+        save_path: Union[str, None] = None,
+        job_ledger_path: Union[str, None] = None,
+        use_shared_memory: bool = True,
+    ):
+        """Create a new sharded executor
+
+        Args:
+            workers (List[ModelMyWatershedWorker]): The API key and (optionally) host
+                for each worker process
+            save_path (Union[str, None], optional): The path shared by all workers for
+                their json dumps and result cache. Defaults to None.
+            job_ledger_path (Union[str, None], optional): The job ledger shared by all
+                workers. Defaults to "job_ledger.jsonl" in the save path, or no ledger
+                if there is no save path.
+            use_shared_memory (bool, optional): Hand the result tables back from the
+                workers through shared memory. Defaults to True.
+        """
+        if len(workers) == 0:
+            raise ValueError("At least one worker is needed")
+        self.workers = workers
+        self.save_path = save_path
+        if job_ledger_path is None and save_path is not None:
+            job_ledger_path = save_path + "job_ledger.jsonl"
+        self.job_ledger_path = job_ledger_path
+        self.use_shared_memory = use_shared_memory
+
+    def estimate_cost(self, mmw_aoi: ModelMyWatershedAOI) -> float:
+        """Estimates the relative cost of running an AOI, where a HUC-12 costs 1
+
+        Args:
+            mmw_aoi (ModelMyWatershedAOI): The AOI
+
+        Returns:
+            float: The estimated cost
+        """
+        if mmw_aoi.kind == "geojson":
+            area_km2 = mmw_aoi.summary()["area_km2"]
+            if area_km2 is None:
+                return 1.0
+            return max(1.0, area_km2 / self.huc12_area_km2)
+        return self.aoi_costs.get(mmw_aoi.size_class(), 1.0)
+
+    def plan_shards(self, list_of_aois: List) -> List[List[ModelMyWatershedAOI]]:
+        """Parses the AOIs and splits them into one shard per worker, balancing the
+        estimated cost of the shards by assigning the most costly AOIs first, each to
+        the shard with the least work so far.
+
+        Args:
+            list_of_aois (List): A list of AOI's.  They can be strings, geojsons or
+                ModelMyWatershedAOI's.
+
+        Returns:
+            List[List[ModelMyWatershedAOI]]: The AOIs for each worker
+        """
+        costed_aois = []
+        for run_number, aoi in enumerate(list_of_aois, start=1):
+            # parse here, so unnamed shapes are numbered across the whole batch
+            try:
+                mmw_aoi = ModelMyWatershedAOI.from_any(aoi, run_number)
+            except ValueError as ex:
+                self.executor_logger.warn("\tSkipping invalid AOI: {}".format(ex))
+                continue
+            costed_aois.append((self.estimate_cost(mmw_aoi), run_number, mmw_aoi))
+        costed_aois.sort(key=lambda costed_aoi: (-costed_aoi[0], costed_aoi[1]))
+
+        shards: List[List[ModelMyWatershedAOI]] = [[] for _ in self.workers]
+        shard_loads = [(0.0, shard_number) for shard_number in range(len(shards))]
+        for cost, _, mmw_aoi in costed_aois:
+            shard_load, shard_number = heapq.heappop(shard_loads)
+            shards[shard_number].append(mmw_aoi)
+            heapq.heappush(shard_loads, (shard_load + cost, shard_number))
+
+        for shard_load, shard_number in sorted(shard_loads, key=lambda load: load[1]):
+            self.executor_logger.info(
+                "\tShard {} has {} AOIs with an estimated cost of {:.1f}".format(
+                    shard_number, len(shards[shard_number]), shard_load
+                )
+            )
+        return shards
+
+    def run(
+        self, batch_method: str, list_of_aois: List, **batch_kwargs: Any
+    ) -> Union["pd.DataFrame", Dict[str, Union["pd.DataFrame", None]], None]:
+        """Runs a batch method of `ModelMyWatershedAPI` with the AOIs split across the
+        workers, and joins the results of the shards.
+
+        Args:
+            batch_method (str): The name of the batch method, ie, "run_batch_tr55"
+            list_of_aois (List): A list of AOI's.  They can be strings, geojsons or
+                ModelMyWatershedAOI's.
+            **batch_kwargs: The other arguments to the batch method
+
+        Returns:
+            Union[pd.DataFrame, Dict[str, Union[pd.DataFrame, None]], None]: The
+                results, as the batch method would return them for all of the AOIs
+        """
+        if batch_method not in self.batch_methods:
+            raise ValueError("{} can't be sharded".format(batch_method))
+
+        shards = self.plan_shards(list_of_aois)
+        shard_results = []
+        with ProcessPoolExecutor(max_workers=len(self.workers)) as shard_executor:
+            shard_futures = [
+                shard_executor.submit(
+                    _run_shard,
+                    worker,
+                    self.save_path,
+                    self.job_ledger_path,
+                    batch_method,
+                    shard,
+                    batch_kwargs,
+                    self.use_shared_memory,
+                )
+                for worker, shard in zip(self.workers, shards)
+                if len(shard) > 0
+            ]
+            for shard_number, shard_future in enumerate(shard_futures):
+                try:
+                    shard_results.append(shard_future.result())
+                except Exception as ex:
+                    self.executor_logger.warn(
+                        "\tShard {} failed:\n\t{}".format(shard_number, ex)
+                    )
+
+        if not self.use_shared_memory:
+            return self._join_results(shard_results)
+        try:
+            return assemble_tables(shard_results)
+        except Exception:
+            release_tables(shard_results)
+            raise
+
+    @staticmethod
+    def _join_results(
+        shard_results: List[Any],
+    ) -> Union["pd.DataFrame", Dict[str, Union["pd.DataFrame", None]], None]:
+        """Joins the frames (or dictionaries of frames) returned by each shard"""
+        import pandas as pd
+
+        shard_results = [result for result in shard_results if result is not None]
+        if len(shard_results) == 0:
+            return None
+        if isinstance(shard_results[0], pd.DataFrame):
+            return pd.concat(shard_results, ignore_index=True)
+
+        joined_results = {}
+        for table_name in shard_results[0].keys():
+            table_frames = [
+                result[table_name]
+                for result in shard_results
+                if result.get(table_name) is not None
+            ]
+            joined_results[table_name] = (
+                pd.concat(table_frames, ignore_index=True)
+                if len(table_frames) > 0
+                else None
+            )
+        return joined_results
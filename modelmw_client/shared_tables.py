@@ -0,0 +1,222 @@
+"""
+Hand-off of result tables between processes through shared memory.
+"""
+#%%
+import logging
+from multiprocessing import resource_tracker, shared_memory
+from typing import TYPE_CHECKING, Any, Dict, List, Union
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+module_logger = logging.getLogger(__name__)
+
+# numpy dtype kinds that are copied into shared memory: bool, int, unsigned, float
+_SHARED_KINDS = "biuf"
+
+
+#%%
+def _share_table(table: "pd.DataFrame") -> Dict[str, Any]:
+    """Copies the numeric columns of a table into one block of shared memory and
+    returns a small, picklable description of the table.  The other columns (ie, the
+    labels) are kept as lists in the description."""
+    import numpy as np
+
+    shared_columns = []
+    other_columns = {}
+    n_bytes = 0
+    for column in table.columns:
+        column_dtype = table[column].dtype
+        if isinstance(column_dtype, np.dtype) and column_dtype.kind in _SHARED_KINDS:
+            shared_columns.append((column, column_dtype.str, n_bytes))
+            # keep each column aligned to 8 bytes
+            n_bytes += -(-column_dtype.itemsize * len(table) // 8) * 8
+        else:
+            other_columns[column] = table[column].tolist()
+
+    shared_block = None
+    if n_bytes > 0:
+        shared_block = shared_memory.SharedMemory(create=True, size=n_bytes)
+        for column, dtype_str, offset in shared_columns:
+            np.ndarray(
+                (len(table),), dtype=dtype_str, buffer=shared_block.buf, offset=offset
+            )[:] = table[column].to_numpy()
+        shared_block.close()
+        # the receiving process now owns the block and unlinks it; don't let this
+        # process's resource tracker remove it when the worker exits
+        resource_tracker.unregister(shared_block._name, "shared_memory")
+
+    return {
+        "columns": list(table.columns),
+        "n_rows": len(table),
+        "shared_name": None if shared_block is None else shared_block.name,
+        "shared_columns": shared_columns,
+        "other_columns": other_columns,
+    }
+
+
+def share_tables(result: Any) -> Any:
+    """Moves the tables from a batch result into shared memory, for sending to another
+    process.
+
+    Args:
+        result (Any): A data frame, a dictionary of data frames (or None's), or None
+
+    Returns:
+        Any: The same structure, with each data frame replaced by a description of
+            where its columns are.  Pass it to `assemble_tables` in the receiving
+            process.
+    """
+    import pandas as pd
+
+    if isinstance(result, pd.DataFrame):
+        return {"kind": "frame", "table": _share_table(result)}
+    elif isinstance(result, dict):
+        return {
+            "kind": "tables",
+            "tables": {
+                table_name: None if table is None else _share_table(table)
+                for table_name, table in result.items()
+            },
+        }
+    return None
+
+
+def _release_table(shared_table: Dict[str, Any]) -> None:
+    if shared_table["shared_name"] is None:
+        return
+    try:
+        shared_block = shared_memory.SharedMemory(name=shared_table["shared_name"])
+    except FileNotFoundError:
+        return
+    shared_block.close()
+    shared_block.unlink()
+
+
+def release_tables(shared_results: List[Any]) -> None:
+    """Frees the shared memory of results that won't be assembled
+
+    Args:
+        shared_results (List[Any]): Results from `share_tables`
+    """
+    for shared_result in shared_results:
+        if shared_result is None:
+            continue
+        elif shared_result["kind"] == "frame":
+            _release_table(shared_result["table"])
+        else:
+            for shared_table in shared_result["tables"].values():
+                if shared_table is not None:
+                    _release_table(shared_table)
+
+
+def _join_shared_tables(
+    shared_tables: List[Dict[str, Any]],
+    shared_blocks: List[Union[shared_memory.SharedMemory, None]],
+) -> "pd.DataFrame":
+    """Joins the pieces of one table, copying the numeric columns out of the shared
+    memory.  None of the views of the shared memory outlive this function."""
+    import numpy as np
+    import pandas as pd
+
+    shard_columns = []
+    for shared_table, shared_block in zip(shared_tables, shared_blocks):
+        columns = {
+            column: np.ndarray(
+                (shared_table["n_rows"],),
+                dtype=dtype_str,
+                buffer=shared_block.buf,
+                offset=offset,
+            )
+            for column, dtype_str, offset in shared_table["shared_columns"]
+        }
+        columns.update(shared_table["other_columns"])
+        shard_columns.append(columns)
+
+    first_columns = shared_tables[0]["columns"]
+    if all(
+        shared_table["columns"] == first_columns
+        and shared_table["shared_columns"] == shared_tables[0]["shared_columns"]
+        for shared_table in shared_tables
+    ):
+        # the same layout in every piece: one copy for each column, from the shared
+        # memory straight into the joined column
+        joined_columns = {}
+        for column in first_columns:
+            pieces = [columns[column] for columns in shard_columns]
+            if isinstance(pieces[0], np.ndarray):
+                joined_columns[column] = np.concatenate(pieces)
+            else:
+                joined_columns[column] = [value for piece in pieces for value in piece]
+        return pd.DataFrame(joined_columns, columns=first_columns, copy=False)
+
+    # the pieces have different columns, so let pandas line them up
+    return pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    column: values.copy() if isinstance(values, np.ndarray) else values
+                    for column, values in columns.items()
+                },
+                columns=shared_table["columns"],
+            )
+            for columns, shared_table in zip(shard_columns, shared_tables)
+        ],
+        ignore_index=True,
+    )
+
+
+def _assemble_table(shared_tables: List[Dict[str, Any]]) -> "pd.DataFrame":
+    """Joins the pieces of one table from several processes and frees their shared
+    memory"""
+    shared_blocks = [
+        (
+            None
+            if shared_table["shared_name"] is None
+            else shared_memory.SharedMemory(name=shared_table["shared_name"])
+        )
+        for shared_table in shared_tables
+    ]
+    try:
+        return _join_shared_tables(shared_tables, shared_blocks)
+    finally:
+        for shared_block in shared_blocks:
+            if shared_block is not None:
+                shared_block.unlink()
+                try:
+                    shared_block.close()
+                except BufferError:
+                    # a view is still held by a traceback; the memory is freed with it
+                    pass
+
+
+def assemble_tables(
+    shared_results: List[Any],
+) -> Union["pd.DataFrame", Dict[str, Union["pd.DataFrame", None]], None]:
+    """Joins results from several processes that were sent with `share_tables`, and
+    frees their shared memory.
+
+    Args:
+        shared_results (List[Any]): The results from `share_tables`
+
+    Returns:
+        Union[pd.DataFrame, Dict[str, Union[pd.DataFrame, None]], None]: The joined
+            results, in the same structure as the results that were shared
+    """
+    shared_results = [result for result in shared_results if result is not None]
+    if len(shared_results) == 0:
+        return None
+    if shared_results[0]["kind"] == "frame":
+        return _assemble_table([result["table"] for result in shared_results])
+
+    joined_tables = {}
+    for table_name in shared_results[0]["tables"].keys():
+        shared_tables = [
+            result["tables"][table_name]
+            for result in shared_results
+            if result["tables"].get(table_name) is not None
+        ]
+        joined_tables[table_name] = (
+            _assemble_table(shared_tables) if len(shared_tables) > 0 else None
+        )
+    return joined_tables
@@ -0,0 +1,240 @@
+"""
+Streaming of large response bodies to disk, parsing only their small top-level fields.
+"""
+#%%
+import codecs
+import gzip
+import hashlib
+import json
+import logging
+import re
+import zlib
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple, Union
+
+if TYPE_CHECKING:
+    from requests import Response
+
+module_logger = logging.getLogger(__name__)
+
+# the characters that change the structure of a JSON document, outside of strings
+_STRUCTURE_CHARS = re.compile(r'["{}\[\],:]')
+# the characters that end or escape within a string
+_STRING_CHARS = re.compile(r'["\\]')
+
+
+#%%
+class _TopLevelFieldScanner:
+    """Scans a JSON object given a piece at a time, keeping only the top-level values
+    that are no longer than `max_field_chars`.  Longer values are skipped as they go
+    past, so the memory used is bounded by the size of the pieces, not the document."""
+
+    __slots__ = (
+        "max_field_chars",
+        "fields",
+        "skipped_fields",
+        "_depth",
+        "_in_string",
+        "_escaped",
+        "_expect_key",
+        "_key",
+        "_key_parts",
+        "_value_parts",
+        "_value_chars",
+    )
+
+    def __init__(self, max_field_chars: int):
+        self.max_field_chars = max_field_chars
+        self.fields: Dict[str, Any] = {}
+        self.skipped_fields: List[str] = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._expect_key = False
+        self._key: Union[str, None] = None
+        # the pieces of the key or value being read, or None when not reading one
+        self._key_parts: Union[List[str], None] = None
+        self._value_parts: Union[List[str], None] = None
+        self._value_chars = 0
+
+    def _add_value_piece(self, piece: str) -> None:
+        self._value_chars += len(piece)
+        if self._value_chars <= self.max_field_chars:
+            self._value_parts.append(piece)
+        elif len(self._value_parts) > 0:
+            # too long to keep; only keep counting
+            self._value_parts.clear()
+
+    def _end_value(self, piece: str) -> None:
+        self._add_value_piece(piece)
+        if self._value_chars > self.max_field_chars:
+            self.skipped_fields.append(self._key)
+        else:
+            self.fields[self._key] = json.loads("".join(self._value_parts))
+        self._value_parts = None
+
+    def feed(self, text: str) -> None:
+        """Scans the next piece of the document"""
+        n_chars = len(text)
+        capture_start = (
+            0 if self._key_parts is not None or self._value_parts is not None else None
+        )
+        i = 0
+        while i < n_chars:
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                    i += 1
+                    continue
+                string_match = _STRING_CHARS.search(text, i)
+                if string_match is None:
+                    break
+                i = string_match.end()
+                if string_match.group() == "\\":
+                    self._escaped = True
+                    continue
+                self._in_string = False
+                if self._key_parts is not None:
+                    self._key_parts.append(text[capture_start : i - 1])
+                    self._key = json.loads('"{}"'.format("".join(self._key_parts)))
+                    self._key_parts = None
+                    capture_start = None
+                continue
+
+            structure_match = _STRUCTURE_CHARS.search(text, i)
+            if structure_match is None:
+                break
+            char = structure_match.group()
+            i = structure_match.end()
+            if char == '"':
+                self._in_string = True
+                if self._depth == 1 and self._expect_key:
+                    self._expect_key = False
+                    self._key_parts = []
+                    capture_start = i
+            elif char in "{[":
+                self._depth += 1
+                if self._depth == 1:
+                    self._expect_key = char == "{"
+            elif char in "}]":
+                if self._depth == 1 and self._value_parts is not None:
+                    self._end_value(text[capture_start : structure_match.start()])
+                    capture_start = None
+                self._depth -= 1
+            elif char == ":" and self._depth == 1:
+                self._value_parts = []
+                self._value_chars = 0
+                capture_start = i
+            elif char == "," and self._depth == 1:
+                if self._value_parts is not None:
+                    self._end_value(text[capture_start : structure_match.start()])
+                    capture_start = None
+                self._expect_key = True
+
+        # keep the part of a key or value that continues into the next piece
+        if capture_start is not None:
+            if self._key_parts is not None:
+                self._key_parts.append(text[capture_start:])
+            elif self._value_parts is not None:
+                self._add_value_piece(text[capture_start:])
+
+
+def stream_response(
+    response: "Response",
+    filename: str,
+    chunk_size: int = 65536,
+    max_field_bytes: int = 65536,
+) -> Tuple[Dict[str, Any], List[str], Dict[str, Any]]:
+    """Writes the body of a streamed response to a file as it arrives, without
+    decompressing it, and parses its small top-level fields on the way past.
+
+    Args:
+        response (Response): A response from a request sent with `stream=True`, either
+            gzipped or not compressed
+        filename (str): The file to write the body to
+        chunk_size (int, optional): The number of bytes to read and decompress at a
+            time. Defaults to 65536.
+        max_field_bytes (int, optional): The longest top-level value to parse; longer
+            values (ie, a job "result") are only written to the file.
+            Defaults to 65536.
+
+    Returns:
+        Tuple[Dict[str, Any], List[str], Dict[str, Any]]: The parsed top-level fields,
+            the names of the fields that were too long to parse, and the
+            "content_encoding", "size" and "sha256" of the file
+    """
+    content_encoding = response.headers.get("Content-Encoding", "").lower()
+    if content_encoding == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif content_encoding in ["", "identity"]:
+        decompressor = None
+    else:
+        raise ValueError(
+            "Can't stream a response with content encoding {}".format(content_encoding)
+        )
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    field_scanner = _TopLevelFieldScanner(max_field_bytes)
+    file_hash = hashlib.sha256()
+    file_size = 0
+
+    with open(filename, "wb") as fp:
+        while True:
+            chunk = response.raw.read(chunk_size, decode_content=False)
+            if not chunk:
+                break
+            fp.write(chunk)
+            file_hash.update(chunk)
+            file_size += len(chunk)
+            if decompressor is None:
+                field_scanner.feed(text_decoder.decode(chunk))
+                continue
+            # decompress no more than a chunk at a time, however well it compressed
+            compressed = chunk
+            while compressed:
+                field_scanner.feed(
+                    text_decoder.decode(decompressor.decompress(compressed, chunk_size))
+                )
+                compressed = decompressor.unconsumed_tail
+        field_scanner.feed(text_decoder.decode(b"", final=True))
+
+    return (
+        field_scanner.fields,
+        field_scanner.skipped_fields,
+        {
+            "content_encoding": content_encoding,
+            "size": file_size,
+            "sha256": file_hash.hexdigest(),
+        },
+    )
+
+
+def read_streamed_json(filename: str) -> Any:
+    """Reads a response body saved by `stream_response`
+
+    Args:
+        filename (str): The file, ending in ".gz" if it is gzipped
+
+    Returns:
+        Any: The parsed JSON
+    """
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rb") as fp:
+        return json.load(fp)
+
+
+def read_streamed_result(result_file: str) -> Any:
+    """Reads the "result" from a job results response saved by `stream_response`
+
+    Args:
+        result_file (str): The file, ending in ".gz" if it is gzipped
+
+    Returns:
+        Any: The job result, or None if the file doesn't exist or doesn't have one
+    """
+    try:
+        result_response = read_streamed_json(result_file)
+    except FileNotFoundError:
+        module_logger.warn("\tThe result file {} is missing".format(result_file))
+        return None
+    if not isinstance(result_response, dict):
+        return None
+    return result_response.get("result")
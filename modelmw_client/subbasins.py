@@ -0,0 +1,393 @@
+"""
+A cache of HUC-12 sub-basin geometries, packed into typed arrays.
+"""
+#%%
+import array
+import itertools
+import json
+import logging
+import sys
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Tuple, Union
+
+from .dump_index import ModelMyWatershedDumpIndex
+
+module_logger = logging.getLogger(__name__)
+
+
+#%%
+class ModelMyWatershedSubbasinGeometry:
+    """The boundary of one HUC-12 sub-basin, packed into typed arrays.
+
+    As GeoJSON, a HUC-12 boundary is thousands of two-item lists of floats, costing
+    over 100 bytes a point as Python objects.  Here the points are one flat array of
+    doubles (x0, y0, x1, y1, ...), 16 bytes a point, with two arrays of offsets for the
+    rings and polygons (the same layout as GeoArrow):
+
+    - ring `i` is points `ring_offsets[i]` up to `ring_offsets[i + 1]`
+    - polygon `j` is rings `polygon_offsets[j]` up to `polygon_offsets[j + 1]`, the
+      first of which is its outer ring
+
+    The arrays support the buffer protocol, so they can be wrapped without copying,
+    ie, with `numpy.frombuffer`.  The type of the original shape (Polygon or
+    MultiPolygon) and whether it was a JSON string are kept, so `to_detail` gives back
+    a shape of the same kind.
+    """
+
+    __slots__ = (
+        "huc12",
+        "properties",
+        "coordinates",
+        "ring_offsets",
+        "polygon_offsets",
+        "shape_type",
+        "shape_is_json",
+    )
+
+    def __init__(
+        self,
+        huc12: str,
+        properties: Dict[str, Any],
+        coordinates: array.array,
+        ring_offsets: array.array,
+        polygon_offsets: array.array,
+        shape_type: str = "MultiPolygon",
+        shape_is_json: bool = False,
+    ):
+        """Create a sub-basin geometry from its packed arrays; see `from_detail` to
+        pack one from a `get_subbasin_details` response
+
+        Args:
+            huc12 (str): The HUC-12 code of the sub-basin
+            properties (Dict[str, Any]): The other details of the sub-basin
+            coordinates (array.array): The x and y of every point, as doubles ("d")
+            ring_offsets (array.array): The first point of each ring and the number of
+                points, as unsigned ints ("I")
+            polygon_offsets (array.array): The first ring of each polygon and the
+                number of rings, as unsigned ints ("I")
+            shape_type (str, optional): The GeoJSON type of the original shape,
+                "Polygon" or "MultiPolygon". Defaults to "MultiPolygon".
+            shape_is_json (bool, optional): Whether the original shape was a JSON
+                string rather than a dictionary. Defaults to False.
+        """
+        self.huc12 = huc12
+        self.properties = properties
+        self.coordinates = coordinates
+        self.ring_offsets = ring_offsets
+        self.polygon_offsets = polygon_offsets
+        self.shape_type = shape_type
+        self.shape_is_json = shape_is_json
+
+    @classmethod
+    def from_detail(
+        cls, subbasin_detail: Dict[str, Any]
+    ) -> "ModelMyWatershedSubbasinGeometry":
+        """Packs one sub-basin from the list returned by `get_subbasin_details`
+
+        Args:
+            subbasin_detail (Dict[str, Any]): The sub-basin, with its "shape" as a
+                GeoJSON Polygon or MultiPolygon and its HUC-12 code as "huc12" or "id"
+
+        Returns:
+            ModelMyWatershedSubbasinGeometry: The packed geometry
+        """
+        shape = subbasin_detail["shape"]
+        shape_is_json = isinstance(shape, str)
+        if shape_is_json:
+            shape = json.loads(shape)
+        if shape["type"] == "Polygon":
+            polygons = [shape["coordinates"]]
+        elif shape["type"] == "MultiPolygon":
+            polygons = shape["coordinates"]
+        else:
+            raise ValueError(
+                "Sub-basin shapes must be Polygons or MultiPolygons, not {}".format(
+                    shape["type"]
+                )
+            )
+
+        coordinates = array.array("d")
+        ring_offsets = array.array("I", [0])
+        polygon_offsets = array.array("I", [0])
+        for polygon in polygons:
+            for ring in polygon:
+                # only the x and y of any 3D points are kept
+                coordinates.extend(
+                    itertools.chain.from_iterable(point[:2] for point in ring)
+                )
+                ring_offsets.append(len(coordinates) // 2)
+            polygon_offsets.append(len(ring_offsets) - 1)
+
+        return cls(
+            str(subbasin_detail.get("huc12", subbasin_detail.get("id"))),
+            {key: val for key, val in subbasin_detail.items() if key != "shape"},
+            coordinates,
+            ring_offsets,
+            polygon_offsets,
+            shape["type"],
+            shape_is_json,
+        )
+
+    def get_arrays(self) -> Tuple[array.array, array.array, array.array]:
+        """Returns the packed arrays of the geometry, without building any lists
+
+        Returns:
+            Tuple[array.array, array.array, array.array]: The flat x and y of every
+                point, the offsets of the rings into the points and the offsets of the
+                polygons into the rings
+        """
+        return self.coordinates, self.ring_offsets, self.polygon_offsets
+
+    @property
+    def bounds(self) -> Tuple[float, float, float, float]:
+        """The minimum x and y and maximum x and y of the sub-basin"""
+        x_values = self.coordinates[0::2]
+        y_values = self.coordinates[1::2]
+        return min(x_values), min(y_values), max(x_values), max(y_values)
+
+    def to_geojson(self) -> Dict[str, Any]:
+        """Rebuilds the boundary as a GeoJSON Polygon or MultiPolygon, the same type
+        as the original shape
+
+        Returns:
+            Dict[str, Any]: The Polygon or MultiPolygon
+        """
+        polygons = []
+        for polygon_number in range(len(self.polygon_offsets) - 1):
+            rings = []
+            for ring_number in range(
+                self.polygon_offsets[polygon_number],
+                self.polygon_offsets[polygon_number + 1],
+            ):
+                ring_start = 2 * self.ring_offsets[ring_number]
+                ring_end = 2 * self.ring_offsets[ring_number + 1]
+                ring_values = self.coordinates[ring_start:ring_end].tolist()
+                rings.append(
+                    [list(point) for point in zip(ring_values[0::2], ring_values[1::2])]
+                )
+            polygons.append(rings)
+        if self.shape_type == "Polygon" and len(polygons) == 1:
+            return {"type": "Polygon", "coordinates": polygons[0]}
+        return {"type": "MultiPolygon", "coordinates": polygons}
+
+    def to_detail(self) -> Dict[str, Any]:
+        """Rebuilds the sub-basin in the form returned by `get_subbasin_details`,
+        with its shape as a JSON string if the original was one"""
+        shape = self.to_geojson()
+        return {
+            **self.properties,
+            "shape": json.dumps(shape) if self.shape_is_json else shape,
+        }
+
+    def to_bytes(self) -> bytes:
+        """Serializes the geometry: a line of JSON with the HUC-12 code, properties and
+        array lengths, followed by the raw bytes of the arrays"""
+        header = {
+            "huc12": self.huc12,
+            "properties": self.properties,
+            "byteorder": sys.byteorder,
+            "n_coordinates": len(self.coordinates),
+            "n_ring_offsets": len(self.ring_offsets),
+            "n_polygon_offsets": len(self.polygon_offsets),
+            "shape_type": self.shape_type,
+            "shape_is_json": self.shape_is_json,
+        }
+        return b"".join(
+            [
+                json.dumps(header, separators=(",", ":")).encode("utf-8"),
+                b"\n",
+                self.polygon_offsets.tobytes(),
+                self.ring_offsets.tobytes(),
+                self.coordinates.tobytes(),
+            ]
+        )
+
+    @classmethod
+    def from_bytes(cls, content: bytes) -> "ModelMyWatershedSubbasinGeometry":
+        """Reads a geometry serialized with `to_bytes`"""
+        header_end = content.index(b"\n")
+        header = json.loads(content[:header_end])
+        arrays = []
+        array_start = header_end + 1
+        for type_code, n_items in [
+            ("I", header["n_polygon_offsets"]),
+            ("I", header["n_ring_offsets"]),
+            ("d", header["n_coordinates"]),
+        ]:
+            packed = array.array(type_code)
+            array_end = array_start + n_items * packed.itemsize
+            packed.frombytes(content[array_start:array_end])
+            if header["byteorder"] != sys.byteorder:
+                packed.byteswap()
+            arrays.append(packed)
+            array_start = array_end
+        polygon_offsets, ring_offsets, coordinates = arrays
+        return cls(
+            header["huc12"],
+            header["properties"],
+            coordinates,
+            ring_offsets,
+            polygon_offsets,
+            # geometries cached before these were kept were rebuilt as MultiPolygons
+            header.get("shape_type", "MultiPolygon"),
+            header.get("shape_is_json", False),
+        )
+
+    def __repr__(self) -> str:
+        return "ModelMyWatershedSubbasinGeometry({}, {} points)".format(
+            self.huc12, len(self.coordinates) // 2
+        )
+
+
+class ModelMyWatershedSubbasinCache:
+    """Keeps HUC-12 sub-basin geometries by their HUC-12 code, so boundaries that
+    appear in many sub-basin jobs are only fetched once.
+
+    The HUC-12 codes of each MapShed job are kept too, so asking for the sub-basins of
+    a job that has been seen before needs no request.  Everything is kept in memory
+    and, if a cache path is given, also written to one file per HUC-12 (`<huc12>.geom`)
+    and per job (`<job uuid>.huc12s`), looked up in an index of the directory.
+    """
+
+    cache_logger = module_logger.getChild(__qualname__)
+
+    def __init__(self, cache_path: Union[str, None] = None):
+        """Create a new sub-basin cache
+
+        Args:
+            cache_path (Union[str, None], optional): The directory to save geometries
+                in. Defaults to None, for a cache that is only in memory.
+        """
+        self.cache_path = cache_path
+        self._geometries: Dict[str, ModelMyWatershedSubbasinGeometry] = {}
+        self._job_huc12s: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+        self._index = (
+            ModelMyWatershedDumpIndex(cache_path, "subbasin_index.jsonl", "*.*")
+            if cache_path is not None
+            else None
+        )
+
+    def _read_file(self, filename: str) -> Union[bytes, None]:
+        if self.cache_path is None or filename not in self._index:
+            return None
+        try:
+            with open(Path(self.cache_path) / filename, "rb") as fp:
+                return fp.read()
+        except FileNotFoundError:
+            return None
+
+    def get(self, huc12: str) -> Union[ModelMyWatershedSubbasinGeometry, None]:
+        """Gets the cached geometry of a HUC-12
+
+        Args:
+            huc12 (str): The HUC-12 code
+
+        Returns:
+            Union[ModelMyWatershedSubbasinGeometry, None]: The geometry, or None if it
+                isn't cached
+        """
+        with self._lock:
+            if huc12 in self._geometries:
+                return self._geometries[huc12]
+        content = self._read_file("{}.geom".format(huc12))
+        if content is None:
+            return None
+        try:
+            geometry = ModelMyWatershedSubbasinGeometry.from_bytes(content)
+        except (ValueError, KeyError):
+            self.cache_logger.warn(
+                "\tIgnoring unreadable cached geometry for {}".format(huc12)
+            )
+            return None
+        with self._lock:
+            self._geometries[huc12] = geometry
+        return geometry
+
+    def get_many(
+        self, huc12s: List[str]
+    ) -> Union[Dict[str, ModelMyWatershedSubbasinGeometry], None]:
+        """Gets the cached geometries of several HUC-12's
+
+        Args:
+            huc12s (List[str]): The HUC-12 codes
+
+        Returns:
+            Union[Dict[str, ModelMyWatershedSubbasinGeometry], None]: The geometries by
+                HUC-12 code, or None if any of them aren't cached
+        """
+        geometries = {}
+        for huc12 in huc12s:
+            geometry = self.get(huc12)
+            if geometry is None:
+                return None
+            geometries[huc12] = geometry
+        return geometries
+
+    def get_job(
+        self, mapshed_job_uuid: str
+    ) -> Union[Dict[str, ModelMyWatershedSubbasinGeometry], None]:
+        """Gets the cached geometries of every sub-basin of a MapShed job
+
+        Args:
+            mapshed_job_uuid (str): The UUID of the sub-basin prepare (MapShed) job
+
+        Returns:
+            Union[Dict[str, ModelMyWatershedSubbasinGeometry], None]: The geometries by
+                HUC-12 code, in the order they were returned by ModelMyWatershed, or
+                None if the job or any of its geometries aren't cached
+        """
+        with self._lock:
+            huc12s = self._job_huc12s.get(mapshed_job_uuid)
+        if huc12s is None:
+            content = self._read_file("{}.huc12s".format(mapshed_job_uuid))
+            if content is None:
+                return None
+            huc12s = json.loads(content)
+            with self._lock:
+                self._job_huc12s[mapshed_job_uuid] = huc12s
+        return self.get_many(huc12s)
+
+    def put(self, geometry: ModelMyWatershedSubbasinGeometry) -> None:
+        """Adds a geometry to the cache, replacing any for the same HUC-12"""
+        with self._lock:
+            self._geometries[geometry.huc12] = geometry
+        if self.cache_path is not None:
+            self._index.write("{}.geom".format(geometry.huc12), geometry.to_bytes())
+
+    def put_job(
+        self,
+        mapshed_job_uuid: str,
+        geometries: List[ModelMyWatershedSubbasinGeometry],
+    ) -> None:
+        """Adds the geometries of every sub-basin of a MapShed job to the cache
+
+        Args:
+            mapshed_job_uuid (str): The UUID of the sub-basin prepare (MapShed) job
+            geometries (List[ModelMyWatershedSubbasinGeometry]): The geometries of its
+                sub-basins
+        """
+        for geometry in geometries:
+            self.put(geometry)
+        huc12s = [geometry.huc12 for geometry in geometries]
+        with self._lock:
+            self._job_huc12s[mapshed_job_uuid] = huc12s
+        # the job goes last, so it is never saved without its geometries
+        if self.cache_path is not None:
+            self._index.write(
+                "{}.huc12s".format(mapshed_job_uuid),
+                json.dumps(huc12s).encode("utf-8"),
+            )
+
+    def __contains__(self, huc12: str) -> bool:
+        with self._lock:
+            if huc12 in self._geometries:
+                return True
+        return self.cache_path is not None and "{}.geom".format(huc12) in self._index
+
+    def clear(self) -> None:
+        """Forgets the geometries held in memory; geometries on disk are kept"""
+        with self._lock:
+            self._geometries.clear()
+            self._job_huc12s.clear()
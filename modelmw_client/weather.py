@@ -0,0 +1,304 @@
+"""
+Cached and concurrent retrieval of project weather data from ModelMyWatershed.
+"""
+#%%
+import array
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple, Union, Any
+
+from .aoi import ModelMyWatershedAOI
+from .model_client import ModelMyWatershedAPI
+from .project_pool import ModelMyWatershedProjectPool, _aoi_key
+
+module_logger = logging.getLogger(__name__)
+
+
+#%%
+class ModelMyWatershedWeatherData:
+    """A compact copy of the weather output for one area of interest and weather layer.
+
+    The daily precipitation and temperature values returned by ModelMyWatershed are
+    nested lists (year x month x day) of floats.  Holding thousands of those as Python
+    lists of float objects is very expensive, so any rectangular nested list of numbers
+    is flattened into a typed array of doubles with its shape kept alongside it.
+    """
+
+    __slots__ = ("weather_layer", "scalars", "arrays", "errors")
+
+    def __init__(self, weather_layer: str, weather_json: Dict):
+        """Packs a weather response from `get_project_weather` into arrays
+
+        Args:
+            weather_layer (str): The weather layer the data came from
+            weather_json (Dict): The json returned by `get_project_weather`
+        """
+        self.weather_layer = weather_layer
+        self.scalars: Dict[str, Any] = {}
+        self.arrays: Dict[str, Tuple[Tuple[int, ...], array.array]] = {}
+        self.errors = list(weather_json.get("errors", []))
+
+        for key, value in weather_json.get("output", {}).items():
+            shape = self._get_shape(value) if isinstance(value, list) else None
+            if shape is None:
+                self.scalars[key] = value
+            else:
+                self.arrays[key] = (shape, array.array("d", self._flatten(value)))
+
+    @staticmethod
+    def _get_shape(values: List) -> Union[Tuple[int, ...], None]:
+        """Gets the shape of a rectangular nested list of numbers, or None if the list
+        is ragged or holds anything other than numbers."""
+        if len(values) == 0:
+            return None
+        if all(isinstance(val, list) for val in values):
+            sub_shapes = set(
+                ModelMyWatershedWeatherData._get_shape(val) for val in values
+            )
+            if len(sub_shapes) != 1 or None in sub_shapes:
+                return None
+            return (len(values),) + sub_shapes.pop()
+        if all(
+            isinstance(val, (int, float)) and not isinstance(val, bool)
+            for val in values
+        ):
+            return (len(values),)
+        return None
+
+    @staticmethod
+    def _flatten(values: List):
+        for val in values:
+            if isinstance(val, list):
+                yield from ModelMyWatershedWeatherData._flatten(val)
+            else:
+                yield val
+
+    @staticmethod
+    def _nest(flat: array.array, shape: Tuple[int, ...]) -> List:
+        if len(shape) == 1:
+            return flat.tolist()
+        step = len(flat) // shape[0]
+        return [
+            ModelMyWatershedWeatherData._nest(
+                flat[i * step : (i + 1) * step], shape[1:]
+            )
+            for i in range(shape[0])
+        ]
+
+    def get_array(self, key: str) -> Tuple[Tuple[int, ...], array.array]:
+        """Returns the shape and flat array of doubles for one of the weather outputs
+
+        Args:
+            key (str): The output key, ie "Prec" or "Temp"
+
+        Returns:
+            Tuple[Tuple[int, ...], array.array]: The shape and the values in row-major
+                order
+        """
+        return self.arrays[key]
+
+    def to_dict(self) -> Dict:
+        """Rebuilds the weather json in the form returned by `get_project_weather`
+
+        Returns:
+            Dict: Weather output, ready to be fed into a project GWLF-E modification run
+        """
+        output = dict(self.scalars)
+        for key, (shape, flat) in self.arrays.items():
+            output[key] = self._nest(flat, shape)
+        return {"output": output, "errors": list(self.errors)}
+
+
+class ModelMyWatershedWeatherService:
+    """Retrieves weather data for areas of interest, caching the results by AOI and
+    weather layer.
+
+    Getting weather from ModelMyWatershed requires a (throw-away) project for the
+    area.  This service takes a single project per AOI from a project pool, requests
+    all of the needed weather layers for it concurrently, and leaves the pool to
+    re-use or delete the project in the background.  Because the weather is averaged
+    from the nearest stations, many adjacent AOIs share data, so results are kept in a
+    compact form for re-use.
+
+    YOU MUST BE LOGGED IN TO USE THIS FEATURE!
+    """
+
+    service_logger = module_logger.getChild(__qualname__)
+
+    def __init__(
+        self,
+        mmw_api: ModelMyWatershedAPI,
+        max_workers: int = 3,
+        project_pool: Union[ModelMyWatershedProjectPool, None] = None,
+    ):
+        """Create a new weather service on top of a logged-in API client
+
+        Args:
+            mmw_api (ModelMyWatershedAPI): The API client to make the requests with
+            max_workers (int, optional): The maximum number of weather requests to run
+                at once. Defaults to 3, one for each weather layer.
+            project_pool (Union[ModelMyWatershedProjectPool, None], optional): A project
+                pool to take the projects from.  If not given, the service creates and
+                closes its own pool.
+        """
+        self.mmw_api = mmw_api
+
+        self._owns_pool = project_pool is None
+        self.project_pool = (
+            ModelMyWatershedProjectPool(mmw_api)
+            if project_pool is None
+            else project_pool
+        )
+
+        self._cache: Dict[Tuple[str, str], ModelMyWatershedWeatherData] = {}
+        self._cache_lock = threading.Lock()
+        self._aoi_locks: Dict[str, threading.Lock] = {}
+
+        self._fetch_executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self) -> "ModelMyWatershedWeatherService":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _get_aoi_lock(self, aoi_key: str) -> threading.Lock:
+        with self._cache_lock:
+            if aoi_key not in self._aoi_locks:
+                self._aoi_locks[aoi_key] = threading.Lock()
+            return self._aoi_locks[aoi_key]
+
+    def get_weather(
+        self,
+        weather_layers: Union[List[str], None] = None,
+        area_of_interest: Union[Dict, None] = None,
+        wkaoi: Union[str, None] = None,
+        huc: Union[str, None] = None,
+    ) -> Dict[str, ModelMyWatershedWeatherData]:
+        """Gets the weather data for one area of interest, using cached values where
+        possible.  One of the area_of_interest, wkaoi, or huc must be given.
+
+        Args:
+            weather_layers (Union[List[str], None], optional): The weather layers to
+                get. Defaults to all of the layers in
+                `ModelMyWatershedAPI.weather_layers`.
+            area_of_interest (Union[Dict, None]): A geojson of the area of interest
+            wkaoi (Union[str, None]): A well known area of interest identifier
+            huc (Union[str, None]): A HUC identifier code (HUC8, HUC10, or HUC12)
+
+        Returns:
+            Dict[str, ModelMyWatershedWeatherData]: The weather data for each layer
+                that could be retrieved, keyed by the weather layer
+        """
+        if weather_layers is None:
+            weather_layers = self.mmw_api.weather_layers
+        aoi_key = _aoi_key(area_of_interest, wkaoi, huc)
+        if aoi_key == "":
+            self.service_logger.error(
+                "\t***Either a HUC code, an WKAoI, or a geojson is required to get weather!***"
+            )
+            return {}
+
+        # only one thread at a time may create a project for the same AOI
+        with self._get_aoi_lock(aoi_key):
+            weather = {
+                layer: self._cache[(aoi_key, layer)]
+                for layer in weather_layers
+                if (aoi_key, layer) in self._cache
+            }
+            missing_layers = [layer for layer in weather_layers if layer not in weather]
+            if len(missing_layers) == 0:
+                self.service_logger.debug(
+                    "\tUsing cached weather for {}".format(aoi_key)
+                )
+                return weather
+
+            with self.project_pool.project(area_of_interest, wkaoi, huc) as project_id:
+                if project_id is None:
+                    self.service_logger.error(
+                        "\t***Could not get a project to get weather for {}***".format(
+                            aoi_key
+                        )
+                    )
+                    return weather
+
+                layer_futures = {
+                    layer: self._fetch_executor.submit(
+                        self.mmw_api.get_project_weather, project_id, layer
+                    )
+                    for layer in missing_layers
+                }
+                for layer, layer_future in layer_futures.items():
+                    weather_json = layer_future.result()
+                    if weather_json is None or "output" not in weather_json.keys():
+                        continue
+                    compact_weather = ModelMyWatershedWeatherData(layer, weather_json)
+                    with self._cache_lock:
+                        self._cache[(aoi_key, layer)] = compact_weather
+                    weather[layer] = compact_weather
+
+        return weather
+
+    def get_bulk_weather(
+        self,
+        list_of_aois: List,
+        weather_layers: Union[List[str], None] = None,
+        max_aois: int = 2,
+    ) -> Dict[str, Dict[str, ModelMyWatershedWeatherData]]:
+        """Given a list of areas of interest (AOIs), gets the weather for all of them.
+
+        Args:
+            list_of_aois (List): A list of AOI's.  They can be strings, geojsons or
+                ModelMyWatershedAOI's.
+            weather_layers (Union[List[str], None], optional): The weather layers to
+                get. Defaults to all of the layers in
+                `ModelMyWatershedAPI.weather_layers`.
+            max_aois (int, optional): The number of AOI's to work on at once.
+                Defaults to 2.
+
+        Returns:
+            Dict[str, Dict[str, ModelMyWatershedWeatherData]]: The weather for each AOI,
+                keyed by the job label of the AOI and then the weather layer.  AOI's
+                with the same job label as an earlier one are skipped.
+        """
+        labeled_aois = []
+        seen_labels = set()
+        for run_number, aoi in enumerate(list_of_aois, start=1):
+            try:
+                mmw_aoi = ModelMyWatershedAOI.from_any(aoi, run_number)
+            except ValueError as ex:
+                self.service_logger.warn("\tSkipping invalid AOI: {}".format(ex))
+                continue
+            if mmw_aoi.job_label in seen_labels:
+                self.service_logger.warn(
+                    "\tSkipping AOI {}; an earlier AOI has the same job label".format(
+                        run_number
+                    )
+                )
+                continue
+            seen_labels.add(mmw_aoi.job_label)
+            labeled_aois.append((mmw_aoi.job_label, mmw_aoi.project_kwargs()))
+        with ThreadPoolExecutor(max_workers=max_aois) as aoi_executor:
+            aoi_futures = {
+                job_label: aoi_executor.submit(
+                    self.get_weather, weather_layers, **aoi_kwargs
+                )
+                for job_label, aoi_kwargs in labeled_aois
+            }
+            return {
+                job_label: aoi_future.result()
+                for job_label, aoi_future in aoi_futures.items()
+            }
+
+    def clear_cache(self) -> None:
+        """Forgets all cached weather data"""
+        with self._cache_lock:
+            self._cache.clear()
+
+    def close(self) -> None:
+        """Shuts down the worker threads and, if the service made its own project
+        pool, deletes all of its projects."""
+        self._fetch_executor.shutdown(wait=True)
+        if self._owns_pool:
+            self.project_pool.close()